@@ -1,50 +1,70 @@
-import json
 import os
+import time
 
 import boto3
+from aws_lambda_powertools import Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+
+from catalog_keys import query_product_shards
+from catalog_snapshot import catalog_version, product_digest, record_loaded_version
+from dynamodb_loader import BulkLoader, iter_json_items, migrate_legacy_products, product_item
 
-dynamodb = boto3.resource('dynamodb')
 table_name = os.environ.get("ECOMMERCE_TABLE_NAME")
-table = dynamodb.Table(table_name)
+# A JSON array or JSON Lines file, streamed rather than loaded at import time
+product_source = os.environ.get("PRODUCT_SOURCE", "product_list.json")
+loader_workers = int(os.environ.get("LOADER_WORKERS", "8"))
+
+loader = BulkLoader(table_name, workers=loader_workers)
+table = boto3.resource("dynamodb").Table(table_name)
+
+metrics = Metrics()
+
+
+def record_catalog_version(digests: dict, loaded_at_ms: int) -> None:
+    """
+    Records the version of the loaded catalog for the agent's catalog snapshot,
+    unless the table holds more products than were loaded.
+    """
+    stored = sum(1 for _ in query_product_shards(table, ProjectionExpression="productId"))
+    if stored != len(digests):
+        print(f"The table holds {stored} products and {len(digests)} were loaded, catalog version not recorded")
+        return
+    version = catalog_version(digests)
+    record_loaded_version(table, version, loaded_at_ms)
+    print(f"Catalog version {version} recorded")
 
-with open("product_list.json", "r") as product_list:
-    product_list = json.load(product_list)
 
+@metrics.log_metrics
 def handler(event, context):
-    print("Retrieving all products: %s", product_list)
-    print(f"item id is {product_list[0]['productId']}")
+    print(f"Loading products from {product_source} into {table_name}")
+    # Product writes the stream processor reports after this point leave the
+    # recorded catalog version out of date
+    started_ms = int(time.time() * 1000)
+    digests = {}
+
+    def products():
+        for item in iter_json_items(product_source):
+            digests[item["productId"]] = product_digest(item)
+            yield product_item(item)
 
     try:
-        with table.batch_writer() as batch:
-            for item in product_list:
-                batch.put_item(
-                    Item={
-                        "PK": f"PRODUCT",
-                        "SK": f"PRODUCT#{item['productId']}",
-                        "productId": item["productId"],
-                        "category": item["category"],
-                        "createdDate": item["createdDate"],
-                        "description": item["description"],
-                        "modifiedDate": item["modifiedDate"],
-                        "name": item["name"],
-                        "package": item["package"],
-                        "pictures": item["pictures"],
-                        "price": item["price"],
-                        "tags": item["tags"],
-                    }
-                )
+        # Products written before the catalog was sharded are moved first, so
+        # the catalog is never split between the two layouts for long
+        migrated = migrate_legacy_products(table, loader)
+        metrics.add_metric(name="ProductsMigrated", unit=MetricUnit.Count, value=migrated.written)
+        if migrated.failed:
+            return False
+
+        report = loader.load(products())
+        metrics.add_metric(name="ProductsWritten", unit=MetricUnit.Count, value=report.written)
+        metrics.add_metric(name="ProductsFailed", unit=MetricUnit.Count, value=report.failed)
+        metrics.add_metric(name="DynamoDBCalls", unit=MetricUnit.Count, value=report.requests)
+        metrics.add_metric(name="DynamoDBThrottles", unit=MetricUnit.Count, value=report.throttled)
+        metrics.add_metric(name="LoadDuration", unit=MetricUnit.Milliseconds, value=report.seconds * 1000)
+        if report.failed:
+            return False
+        record_catalog_version(digests, started_ms)
         return True
     except Exception as e:
         print(f"Exception: {e}")
         return False
-
-
-
-
-
-
-
-
-
-
-
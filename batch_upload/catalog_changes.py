@@ -0,0 +1,143 @@
+"""
+Feed of recent catalog changes kept in GroceryAppTable.
+
+The catalog stream processor (catalog_stream.py) writes one item per product it
+synced under `PK=CATALOG_CHANGE`, sorted by the time of the change, and the
+items expire through the table TTL. Warm agent containers poll the feed at most
+every CATALOG_CHANGES_CHECK_SECONDS and apply only the listed products to
+their in-memory catalog index and matcher, instead of waiting for the TTL of
+those indexes to rebuild them from scratch.
+
+Items written by concurrent stream batches can land slightly out of order, so
+every poll reads back CATALOG_CHANGES_LOOKBACK_MS further than the newest
+change it has seen and skips the changes it already returned.
+"""
+import os
+import re
+import threading
+import time
+from time import monotonic
+from typing import Dict, Iterable, List, Optional
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import BotoCoreError, ClientError
+
+CATALOG_CHANGE_PK = "CATALOG_CHANGE"
+CATALOG_CHANGES_TTL_SECONDS = int(os.environ.get("CATALOG_CHANGES_TTL_SECONDS", "86400"))
+CATALOG_CHANGES_CHECK_SECONDS = int(os.environ.get("CATALOG_CHANGES_CHECK_SECONDS", "30"))
+CATALOG_CHANGES_LOOKBACK_MS = int(os.environ.get("CATALOG_CHANGES_LOOKBACK_MS", "60000"))
+# How long the feed remembers which product names changed, for callers holding
+# entries resolved before the change (see changed_since)
+CATALOG_CHANGES_RETAIN_SECONDS = int(os.environ.get("CATALOG_CHANGES_RETAIN_SECONDS", "3600"))
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _name_key(name: str) -> str:
+    return _WHITESPACE.sub(" ", name).strip().casefold()
+
+
+def _changed_at_ms(item: dict) -> int:
+    return int(item["SK"].split("#", 1)[0])
+
+
+def change_item(product: dict, previous_name: Optional[str] = None, removed: bool = False,
+                at_ms: Optional[int] = None) -> dict:
+    """
+    The feed item for one changed product. It carries the fields the agent's
+    matcher indexes, and the name the product had before when it was renamed.
+    """
+    at_ms = at_ms if at_ms is not None else int(time.time() * 1000)
+    item = {
+        "PK": CATALOG_CHANGE_PK,
+        "SK": f"{at_ms:013d}#{product['productId']}",
+        "productId": product["productId"],
+        "name": product.get("name"),
+        "category": product.get("category", ""),
+        "tags": product.get("tags") or [],
+        "price": product.get("price"),
+        "removed": removed,
+        "expiresAt": at_ms // 1000 + CATALOG_CHANGES_TTL_SECONDS,
+    }
+    if previous_name and previous_name != product.get("name"):
+        item["previousName"] = previous_name
+    return item
+
+
+def record_changes(table, items: Iterable[dict]) -> None:
+    with table.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+
+
+class CatalogChangeFeed:
+    """
+    Polls the change feed and returns each change once.
+    """
+
+    def __init__(self, table=None, check_interval_seconds: int = CATALOG_CHANGES_CHECK_SECONDS,
+                 lookback_ms: int = CATALOG_CHANGES_LOOKBACK_MS,
+                 retain_seconds: int = CATALOG_CHANGES_RETAIN_SECONDS):
+        self._table = table
+        self.check_interval_seconds = check_interval_seconds
+        self.lookback_ms = lookback_ms
+        self.retain_seconds = retain_seconds
+        # Indexes built after the container started already reflect the older changes
+        self.since_ms = int(time.time() * 1000)
+        self._returned: Dict[str, int] = {}
+        self._changed_names: Dict[str, int] = {}
+        self._checked_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = boto3.resource("dynamodb").Table(os.environ.get("ECOMMERCE_TABLE_NAME"))
+        return self._table
+
+    def _query(self, after_ms: int) -> Iterable[dict]:
+        kwargs = {"KeyConditionExpression": Key("PK").eq(CATALOG_CHANGE_PK) & Key("SK").gt(f"{after_ms:013d}")}
+        while True:
+            response = self.table.query(**kwargs)
+            yield from response["Items"]
+            if "LastEvaluatedKey" not in response:
+                return
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def poll(self) -> List[dict]:
+        """
+        Returns the changes not returned before, oldest first. Within the check
+        interval of the previous poll it returns nothing without reading the
+        table, and a failed read is retried at the next interval.
+        """
+        with self._lock:
+            now = monotonic()
+            if self._checked_at is not None and now - self._checked_at < self.check_interval_seconds:
+                return []
+            self._checked_at = now
+
+            try:
+                changes = [item for item in self._query(self.since_ms - self.lookback_ms)
+                           if item["SK"] not in self._returned]
+            except (BotoCoreError, ClientError) as e:
+                print(f"Error reading the catalog change feed: {e}")
+                return []
+            for item in changes:
+                at_ms = _changed_at_ms(item)
+                self._returned[item["SK"]] = at_ms
+                self.since_ms = max(self.since_ms, at_ms)
+                for name in (item.get("name"), item.get("previousName")):
+                    if name:
+                        self._changed_names[_name_key(name)] = at_ms
+
+            horizon = self.since_ms - self.lookback_ms
+            self._returned = {sk: at_ms for sk, at_ms in self._returned.items() if at_ms >= horizon}
+            horizon = int(time.time() * 1000) - self.retain_seconds * 1000
+            self._changed_names = {name: at_ms for name, at_ms in self._changed_names.items() if at_ms >= horizon}
+            return changes
+
+    def changed_since(self, product_name: str, at_seconds: float) -> bool:
+        """Whether a product of this name changed after `at_seconds` (epoch seconds)."""
+        changed_at_ms = self._changed_names.get(_name_key(product_name))
+        return changed_at_ms is not None and changed_at_ms >= at_seconds * 1000
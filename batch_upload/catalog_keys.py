@@ -0,0 +1,72 @@
+"""
+Key layout of the products in GroceryAppTable.
+
+Products used to share the single partition `PK=PRODUCT`, so every catalog
+write and every full catalog read went to one partition. They are spread over
+PRODUCT_SHARDS partitions `PRODUCT#00`, `PRODUCT#01`, ... instead, chosen by the
+last hex digit of the productId. Product ids are random UUIDs, so the shards
+fill evenly, and the shard follows from the id alone: the getProduct resolver
+computes it the same way in VTL (graphql/resolvers/getProduct.request.vtl), so
+PRODUCT_SHARDS must stay a divisor of 16 and match the resolvers. Reading the
+whole catalog queries the shards in parallel (query_product_shards).
+
+Products also carry the keys of the productsByCategory index, the category in
+GSI3PK and the price in GSI3SK, so a category is listed in price order without
+reading the rest of the catalog.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional
+
+from boto3.dynamodb.conditions import Key
+
+PRODUCT_SHARDS = 8
+LEGACY_PRODUCT_PK = "PRODUCT"
+CATEGORY_INDEX = "productsByCategory"
+
+_HEX_DIGITS = "0123456789abcdef"
+
+
+def product_shard(product_id: str) -> int:
+    # Ids that do not end in a hex digit all land in shard 0
+    return max(_HEX_DIGITS.find(product_id[-1:].lower()), 0) % PRODUCT_SHARDS
+
+
+def shard_pk(shard: int) -> str:
+    return f"PRODUCT#{shard:02d}"
+
+
+def product_key(product_id: str) -> dict:
+    return {"PK": shard_pk(product_shard(product_id)), "SK": f"PRODUCT#{product_id}"}
+
+
+def category_pk(category: str) -> str:
+    return f"CATEGORY#{category}"
+
+
+def is_product_pk(pk: str) -> bool:
+    return pk.startswith("PRODUCT#")
+
+
+def _query_shard(table, shard: int, on_query: Optional[Callable[[], None]], kwargs: dict) -> List[dict]:
+    kwargs = dict(kwargs, KeyConditionExpression=Key("PK").eq(shard_pk(shard)))
+    items = []
+    while True:
+        if on_query:
+            on_query()
+        response = table.query(**kwargs)
+        items.extend(response["Items"])
+        if "LastEvaluatedKey" not in response:
+            return items
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+
+def query_product_shards(table, on_query: Optional[Callable[[], None]] = None, **kwargs) -> Iterator[dict]:
+    """
+    Queries every product shard in parallel, with `kwargs` added to each
+    Query, and yields the products of all shards. `on_query` is called before
+    every Query request, from the worker threads.
+    """
+    with ThreadPoolExecutor(max_workers=PRODUCT_SHARDS) as pool:
+        shards = pool.map(lambda shard: _query_shard(table, shard, on_query, kwargs), range(PRODUCT_SHARDS))
+        for items in list(shards):
+            yield from items
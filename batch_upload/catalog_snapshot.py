@@ -0,0 +1,203 @@
+"""
+Deploy-time snapshot of the product catalog for the agent Lambda.
+
+The CDK app compiles batch_upload/product_list.json into a compact binary file
+(write_snapshot) that ships in the agent image, so a new container indexes the
+catalog from a memory-mapped file instead of reading every product shard of
+GroceryAppTable. For every product the file holds its id, name, category, tags
+and price, in fixed-size records sorted by product id, followed by the string
+data:
+
+    header   magic, format, product count, catalog version
+    records  (offset, length) of the id, name, category and tags, and the
+             price, per product
+    strings  UTF-8 data the records point into
+
+The catalog version is a hash of those fields, so the same product list always
+compiles to the same file and asset hash. The table tells whether it still
+holds that catalog through the CATALOG_VERSION item: the product loader records
+the version it loaded (record_loaded_version) and the stream processor stamps
+the item whenever a product is written that differs from the product list
+(mark_modified). A snapshot is only used while the item reports its version
+and no modification after that load (CatalogSnapshot.is_current). Checking
+costs one GetItem, so the snapshot replaces the full read of the shards, not
+the check itself.
+
+This module only uses the standard library, as the CDK app imports it too.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+from typing import Dict, Iterable, Iterator, Optional
+
+CATALOG_SNAPSHOT_PATH = os.environ.get(
+    "CATALOG_SNAPSHOT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.snapshot"))
+CATALOG_VERSION_KEY = {"PK": "CATALOG_VERSION", "SK": "CURRENT"}
+
+MAGIC = b"GCAT"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<4sHI16s")
+# (offset, length) of the product id, name, category and tags, then the price
+RECORD = struct.Struct("<IHIHIHIHq")
+NO_PRICE = -1 << 63
+TAG_SEPARATOR = "\x1f"
+
+
+def product_digest(product: dict) -> bytes:
+    """Hashes the product fields the snapshot holds."""
+    fields = {
+        "productId": product["productId"],
+        "name": product.get("name"),
+        "category": product.get("category", ""),
+        "tags": list(product.get("tags") or []),
+        "price": product.get("price"),
+    }
+    canonical = json.dumps(fields, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).digest()[:8]
+
+
+def catalog_version(digests: Dict[str, bytes]) -> str:
+    """The version of a catalog, from the product_digest of each product id."""
+    combined = hashlib.sha256()
+    for product_id in sorted(digests):
+        combined.update(product_id.encode("utf-8"))
+        combined.update(digests[product_id])
+    return combined.hexdigest()[:16]
+
+
+def catalog_digests(path: str) -> Dict[str, bytes]:
+    with open(path) as f:
+        return {product["productId"]: product_digest(product) for product in json.load(f)}
+
+
+def build_snapshot(products: Iterable[dict]) -> bytes:
+    """Compiles products into the snapshot format. A product id listed twice keeps its last entry."""
+    by_id = {product["productId"]: product for product in products}
+    version = catalog_version({product_id: product_digest(product) for product_id, product in by_id.items()})
+    ordered = [by_id[product_id] for product_id in sorted(by_id)]
+
+    strings, offsets = bytearray(), {}
+
+    def intern(text: str):
+        data = text.encode("utf-8")
+        if data not in offsets:
+            offsets[data] = len(strings)
+            strings.extend(data)
+        return offsets[data], len(data)
+
+    records = bytearray()
+    for product in ordered:
+        price = product.get("price")
+        fields = (product["productId"], product["name"], product.get("category", ""),
+                  TAG_SEPARATOR.join(product.get("tags") or []))
+        records.extend(RECORD.pack(*(value for text in fields for value in intern(text)),
+                                   NO_PRICE if price is None else int(price)))
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, len(ordered), version.encode("ascii"))
+    return header + bytes(records) + bytes(strings)
+
+
+def write_snapshot(source_path: str, target_path: str) -> str:
+    """
+    Compiles a JSON product list into a snapshot file and returns its catalog
+    version. An identical file is left untouched.
+    """
+    with open(source_path) as f:
+        data = build_snapshot(json.load(f))
+    try:
+        with open(target_path, "rb") as existing:
+            unchanged = existing.read() == data
+    except FileNotFoundError:
+        unchanged = False
+    if not unchanged:
+        os.makedirs(os.path.dirname(target_path) or ".", exist_ok=True)
+        with open(target_path, "wb") as f:
+            f.write(data)
+    return CatalogSnapshot(data).version
+
+
+class CatalogSnapshot:
+    """
+    Read-only view of a snapshot. Products are decoded from the buffer on
+    access, so opening a memory-mapped file reads nothing up front.
+    """
+
+    def __init__(self, buffer):
+        magic, format_version, self._count, version = HEADER.unpack_from(buffer)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise ValueError(f"Not a version {FORMAT_VERSION} catalog snapshot")
+        self._buffer = buffer
+        self.version = version.decode("ascii")
+        self._strings_offset = HEADER.size + self._count * RECORD.size
+
+    @classmethod
+    def open(cls, path: str) -> "CatalogSnapshot":
+        with open(path, "rb") as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _string(self, offset: int, length: int) -> str:
+        start = self._strings_offset + offset
+        return bytes(self._buffer[start:start + length]).decode("utf-8")
+
+    def _record(self, number: int) -> tuple:
+        return RECORD.unpack_from(self._buffer, HEADER.size + number * RECORD.size)
+
+    def _product(self, number: int) -> dict:
+        *fields, price = self._record(number)
+        product_id, name, category, tags = (self._string(*fields[i:i + 2]) for i in range(0, len(fields), 2))
+        return {
+            "productId": product_id,
+            "name": name,
+            "category": category,
+            "tags": tags.split(TAG_SEPARATOR) if tags else [],
+            "price": None if price == NO_PRICE else price,
+        }
+
+    def products(self) -> Iterator[dict]:
+        return (self._product(number) for number in range(self._count))
+
+    def is_current(self, table) -> bool:
+        """
+        Whether the table was last loaded with this catalog and no product was
+        written differently since. Costs one GetItem.
+        """
+        item = table.get_item(Key=CATALOG_VERSION_KEY, ConsistentRead=True).get("Item") or {}
+        if item.get("version") != self.version:
+            return False
+        modified_at = item.get("modifiedAt")
+        return modified_at is None or modified_at < item["loadedAt"]
+
+
+def load_snapshot(path: str = CATALOG_SNAPSHOT_PATH) -> Optional[CatalogSnapshot]:
+    """Opens the snapshot shipped with the function, or returns None when there is none."""
+    try:
+        return CatalogSnapshot.open(path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, struct.error) as e:
+        print(f"Error opening the catalog snapshot {path}: {e}")
+        return None
+
+
+def record_loaded_version(table, version: str, loaded_at_ms: int) -> None:
+    """Records that the table holds catalog `version`, loaded from `loaded_at_ms` on."""
+    table.update_item(
+        Key=CATALOG_VERSION_KEY,
+        UpdateExpression="SET #version = :version, #loadedAt = :loadedAt",
+        ExpressionAttributeNames={"#version": "version", "#loadedAt": "loadedAt"},
+        ExpressionAttributeValues={":version": version, ":loadedAt": loaded_at_ms},
+    )
+
+
+def mark_modified(table, at_ms: int) -> None:
+    """Records that a product differing from the loaded catalog was written."""
+    table.update_item(
+        Key=CATALOG_VERSION_KEY,
+        UpdateExpression="SET #modifiedAt = :modifiedAt",
+        ExpressionAttributeNames={"#modifiedAt": "modifiedAt"},
+        ExpressionAttributeValues={":modifiedAt": at_ms},
+    )
@@ -0,0 +1,164 @@
+"""
+GroceryAppTable stream processor that carries product writes to Stripe and to
+the agent's in-memory catalog indexes.
+
+Only the products in a stream batch are looked up in Stripe (retrieved by id,
+see stripe_sync.find_products) and only those whose synced fields
+changed are created, updated or archived, so keeping the catalog consistent
+costs work in proportion to the change rather than a run of
+create_stripe_products over the whole list. Every product that was synced is
+then written to the catalog change feed (catalog_changes.py), which warm agent
+containers apply to their indexes, and the AppSync product cache is flushed
+when the API has one.
+
+A product that could not be synced is reported as a batch item failure, so the
+stream resumes from its first record; the products already synced are
+unchanged on the retry and cost one lookup each.
+
+Writes that leave a product different from product_list.json, which the
+agent's catalog snapshot is compiled from, are stamped on the catalog version
+item so agents stop using the snapshot (see catalog_snapshot.py).
+"""
+import os
+import time
+from decimal import Decimal
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Tuple
+
+import boto3
+import stripe
+from aws_lambda_powertools import Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+from catalog_changes import change_item, record_changes
+from catalog_keys import is_product_pk
+from catalog_snapshot import catalog_digests, mark_modified, product_digest
+from stripe_sync import StripeCatalogSync, find_products, plan_sync, take_call_counts
+
+stripe.api_key = 'sk_test_o5XBQtVklHa7okPAhm5Ey61C00T7DHjBgB'
+
+STRIPE_SYNC_CONCURRENCY = int(os.environ.get("STRIPE_SYNC_CONCURRENCY", "8"))
+APPSYNC_API_ID = os.environ.get("APPSYNC_API_ID")
+
+table = boto3.resource("dynamodb").Table(os.environ.get("ECOMMERCE_TABLE_NAME"))
+appsync = boto3.client("appsync")
+
+_deserializer = TypeDeserializer()
+
+metrics = Metrics()
+
+
+def _plain(value):
+    """Turns the Decimals of a deserialized image back into the ints and floats of the catalog JSON."""
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {key: _plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_plain(item) for item in value]
+    return value
+
+
+def product_changes(records: Iterable[dict]) -> Tuple[Dict[str, Optional[dict]], Dict[str, str]]:
+    """
+    Reduces a batch to the latest image of every product it touches, None for
+    a deleted product, and the sequence number of each product's first record.
+    Records of other items in the table are skipped.
+    """
+    latest: Dict[str, Optional[dict]] = {}
+    first_sequence: Dict[str, str] = {}
+    for record in records:
+        change = record["dynamodb"]
+        keys = change["Keys"]
+        if not is_product_pk(keys["PK"]["S"]):
+            continue
+        product_id = keys["SK"]["S"].split("#", 1)[1]
+        first_sequence.setdefault(product_id, change["SequenceNumber"])
+        if record["eventName"] == "REMOVE":
+            latest[product_id] = None
+        else:
+            image = {name: _deserializer.deserialize(value) for name, value in change["NewImage"].items()}
+            latest[product_id] = _plain(image)
+    return latest, first_sequence
+
+
+@lru_cache(maxsize=None)
+def listed_products() -> Dict[str, bytes]:
+    return catalog_digests(os.path.join(os.path.dirname(os.path.abspath(__file__)), "product_list.json"))
+
+
+def differs_from_list(latest: Dict[str, Optional[dict]]) -> bool:
+    listed = listed_products()
+    return any(image is None or listed.get(product_id) != product_digest(image)
+               for product_id, image in latest.items())
+
+
+def flush_api_cache() -> None:
+    if not APPSYNC_API_ID:
+        return
+    try:
+        appsync.flush_api_cache(apiId=APPSYNC_API_ID)
+    except ClientError as e:
+        # The cache entries still expire with their TTL
+        print(f"Error flushing the AppSync cache: {e}")
+
+
+@metrics.log_metrics
+def handler(event, context):
+    metrics.add_metric(name="StreamRecords", unit=MetricUnit.Count, value=len(event["Records"]))
+    latest, first_sequence = product_changes(event["Records"])
+    if not latest:
+        return {"batchItemFailures": []}
+
+    started = time.perf_counter()
+    if differs_from_list(latest):
+        mark_modified(table, int(time.time() * 1000))
+
+    existing = find_products(list(latest))
+    plan = plan_sync([image for image in latest.values() if image is not None], existing)
+    plan.archives = [existing[product_id] for product_id, image in latest.items()
+                     if image is None and product_id in existing and existing[product_id].get("active", True)]
+    print(f"Stream sync plan: {len(plan.creates)} to create, {len(plan.updates)} to update, "
+          f"{len(plan.archives)} to archive, {plan.unchanged} unchanged")
+
+    sync = StripeCatalogSync(
+        max_workers=STRIPE_SYNC_CONCURRENCY,
+        remaining_time_ms=context.get_remaining_time_in_millis if context else None,
+    )
+    outcomes = sync.apply(plan)
+    counts = take_call_counts()
+    metrics.add_metric(name="SyncDuration", unit=MetricUnit.Milliseconds, value=(time.perf_counter() - started) * 1000)
+    metrics.add_metric(name="StripeCalls", unit=MetricUnit.Count, value=counts["calls"])
+    metrics.add_metric(name="StripeRateLimited", unit=MetricUnit.Count, value=counts["rate_limited"])
+    planned = {
+        "Created": [product_data["productId"] for product_data, _ in plan.creates],
+        "Updated": [product_data["productId"] for product_data, _, _ in plan.updates],
+        "Archived": [product.metadata["productId"] for product in plan.archives],
+    }
+    for name, product_ids in planned.items():
+        done = sum(1 for product_id in product_ids if outcomes[product_id] == "done")
+        metrics.add_metric(name=f"Products{name}", unit=MetricUnit.Count, value=done)
+    metrics.add_metric(name="ProductsUnchanged", unit=MetricUnit.Count, value=plan.unchanged)
+
+    changes = []
+    for product_id, image in latest.items():
+        if outcomes.get(product_id, "done") != "done":
+            continue
+        product = existing.get(product_id)
+        previous_name = product.name if product is not None else None
+        if image is None:
+            changes.append(change_item({"productId": product_id, "name": previous_name}, removed=True))
+        else:
+            changes.append(change_item(image, previous_name=previous_name))
+    if changes:
+        record_changes(table, changes)
+        flush_api_cache()
+
+    failed = [first_sequence[product_id] for product_id, outcome in outcomes.items() if outcome != "done"]
+    metrics.add_metric(name="ProductsFailed", unit=MetricUnit.Count, value=len(failed))
+    metrics.add_metric(name="CatalogChangesRecorded", unit=MetricUnit.Count, value=len(changes))
+    print(f"Stream sync: {len(changes)} products applied, {len(failed)} to retry")
+    # The stream is retried from the earliest failed record onwards
+    return {"batchItemFailures": [{"itemIdentifier": min(failed, key=int)}] if failed else []}
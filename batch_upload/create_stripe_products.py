@@ -1,49 +1,52 @@
 import json
 import os
+import time
+
 import stripe
-import boto3
+from aws_lambda_powertools import Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+
+from stripe_sync import StripeCatalogSync, take_call_counts
 
 stripe.api_key = 'sk_test_o5XBQtVklHa7okPAhm5Ey61C00T7DHjBgB'
 
 with open("product_list.json", "r") as product_list:
     product_list = json.load(product_list)
 
+STRIPE_SYNC_CONCURRENCY = int(os.environ.get("STRIPE_SYNC_CONCURRENCY", "8"))
+
+metrics = Metrics()
+
+
+def record_stripe_calls():
+    counts = take_call_counts()
+    metrics.add_metric(name="StripeCalls", unit=MetricUnit.Count, value=counts["calls"])
+    metrics.add_metric(name="StripeRateLimited", unit=MetricUnit.Count, value=counts["rate_limited"])
+
 
+@metrics.log_metrics
 def handler(event, context):
-    print("Retrieving all products: %s", product_list)
-    print(f"item id is {product_list[0]['productId']}")
-    response = ''
-    # Iterate through the list and create products and prices
-    for product_data in product_list:
-        try:
-            # Create a product
-            product = stripe.Product.create(
-                name=product_data["name"],
-                description=product_data["description"],
-                metadata={
-                    "category": product_data["category"],
-                    "createdDate": product_data["createdDate"],
-                    "modifiedDate": product_data["modifiedDate"],
-                    "productId": product_data["productId"],
-                    "tags": ", ".join(product_data["tags"]),
-                    "package": json.dumps(product_data["package"]),
-                },
-                images=product_data["pictures"],
-            )
-            print(f"Product created: {product.name} (ID: {product.id})")
-
-            # Create a price for the product
-            price = stripe.Price.create(
-                unit_amount=product_data["price"],  # Price in cents
-                currency="usd",  # Currency code
-                product=product.id,  # Link to the product
-            )
-            print(f"Price created: {price.unit_amount / 100} {price.currency} (ID: {price.id})")
-            response = "Product Created"
-
-
-        except stripe.error.StripeError as e:
-            print(f"Error creating product or price for {product_data['name']}: {e.user_message}")
-            response = "Failed to create Product"
-
-    return response
+    print(f"Syncing {len(product_list)} products to Stripe")
+
+    # Only products that are new or changed since the last sync are sent to
+    # Stripe. A run that hits the Lambda timeout reports the remaining products
+    # and the next invocation picks them up.
+    sync = StripeCatalogSync(
+        max_workers=STRIPE_SYNC_CONCURRENCY,
+        remaining_time_ms=context.get_remaining_time_in_millis if context else None,
+    )
+    started = time.perf_counter()
+    try:
+        summary = sync.run(product_list)
+    except stripe.error.StripeError as e:
+        print(f"Error syncing products: {e.user_message}")
+        return "Failed to create Product"
+    finally:
+        metrics.add_metric(name="SyncDuration", unit=MetricUnit.Milliseconds,
+                           value=(time.perf_counter() - started) * 1000)
+        record_stripe_calls()
+
+    for name in ("created", "updated", "unchanged", "failed", "remaining"):
+        metrics.add_metric(name=f"Products{name.capitalize()}", unit=MetricUnit.Count, value=summary[name])
+    print(f"Sync summary: {summary}")
+    return json.dumps(summary)
@@ -0,0 +1,281 @@
+"""
+Streaming, parallel bulk loader for the product catalog.
+
+Items are read one at a time from a JSON array or JSON Lines source, grouped
+into BatchWriteItem requests of 25 and handed through a bounded queue to a pool
+of writer threads, so memory stays flat however large the catalog is. Each
+writer retries its unprocessed items and throttling errors with an adaptive
+delay that grows while DynamoDB pushes back and shrinks again once writes go
+through cleanly.
+
+The loader only needs a low-level DynamoDB client, so it runs unchanged against
+DynamoDB Local (set DYNAMODB_ENDPOINT_URL) or an in-process stand-in.
+"""
+import json
+import os
+import queue
+import random
+import threading
+import time
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import IO, Iterable, Iterator, List, Optional, Tuple, Union
+
+import boto3
+from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeSerializer
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+from catalog_keys import LEGACY_PRODUCT_PK, category_pk, product_key
+
+BATCH_SIZE = 25  # BatchWriteItem limit
+THROTTLING_ERRORS = {
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+}
+
+_serializer = TypeSerializer()
+_decoder = json.JSONDecoder(parse_float=Decimal)
+
+
+def product_item(item: dict) -> dict:
+    """Maps a catalog product onto the GroceryAppTable key layout (see catalog_keys.py)."""
+    return {
+        **product_key(item["productId"]),
+        "GSI3PK": category_pk(item["category"]),
+        "GSI3SK": item["price"],
+        "productId": item["productId"],
+        "category": item["category"],
+        "createdDate": item["createdDate"],
+        "description": item["description"],
+        "modifiedDate": item["modifiedDate"],
+        "name": item["name"],
+        "package": item["package"],
+        "pictures": item["pictures"],
+        "price": item["price"],
+        "tags": item["tags"],
+    }
+
+
+def _to_dynamodb(value):
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: _to_dynamodb(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_to_dynamodb(v) for v in value]
+    return value
+
+
+def serialize_item(item: dict) -> dict:
+    return {k: _serializer.serialize(_to_dynamodb(v)) for k, v in item.items()}
+
+
+def iter_json_items(source: Union[str, IO[str]], chunk_size: int = 1 << 16) -> Iterator[dict]:
+    """
+    Yields the objects of a JSON array or JSON Lines document without loading
+    the whole document into memory.
+    """
+    if isinstance(source, str):
+        with open(source, "r") as stream:
+            yield from iter_json_items(stream, chunk_size)
+        return
+
+    buffer = ""
+    array = None
+    eof = False
+    while True:
+        if not eof and len(buffer) < chunk_size:
+            chunk = source.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+
+        buffer = buffer.lstrip()
+        if array is None and buffer:
+            array = buffer[0] == "["
+            if array:
+                buffer = buffer[1:]
+            continue
+        if array and buffer[:1] in (",", "]"):
+            buffer = buffer[1:]
+            continue
+        if not buffer:
+            if eof:
+                return
+            continue
+
+        try:
+            item, end = _decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # The next object is split across chunks, read more of it.
+            chunk = source.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+            continue
+        buffer = buffer[end:]
+        yield item
+
+
+@dataclass
+class LoadReport:
+    items: int = 0
+    written: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+    # BatchWriteItem calls, and those that were throttled or left items unprocessed
+    requests: int = 0
+    throttled: int = 0
+
+    @property
+    def items_per_second(self) -> float:
+        return self.written / self.seconds if self.seconds else 0.0
+
+
+class AdaptiveDelay:
+    """
+    Per-writer backoff: doubles (with jitter) on every throttled attempt and
+    decays once batches are fully processed again.
+    """
+
+    def __init__(self, base: float = 0.05, maximum: float = 2.0):
+        self.base = base
+        self.maximum = maximum
+        self.current = 0.0
+
+    def throttled(self) -> None:
+        self.current = min(self.maximum, max(self.base, self.current * 2))
+        time.sleep(random.uniform(self.current / 2, self.current))
+
+    def succeeded(self) -> None:
+        self.current = self.current / 2 if self.current > self.base else 0.0
+        if self.current:
+            time.sleep(self.current)
+
+
+def dynamodb_client(max_pool_connections: int = 16):
+    return boto3.client(
+        "dynamodb",
+        endpoint_url=os.environ.get("DYNAMODB_ENDPOINT_URL"),
+        config=Config(max_pool_connections=max_pool_connections, retries={"mode": "standard"}),
+    )
+
+
+class BulkLoader:
+    """
+    Writes an iterable of items to one table with `workers` concurrent
+    BatchWriteItem writers.
+    """
+
+    def __init__(self, table_name: str, client=None, workers: int = 8, max_attempts: int = 10,
+                 base_delay: float = 0.05, max_delay: float = 2.0):
+        self.table_name = table_name
+        self.workers = workers
+        self.client = client or dynamodb_client(max_pool_connections=workers + 2)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def _write_batch(self, requests: List[dict], delay: AdaptiveDelay) -> Tuple[int, int, int]:
+        """
+        Writes one batch. Returns the number of items that could not be written,
+        the calls made and how many of them were throttled.
+        """
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                response = self.client.batch_write_item(RequestItems={self.table_name: requests})
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in THROTTLING_ERRORS:
+                    raise
+                delay.throttled()
+                continue
+
+            requests = response.get("UnprocessedItems", {}).get(self.table_name, [])
+            if not requests:
+                delay.succeeded()
+                return 0, attempt, attempt - 1
+            delay.throttled()
+        return len(requests), self.max_attempts, self.max_attempts
+
+    def _writer(self, batches: "queue.Queue", report: LoadReport, lock: threading.Lock) -> None:
+        delay = AdaptiveDelay(self.base_delay, self.max_delay)
+        while True:
+            requests = batches.get()
+            if requests is None:
+                return
+            try:
+                failed, calls, throttled = self._write_batch(requests, delay)
+            except (ClientError, BotoCoreError) as e:
+                # Count the batch as failed and keep draining the queue, or the
+                # reader blocks on it once every writer has stopped
+                print(f"Batch write failed: {e}")
+                failed, calls, throttled = len(requests), 1, 0
+            with lock:
+                report.written += len(requests) - failed
+                report.failed += failed
+                report.requests += calls
+                report.throttled += throttled
+
+    def load(self, items: Iterable[dict]) -> LoadReport:
+        report = LoadReport()
+        lock = threading.Lock()
+        # A bounded queue keeps the reader at most a few batches ahead of the writers.
+        batches: "queue.Queue[Optional[List[dict]]]" = queue.Queue(maxsize=self.workers * 2)
+        writers = [
+            threading.Thread(target=self._writer, args=(batches, report, lock), daemon=True)
+            for _ in range(self.workers)
+        ]
+        started = time.perf_counter()
+        for writer in writers:
+            writer.start()
+
+        batch = {}
+        for item in items:
+            report.items += 1
+            # BatchWriteItem rejects two requests for the same key, the last one wins.
+            batch[(item["PK"], item["SK"])] = {"PutRequest": {"Item": serialize_item(item)}}
+            if len(batch) == BATCH_SIZE:
+                batches.put(list(batch.values()))
+                batch = {}
+        if batch:
+            batches.put(list(batch.values()))
+
+        for _ in writers:
+            batches.put(None)
+        for writer in writers:
+            writer.join()
+
+        report.seconds = time.perf_counter() - started
+        print(f"Loaded {report.written}/{report.items} items in {report.seconds:.2f}s "
+              f"({report.items_per_second:.0f} items/s, {report.failed} failed)")
+        return report
+
+
+def migrate_legacy_products(table, loader: BulkLoader) -> LoadReport:
+    """
+    Moves the products still stored in the single PRODUCT partition to their
+    shard, one page at a time: the page is written under its new keys and its
+    old items are deleted once all of them went through. A run that stops
+    early leaves the rest in place, and running it again carries on.
+    """
+    report = LoadReport()
+    kwargs = {"KeyConditionExpression": Key("PK").eq(LEGACY_PRODUCT_PK)}
+    while True:
+        response = table.query(**kwargs)
+        items = response["Items"]
+        if items:
+            page = loader.load(product_item(item) for item in items)
+            for name in ("items", "written", "failed", "seconds", "requests", "throttled"):
+                setattr(report, name, getattr(report, name) + getattr(page, name))
+            if page.failed:
+                print(f"Stopped migrating products, {page.failed} could not be written")
+                return report
+            with table.batch_writer() as batch:
+                for item in items:
+                    batch.delete_item(Key={"PK": item["PK"], "SK": item["SK"]})
+        if "LastEvaluatedKey" not in response:
+            return report
+        kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
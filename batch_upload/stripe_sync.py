@@ -0,0 +1,345 @@
+"""
+Incremental, idempotent sync of the local product catalog into Stripe.
+
+Every Stripe product created by the sync has the catalog `productId` as its
+Stripe id and carries it, with a `syncHash` fingerprint of the synced fields,
+in its metadata. A run lists the existing products once, diffs them against
+the catalog and only creates or updates products whose fingerprint changed. Because the fingerprint is written
+together with each product, Stripe itself is the checkpoint: a run that stops
+at its deadline is resumed by the next invocation, which skips everything that
+already matches.
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import stripe
+
+SYNC_HASH_KEY = "syncHash"
+CURRENCY = "usd"
+
+# Maximum number of OR-ed clauses in a single Stripe search query.
+SEARCH_CLAUSE_LIMIT = 10
+# Products retrieved by id at the same time by find_products
+LOOKUP_CONCURRENCY = 8
+
+# Stripe calls made through with_backoff from any thread, for the handlers' metrics
+_call_counts = {"calls": 0, "rate_limited": 0}
+_call_counts_lock = threading.Lock()
+
+
+def _count_call(rate_limited: bool = False) -> None:
+    with _call_counts_lock:
+        _call_counts["calls"] += 1
+        _call_counts["rate_limited"] += rate_limited
+
+
+def take_call_counts() -> dict:
+    """Returns the Stripe calls and rate-limited calls since the last take, and resets them."""
+    with _call_counts_lock:
+        counts = dict(_call_counts)
+        _call_counts.update(calls=0, rate_limited=0)
+    return counts
+
+
+def catalog_fingerprint(product_data: dict) -> str:
+    """Hashes the catalog fields that are mirrored into Stripe."""
+    synced = {
+        "name": product_data["name"],
+        "description": product_data["description"],
+        "category": product_data["category"],
+        "createdDate": product_data["createdDate"],
+        "modifiedDate": product_data["modifiedDate"],
+        "tags": product_data["tags"],
+        "package": product_data["package"],
+        "pictures": product_data["pictures"],
+        "price": product_data["price"],
+    }
+    canonical = json.dumps(synced, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+
+def product_metadata(product_data: dict, fingerprint: str) -> dict:
+    return {
+        "category": product_data["category"],
+        "createdDate": product_data["createdDate"],
+        "modifiedDate": product_data["modifiedDate"],
+        "productId": product_data["productId"],
+        "tags": ", ".join(product_data["tags"]),
+        "package": json.dumps(product_data["package"]),
+        SYNC_HASH_KEY: fingerprint,
+    }
+
+
+def with_backoff(call: Callable, *args, max_attempts: int = 6, base_delay: float = 0.5,
+                 max_delay: float = 8.0, **kwargs):
+    """
+    Calls a Stripe API method, retrying rate limits and connection errors with
+    exponential backoff and full jitter.
+    """
+    for attempt in range(max_attempts):
+        rate_limited = False
+        try:
+            return call(*args, **kwargs)
+        except (stripe.error.RateLimitError, stripe.error.APIConnectionError) as e:
+            rate_limited = isinstance(e, stripe.error.RateLimitError)
+            if attempt == max_attempts - 1:
+                raise
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+        finally:
+            _count_call(rate_limited)
+
+
+@dataclass
+class SyncPlan:
+    creates: List[Tuple[dict, str]] = field(default_factory=list)
+    updates: List[Tuple[dict, str, object]] = field(default_factory=list)
+    # Stripe products whose catalog product was deleted
+    archives: List[object] = field(default_factory=list)
+    unchanged: int = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self.creates) + len(self.updates) + len(self.archives)
+
+
+def _list_active_products() -> Iterator[object]:
+    """
+    Pages through the active products with one backed-off request per page, so
+    a rate limit part way through the listing only repeats that page.
+    """
+    params = {"active": True, "limit": 100, "expand": ["data.default_price"]}
+    while True:
+        page = with_backoff(stripe.Product.list, **params)
+        yield from page.data
+        if not page.get("has_more") or not page.data:
+            return
+        params["starting_after"] = page.data[-1].id
+
+
+def list_existing_products() -> Dict[str, object]:
+    """
+    Returns the active Stripe products keyed by their catalog productId.
+    """
+    existing = {}
+    duplicates = 0
+    for product in _list_active_products():
+        product_id = (product.get("metadata") or {}).get("productId")
+        if not product_id:
+            continue
+        if product_id in existing:
+            duplicates += 1
+            # Keep the product the sync already manages when there are duplicates.
+            if existing[product_id].metadata.get(SYNC_HASH_KEY) or not product.metadata.get(SYNC_HASH_KEY):
+                continue
+        existing[product_id] = product
+    if duplicates:
+        print(f"Found {duplicates} duplicate Stripe products sharing a productId")
+    return existing
+
+
+def _retrieve_product(product_id: str) -> Optional[object]:
+    try:
+        return with_backoff(stripe.Product.retrieve, product_id, expand=["default_price"])
+    except stripe.error.InvalidRequestError as e:
+        if e.code == "resource_missing":
+            return None
+        raise
+
+
+def _search_products(product_ids: List[str]) -> Dict[str, object]:
+    existing = {}
+    for start in range(0, len(product_ids), SEARCH_CLAUSE_LIMIT):
+        chunk = product_ids[start:start + SEARCH_CLAUSE_LIMIT]
+        query = " OR ".join(f"metadata['productId']:'{product_id}'" for product_id in chunk)
+        result = with_backoff(stripe.Product.search, query=query, limit=100, expand=["data.default_price"])
+        for product in result.data:
+            product_id = (product.get("metadata") or {}).get("productId")
+            if product_id not in chunk or not product.get("active", True):
+                continue
+            if product_id not in existing or product.metadata.get(SYNC_HASH_KEY):
+                existing[product_id] = product
+    return existing
+
+
+def find_products(product_ids: List[str]) -> Dict[str, object]:
+    """
+    Returns the Stripe products of just these catalog productIds, keyed by
+    productId, instead of listing the whole catalog.
+
+    Products are retrieved by their Stripe id, which is read-after-write
+    consistent, so a product created a moment ago is found and not created
+    twice. Retrieved products may be archived; plan_sync reactivates them.
+    Only the ids Stripe does not know, products created with a generated id
+    before the sync set it, fall back to one search per SEARCH_CLAUSE_LIMIT
+    ids. Search lags writes by up to a minute, which those older products are
+    well past.
+    """
+    with ThreadPoolExecutor(max_workers=LOOKUP_CONCURRENCY) as executor:
+        retrieved = dict(zip(product_ids, executor.map(_retrieve_product, product_ids)))
+    existing = {product_id: product for product_id, product in retrieved.items() if product is not None}
+    missing = [product_id for product_id in product_ids if product_id not in existing]
+    if missing:
+        existing.update(_search_products(missing))
+    return existing
+
+
+def plan_sync(catalog: List[dict], existing: Dict[str, object]) -> SyncPlan:
+    plan = SyncPlan()
+    for product_data in catalog:
+        fingerprint = catalog_fingerprint(product_data)
+        product = existing.get(product_data["productId"])
+        if product is None:
+            plan.creates.append((product_data, fingerprint))
+        elif product.metadata.get(SYNC_HASH_KEY) != fingerprint or not product.get("active", True):
+            plan.updates.append((product_data, fingerprint, product))
+        else:
+            plan.unchanged += 1
+    return plan
+
+
+def create_product(product_data: dict, fingerprint: str) -> None:
+    # The product and its price are created in a single call. The product id is
+    # the catalog productId, so the same product cannot be created twice, and
+    # Stripe rejects a second create whatever the fingerprint.
+    try:
+        product = with_backoff(
+            stripe.Product.create,
+            id=product_data["productId"],
+            name=product_data["name"],
+            description=product_data["description"],
+            metadata=product_metadata(product_data, fingerprint),
+            images=product_data["pictures"],
+            default_price_data={
+                "unit_amount": product_data["price"],  # Price in cents
+                "currency": CURRENCY,
+            },
+        )
+    except stripe.error.InvalidRequestError as e:
+        if e.code != "resource_already_exists":
+            raise
+        # A retried create, or an archived product, which the listing of active
+        # products leaves out
+        update_product(product_data, fingerprint, _retrieve_product(product_data["productId"]))
+        return
+    print(f"Product created: {product.name} (ID: {product.id})")
+
+
+def _current_price(product) -> Optional[object]:
+    price = product.get("default_price")
+    if price and not isinstance(price, str):
+        return price
+    if price:
+        return with_backoff(stripe.Price.retrieve, price)
+    # Products created before the sync existed have no default price.
+    prices = with_backoff(stripe.Price.list, product=product.id, active=True, limit=1)
+    return prices.data[0] if prices.data else None
+
+
+def update_product(product_data: dict, fingerprint: str, product) -> None:
+    # Keyed on the state the product was read in as well, so reactivating an
+    # archived product is not answered with the response of an earlier update
+    key = f"{product_data['productId']}-{fingerprint}-{product.get('updated')}"
+    changes = {
+        "name": product_data["name"],
+        "description": product_data["description"],
+        "metadata": product_metadata(product_data, fingerprint),
+        "images": product_data["pictures"],
+        "active": True,
+    }
+
+    # Stripe prices are immutable: a new amount means a new price, and the old
+    # one is archived once the product points at the replacement.
+    old_price = _current_price(product)
+    if old_price is None or old_price.unit_amount != product_data["price"]:
+        new_price = with_backoff(
+            stripe.Price.create,
+            unit_amount=product_data["price"],
+            currency=CURRENCY,
+            product=product.id,
+            idempotency_key=f"price-create-{key}",
+        )
+        changes["default_price"] = new_price.id
+    elif product.get("default_price") is None:
+        changes["default_price"] = old_price.id
+
+    with_backoff(stripe.Product.modify, product.id, idempotency_key=f"product-update-{key}", **changes)
+    if "default_price" in changes and old_price is not None and old_price.id != changes["default_price"]:
+        with_backoff(stripe.Price.modify, old_price.id, active=False)
+    print(f"Product updated: {product_data['name']} (ID: {product.id})")
+
+
+def archive_product(product) -> None:
+    """Archives a product that left the catalog together with its current price."""
+    price = product.get("default_price")
+    with_backoff(stripe.Product.modify, product.id, active=False)
+    if price:
+        with_backoff(stripe.Price.modify, price if isinstance(price, str) else price.id, active=False)
+    print(f"Product archived: {product.name} (ID: {product.id})")
+
+
+class StripeCatalogSync:
+    """
+    Applies a SyncPlan through a bounded pool of Stripe workers.
+
+    `remaining_time_ms` is usually `context.get_remaining_time_in_millis`; no
+    new product is started once less than `safety_margin_ms` is left, and the
+    products that were not reached are reported as remaining.
+    """
+
+    def __init__(self, max_workers: int = 8, remaining_time_ms: Optional[Callable[[], int]] = None,
+                 safety_margin_ms: int = 5000):
+        self.max_workers = max_workers
+        self.remaining_time_ms = remaining_time_ms
+        self.safety_margin_ms = safety_margin_ms
+
+    def _out_of_time(self) -> bool:
+        return self.remaining_time_ms is not None and self.remaining_time_ms() < self.safety_margin_ms
+
+    def _run_task(self, task: Callable, *args) -> str:
+        if self._out_of_time():
+            return "remaining"
+        try:
+            task(*args)
+            return "done"
+        except stripe.error.StripeError as e:
+            print(f"Error syncing product {args[0]['name']}: {e.user_message}")
+            return "failed"
+
+    def apply(self, plan: SyncPlan) -> Dict[str, str]:
+        """
+        Runs the creates, updates and archives of a plan and returns the outcome
+        of each, "done", "failed" or "remaining", keyed by productId.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {args[0]["productId"]: executor.submit(self._run_task, create_product, *args)
+                       for args in plan.creates}
+            futures.update({args[0]["productId"]: executor.submit(self._run_task, update_product, *args)
+                            for args in plan.updates})
+            futures.update({product.metadata["productId"]: executor.submit(self._run_task, archive_product, product)
+                            for product in plan.archives})
+            return {product_id: future.result() for product_id, future in futures.items()}
+
+    def run(self, catalog: List[dict]) -> dict:
+        plan = plan_sync(catalog, list_existing_products())
+        print(f"Sync plan: {len(plan.creates)} to create, {len(plan.updates)} to update, "
+              f"{plan.unchanged} unchanged")
+
+        outcomes = self.apply(plan)
+        create_results = [outcomes[product_data["productId"]] for product_data, _ in plan.creates]
+        update_results = [outcomes[product_data["productId"]] for product_data, _, _ in plan.updates]
+
+        results = create_results + update_results
+        return {
+            "created": create_results.count("done"),
+            "updated": update_results.count("done"),
+            "unchanged": plan.unchanged,
+            "failed": results.count("failed"),
+            "remaining": results.count("remaining"),
+            "complete": plan.pending == create_results.count("done") + update_results.count("done"),
+        }
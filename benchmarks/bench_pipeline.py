@@ -0,0 +1,427 @@
+"""
+End-to-end benchmark of the grocery pipeline against in-process fakes.
+
+The real handlers run in this process with every AWS and Stripe client swapped
+for the fakes in tests/unit/pipeline_fakes.py, in the order data flows through
+the deployed stack:
+
+    stripe_sync          batch_upload/create_stripe_products.handler
+    product_load         batch_upload/batch_upload_products.handler
+    catalog_stream       batch_upload/catalog_stream.handler, for price changes to a few products
+    trigger              lambda/trigger_step_functions_wrokflow.handler
+    textract_completion  lambda/trigger_step_functions_wrokflow.textract_completion_handler
+    poller               lambda/lambda_sqs_poller.handler
+    agent <route>        lambda/app.lambda_handler for each action group route
+
+For each stage it reports p50/p99 latency per invocation, throughput in units
+(products, records or requests) per second, failed units and the API calls
+made per service operation. Latency and throttling are set per service:
+
+    python benchmarks/bench_pipeline.py --uploads 200 \\
+        --latency textract=120 --latency bedrock=900 --throttle dynamodb=0.05
+"""
+import argparse
+import builtins
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, "lambda"), os.path.join(ROOT, "batch_upload")):
+    if path not in sys.path:
+        sys.path.append(path)
+
+BUCKET = "grocery-list"
+SERVICES = ("dynamodb", "sqs", "s3", "textract", "bedrock", "stripe")
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+os.environ.setdefault("ECOMMERCE_TABLE_NAME", "GroceryAppTable")
+os.environ.setdefault("SQS_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/123456789012/GroceryList")
+os.environ.setdefault("TEXTRACT_SNS_TOPIC_ARN", "arn:aws:sns:us-east-1:123456789012:TextractCompletion")
+os.environ.setdefault("TEXTRACT_ROLE_ARN", "arn:aws:iam::123456789012:role/TextractPublish")
+os.environ.setdefault("POWERTOOLS_TRACE_DISABLED", "true")
+os.environ.setdefault("POWERTOOLS_METRICS_NAMESPACE", "GroceryApp")
+os.environ.setdefault("POWERTOOLS_LOG_LEVEL", "CRITICAL")
+
+from pipeline_metrics import captured_metrics  # noqa: E402
+from tests.unit.pipeline_fakes import (CallStats, FakeBedrock, FakeContext, FakeDynamoDB, FakeS3,  # noqa: E402
+                                       FakeSQS, FakeStripe, FakeTextract, Faults, agent_event,
+                                       load_agent_app, stream_event)
+
+
+@dataclass
+class StageReport:
+    stage: str
+    invocations: int = 0
+    units: int = 0
+    failed: int = 0
+    timings_ms: List[float] = field(default_factory=list)
+    seconds: float = 0.0
+    calls: Dict[str, int] = field(default_factory=dict)
+    throttled: Dict[str, int] = field(default_factory=dict)
+    metrics: Dict[str, float] = field(default_factory=dict)
+
+    def percentile(self, q):
+        timings = sorted(self.timings_ms)
+        return timings[min(len(timings) - 1, int(len(timings) * q))] if timings else 0.0
+
+    @property
+    def throughput(self):
+        return self.units / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        return {
+            "stage": self.stage, "invocations": self.invocations, "units": self.units, "failed": self.failed,
+            "p50_ms": round(self.percentile(0.5), 3), "p99_ms": round(self.percentile(0.99), 3),
+            "units_per_second": round(self.throughput, 1), "calls": self.calls, "throttled": self.throttled,
+            "metrics": self.metrics,
+        }
+
+
+@dataclass
+class Fakes:
+    stats: CallStats
+    dynamodb: FakeDynamoDB
+    sqs: FakeSQS
+    s3: FakeS3
+    textract: FakeTextract
+    bedrock: FakeBedrock
+    stripe: FakeStripe
+
+    @classmethod
+    def create(cls, faults: Dict[str, Faults], seed=0, bedrock_ms_per_token=0.0):
+        stats = CallStats()
+        s3 = FakeS3(stats, faults.get("s3"), seed)
+        return cls(
+            stats=stats,
+            dynamodb=FakeDynamoDB(stats, faults.get("dynamodb"), seed),
+            sqs=FakeSQS(stats, faults.get("sqs"), seed),
+            s3=s3,
+            textract=FakeTextract(stats, s3, faults.get("textract"), seed),
+            bedrock=FakeBedrock(stats, faults.get("bedrock"), seed, ms_per_output_token=bedrock_ms_per_token),
+            stripe=FakeStripe(stats, faults.get("stripe"), seed),
+        )
+
+
+@contextmanager
+def quiet(modules):
+    """Silences the handlers' print calls; Powertools logging is set to CRITICAL above."""
+    for module in modules:
+        module.print = lambda *args, **kwargs: None
+    try:
+        yield
+    finally:
+        for module in modules:
+            module.print = builtins.print
+
+
+@contextmanager
+def working_directory(path):
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def make_catalog(size, seed=0):
+    """`size` products cloned from batch_upload/product_list.json with unique ids and names."""
+    with open(os.path.join(ROOT, "batch_upload", "product_list.json")) as f:
+        base = json.load(f)
+    rng = random.Random(seed)
+    catalog = []
+    for n in range(size):
+        product = dict(base[n % len(base)])
+        product["productId"] = str(uuid.UUID(int=rng.getrandbits(128)))
+        if n >= len(base):
+            product["name"] = f"{product['name']} {chr(ord('A') + (n // len(base)) % 26)}{n // len(base)}"
+        catalog.append(product)
+    return catalog
+
+
+def make_upload(catalog, rng, lines=(5, 25)):
+    """A photographed shopping list: item lines with quantities plus some receipt noise."""
+    items = [f"{rng.choice(['', '2kg ', '1 ', '3 ', '0.5kg ', '12 '])}{rng.choice(catalog)['name'].lower()}"
+             for _ in range(rng.randint(*lines))]
+    noise = ["SUBTOTAL 23.40", "VISA **** 1234", "14/03/2024 18:22", "Thank you for shopping!"]
+    return "\n".join(items + rng.sample(noise, 2)) + "\n"
+
+
+class Pipeline:
+
+    def __init__(self, fakes: Fakes, args):
+        self.fakes = fakes
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.catalog = make_catalog(args.products, args.seed)
+        self.reports: List[StageReport] = []
+        self._wire()
+
+    def _patch(self, target, name, value):
+        self._patches.append((target, name, getattr(target, name)))
+        setattr(target, name, value)
+
+    def _wire(self):
+        """Points every handler module at the fakes; `_unwire` puts the originals back."""
+        import batch_upload_products
+        import catalog_stream
+        import dynamodb_loader
+        import lambda_sqs_poller
+        import result_cache
+        import stripe_sync
+        import trigger_step_functions_wrokflow as trigger
+        from catalog_changes import CatalogChangeFeed
+        from catalog_index import CatalogIndex
+        from catalog_matcher import CatalogMatcher
+        from dynamodb_loader import BulkLoader
+        from stripe_guard import SharedLookup
+
+        # The Stripe sync reads product_list.json from the working directory at import
+        with working_directory(os.path.join(ROOT, "batch_upload")):
+            import create_stripe_products
+
+        app = load_agent_app()
+        self._patches = []
+        table = self.fakes.dynamodb.table()
+        table_name = os.environ["ECOMMERCE_TABLE_NAME"]
+
+        self._patch(trigger, "textract", self.fakes.textract)
+        self._patch(trigger, "sqs_client", self.fakes.sqs)
+        self._patch(trigger, "s3_client", self.fakes.s3)
+        self._patch(result_cache.result_cache, "_table", table)
+        self._patch(lambda_sqs_poller, "bedrock_client", self.fakes.bedrock)
+        self._patch(lambda_sqs_poller, "orders_table", table)
+        self._patch(lambda_sqs_poller, "EXTRACTION_STREAMING", self.args.streaming)
+
+        # The agent starts from a cold container: empty catalog index and matcher
+        app.stripe_api()
+        change_feed = CatalogChangeFeed(table=table)
+        catalog_index = CatalogIndex(shared=SharedLookup(table=table), changed_since=change_feed.changed_since)
+        matcher = CatalogMatcher(table=table)
+        agent_loader = BulkLoader(table_name, client=self.fakes.dynamodb, workers=4)
+        self._patch(app, "stripe_catalog", lambda: catalog_index)
+        self._patch(app, "product_matcher", lru_cache(maxsize=None)(lambda: matcher))
+        self._patch(app, "product_loader", lambda: agent_loader)
+        self._patch(app, "catalog_changes", lambda: change_feed)
+        self._patch(catalog_stream, "table", table)
+
+        catalog_file = tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False)
+        with catalog_file:
+            catalog_file.writelines(json.dumps(product) + "\n" for product in self.catalog)
+        self.catalog_path = catalog_file.name
+        self._patch(batch_upload_products, "product_source", self.catalog_path)
+        self._patch(batch_upload_products, "table", table)
+        self._patch(batch_upload_products, "loader", BulkLoader(table_name, client=self.fakes.dynamodb,
+                                                                workers=batch_upload_products.loader_workers))
+        self._patch(create_stripe_products, "product_list", self.catalog)
+
+        self.app, self.trigger, self.poller = app, trigger, lambda_sqs_poller
+        self.batch_upload_products, self.create_stripe_products = batch_upload_products, create_stripe_products
+        self.catalog_stream = catalog_stream
+        self.quiet_modules = [trigger, result_cache, dynamodb_loader, stripe_sync, create_stripe_products,
+                              batch_upload_products, catalog_stream]
+
+    def _unwire(self):
+        for target, name, original in reversed(self._patches):
+            setattr(target, name, original)
+        os.unlink(self.catalog_path)
+
+    def stage(self, name: str, events: Iterable, invoke: Callable, units: Callable, failed: Callable):
+        """Runs `invoke` once per event and records one StageReport."""
+        report = StageReport(name)
+        calls_before, throttled_before = self.fakes.stats.snapshot()
+        started = time.perf_counter()
+        # The handlers' EMF output is kept off stdout and summed into the report
+        with captured_metrics() as captured:
+            for event in events:
+                invocation_started = time.perf_counter()
+                try:
+                    response = invoke(event)
+                    report.failed += failed(event, response)
+                except Exception as e:
+                    # Handlers that fail an invocation for some records list them
+                    report.failed += len(getattr(e, "failures", None) or ()) or units(event)
+                report.timings_ms.append((time.perf_counter() - invocation_started) * 1000)
+                report.invocations += 1
+                report.units += units(event)
+        report.seconds = time.perf_counter() - started
+        report.metrics = captured.counts()
+        calls_after, throttled_after = self.fakes.stats.snapshot()
+        report.calls = dict(sorted((calls_after - calls_before).items()))
+        report.throttled = dict(sorted((throttled_after - throttled_before).items()))
+        self.reports.append(report)
+        return report
+
+    def run(self, stages):
+        context = FakeContext()
+        try:
+            with self.fakes.stripe.install(), quiet(self.quiet_modules):
+                self._run_stages(stages, context)
+        finally:
+            self._unwire()
+        return self.reports
+
+    def _run_stages(self, stages, context):
+        products = len(self.catalog)
+        if "stripe_sync" in stages:
+            # The first run creates the catalog in Stripe, later runs find nothing to change
+            self.stage("stripe_sync", range(self.args.sync_runs),
+                       lambda _: json.loads(self.create_stripe_products.handler({}, context)),
+                       units=lambda _: products, failed=lambda _, summary: summary["failed"])
+
+        if "product_load" in stages:
+            self.stage("product_load", [None], lambda _: self.batch_upload_products.handler({}, context),
+                       units=lambda _: products, failed=lambda _, ok: 0 if ok else products)
+
+        if "catalog_stream" in stages:
+            # Price changes to a few products reach Stripe through the table stream
+            changed = [dict(product, price=product["price"] + 1)
+                       for product in self.rng.sample(self.catalog, min(self.args.stream_changes, products))]
+            events = [stream_event(changed[start:start + 10]) for start in range(0, len(changed), 10)]
+            self.stage("catalog_stream", events, lambda event: self.catalog_stream.handler(event, context),
+                       units=lambda event: len(event["Records"]),
+                       failed=lambda _, response: len(response["batchItemFailures"]))
+
+        if "trigger" in stages:
+            keys = []
+            for n in range(self.args.uploads):
+                extension = "pdf" if self.rng.random() < self.args.pdf_share else "jpg"
+                key = f"user-{n % 7}/list-{n}.{extension}"
+                self.fakes.s3.put_object(Bucket=BUCKET, Key=key, Body=make_upload(self.catalog, self.rng))
+                keys.append(key)
+            size = self.args.records_per_event
+            events = [self.fakes.s3.notification(BUCKET, keys[start:start + size])
+                      for start in range(0, len(keys), size)]
+            self.stage("trigger", events, lambda event: self.trigger.handler(event, context),
+                       units=lambda event: len(event["Records"]),
+                       failed=lambda _, response: 0)
+
+            self.stage("textract_completion", list(self.fakes.textract.completions()),
+                       lambda event: self.trigger.textract_completion_handler(event, context),
+                       units=lambda event: len(event["Records"]),
+                       failed=lambda _, response: 0)
+
+        if "poller" in stages:
+            self.stage("poller", list(self.fakes.sqs.drain()), lambda event: self.poller.handler(event, context),
+                       units=lambda event: len(event["Records"]),
+                       failed=lambda _, response: len(response["batchItemFailures"]))
+
+        if "agent" in stages:
+            self.run_agent(context)
+
+    def run_agent(self, context):
+        requests = self.args.agent_requests
+        names = [product["name"] for product in self.catalog]
+
+        def invoke(event):
+            return self.app.lambda_handler(event, context)
+
+        def failed(_, response):
+            response = response["response"]
+            if response["httpStatusCode"] != 200:
+                return 1
+            body = response["responseBody"]["application/json"]["body"]
+            if body.startswith("{"):
+                result = json.loads(body)
+                return 1 if result.get("invalid") or result.get("failed") else 0
+            return 0
+
+        def products_request():
+            # Product expects ISO 8601 dates, product_list.json has a space before the offset
+            products = [dict(product) for product in self.rng.sample(self.catalog, min(25, len(self.catalog)))]
+            for product in products:
+                for name in ("createdDate", "modifiedDate"):
+                    product[name] = product[name].replace(" ", "")
+            return json.dumps(products)
+
+        routes = {
+            "/current_time": lambda: agent_event("/current_time", "GET"),
+            "/match_items": lambda: agent_event("/match_items", "POST", parameters={"top_k": "3"}, body={
+                "items": [f"2kg {self.rng.choice(names).lower()}" for _ in range(10)]}),
+            "/payment_link": lambda: agent_event("/payment_link", "GET", parameters={
+                "product_name": self.rng.choice(names), "qty": str(self.rng.randint(1, 5))}),
+            "/order_payment_link": lambda: agent_event("/order_payment_link", "POST", body={"line_items": [
+                {"product_name": self.rng.choice(names), "qty": self.rng.randint(1, 5)} for _ in range(5)]}),
+            # Agents send the list parameter as one JSON string
+            "/populate_db": lambda: agent_event("/populate_db", "POST", parameters={
+                "list_items": products_request()}),
+        }
+        for path, make_event in routes.items():
+            self.stage(f"agent {path}", [make_event() for _ in range(requests)], invoke,
+                       units=lambda _: 1, failed=failed)
+
+
+def print_reports(reports: List[StageReport]):
+    print(f"{'stage':<26}{'calls':>6}{'units':>7}{'failed':>7}{'p50 ms':>10}{'p99 ms':>10}{'units/s':>11}")
+    for report in reports:
+        print(f"{report.stage:<26}{report.invocations:>6}{report.units:>7}{report.failed:>7}"
+              f"{report.percentile(0.5):>10.2f}{report.percentile(0.99):>10.2f}{report.throughput:>11.1f}")
+        calls = ", ".join(f"{name}={count}" for name, count in report.calls.items())
+        throttled = ", ".join(f"{name}={count}" for name, count in report.throttled.items())
+        print(f"{'':<4}api: {calls or '-'}" + (f"\n{'':<4}throttled: {throttled}" if throttled else ""))
+        if report.metrics:
+            print(f"{'':<4}metrics: " + ", ".join(f"{name}={value:g}" for name, value in report.metrics.items()))
+
+
+def service_settings(values: List[str], convert):
+    settings = {}
+    for value in values or ():
+        service, _, setting = value.partition("=")
+        if service not in SERVICES:
+            raise argparse.ArgumentTypeError(f"Unknown service {service!r}, expected one of {', '.join(SERVICES)}")
+        settings[service] = convert(setting)
+    return settings
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--products", type=int, default=200, help="Catalog size")
+    parser.add_argument("--uploads", type=int, default=100, help="Grocery list uploads")
+    parser.add_argument("--records-per-event", type=int, default=5, help="S3 records per trigger invocation")
+    parser.add_argument("--pdf-share", type=float, default=0.2, help="Share of uploads that are PDFs")
+    parser.add_argument("--sync-runs", type=int, default=2, help="Stripe sync invocations")
+    parser.add_argument("--stream-changes", type=int, default=20, help="Products changed through the table stream")
+    parser.add_argument("--agent-requests", type=int, default=50, help="Requests per agent route")
+    parser.add_argument("--latency", action="append", metavar="SERVICE=MS",
+                        help=f"Latency per call, repeatable; services: {', '.join(SERVICES)}")
+    parser.add_argument("--jitter", action="append", metavar="SERVICE=MS", help="Extra random latency up to MS")
+    parser.add_argument("--throttle", action="append", metavar="SERVICE=RATE", help="Share of calls throttled")
+    parser.add_argument("--bedrock-ms-per-token", type=float, default=0.0, help="Generation time per output token")
+    parser.add_argument("--streaming", action="store_true", help="Extract with InvokeModelWithResponseStream")
+    parser.add_argument("--stages", default="stripe_sync,product_load,catalog_stream,trigger,poller,agent",
+                        help="Comma-separated stages to run")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print the reports as JSON")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    latency = service_settings(args.latency, float)
+    jitter = service_settings(args.jitter, float)
+    throttle = service_settings(args.throttle, float)
+    faults = {service: Faults(latency.get(service, 0.0), jitter.get(service, 0.0), throttle.get(service, 0.0))
+              for service in SERVICES}
+
+    fakes = Fakes.create(faults, args.seed, args.bedrock_ms_per_token)
+    reports = Pipeline(fakes, args).run(set(args.stages.split(",")))
+    if args.json:
+        print(json.dumps([report.as_dict() for report in reports], indent=2))
+    else:
+        print_reports(reports)
+    return reports
+
+
+if __name__ == "__main__":
+    main()
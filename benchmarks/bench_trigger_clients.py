@@ -0,0 +1,114 @@
+"""
+Micro-benchmark of the per-invocation overhead of the S3 trigger handler for a
+burst of S3 events.
+
+"per-invocation" builds new Textract and SQS clients on every invocation, as the
+handler used to; "module-scope" reuses the clients created at import time. AWS
+calls are answered by botocore Stubbers, so the numbers cover client
+construction and request handling only. Against the real services the
+module-scope clients also keep their pooled connections, which saves a TLS
+handshake per client on every warm invocation.
+
+    python benchmarks/bench_trigger_clients.py --events 200
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, "lambda"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+os.environ.setdefault("SQS_QUEUE_URL", "https://sqs.us-east-1.amazonaws.com/123456789012/GroceryList")
+os.environ.setdefault("ECOMMERCE_TABLE_NAME", "GroceryAppTable")
+os.environ.setdefault("POWERTOOLS_TRACE_DISABLED", "true")
+os.environ.setdefault("POWERTOOLS_METRICS_NAMESPACE", "GroceryApp")
+
+import boto3  # noqa: E402
+from botocore.stub import Stubber  # noqa: E402
+
+import result_cache  # noqa: E402
+from pipeline_metrics import captured_metrics  # noqa: E402
+import trigger_step_functions_wrokflow as trigger  # noqa: E402
+
+
+class NullTable:
+    """Result cache table that always misses, so every event reaches Textract."""
+
+    def get_item(self, **kwargs):
+        return {}
+
+    def put_item(self, **kwargs):
+        pass
+
+    def update_item(self, **kwargs):
+        pass
+
+
+def s3_event(n):
+    return {"Records": [{
+        "s3": {"bucket": {"name": "grocery-list"}, "object": {"key": f"user-1/list-{n}.jpg", "eTag": f"etag-{n}"}},
+    }]}
+
+
+def stub(textract, sqs_client, invocations):
+    textract_stubber, sqs_stubber = Stubber(textract), Stubber(sqs_client)
+    for _ in range(invocations):
+        textract_stubber.add_response("detect_document_text", {
+            "Blocks": [{"BlockType": "LINE", "Text": "2kg lemons"}, {"BlockType": "LINE", "Text": "12 eggs"}],
+        })
+        sqs_stubber.add_response("send_message_batch", {
+            "Successful": [{"Id": "0", "MessageId": "1", "MD5OfMessageBody": "x"}], "Failed": [],
+        })
+    textract_stubber.activate()
+    sqs_stubber.activate()
+
+
+def per_invocation(event):
+    # What the handler used to do before every batch of records
+    trigger.textract = boto3.client("textract", region_name="us-east-1")
+    trigger.sqs_client = boto3.client("sqs")
+    stub(trigger.textract, trigger.sqs_client, 1)
+    trigger.handler(event, None)
+
+
+def module_scope(event):
+    trigger.handler(event, None)
+
+
+def run(mode, invoke, events):
+    timings = []
+    # The handler's EMF output is kept off stdout
+    with captured_metrics():
+        for n in range(events):
+            started = time.perf_counter()
+            invoke(s3_event(n))
+            timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f"{mode:>15}: mean {statistics.mean(timings):7.3f} ms  p50 {timings[len(timings) // 2]:7.3f} ms  "
+          f"p99 {timings[int(len(timings) * 0.99) - 1]:7.3f} ms  total {sum(timings):8.1f} ms")
+    return statistics.mean(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=200, help="S3 events in the burst")
+    args = parser.parse_args()
+
+    result_cache.result_cache._table = NullTable()
+    # The handler prints every event; keep the benchmark output readable
+    trigger.print = result_cache.print = lambda *args, **kwargs: None
+
+    before = run("per-invocation", per_invocation, args.events)
+    trigger.textract = boto3.client("textract", region_name="us-east-1", config=trigger.client_config)
+    trigger.sqs_client = boto3.client("sqs", config=trigger.client_config)
+    stub(trigger.textract, trigger.sqs_client, args.events)
+    after = run("module-scope", module_scope, args.events)
+    print(f"Overhead saved per invocation: {before - after:.3f} ms ({before / after:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,7 +4,9 @@ from aws_cdk import (
 )
 
 from aws_cdk import (aws_lambda, aws_s3, aws_s3_notifications, aws_iam as iam,aws_lambda_event_sources as lambda_event_sources,
-                     aws_appsync as appsync, aws_sqs as sqs, aws_dynamodb as dynamodb )
+                     aws_lambda_destinations as lambda_destinations,
+                     aws_appsync as appsync, aws_sqs as sqs, aws_dynamodb as dynamodb, aws_sns as sns,
+                     aws_sns_subscriptions as sns_subscriptions )
 from aws_cdk.aws_appsync import SchemaFile
 
 from aws_cdk.aws_lambda import DockerImageCode
@@ -18,15 +20,23 @@ from cdklabs.generative_ai_cdk_constructs.bedrock import (
 )
 from constructs import Construct
 
+from batch_upload.catalog_snapshot import write_snapshot
+
+# Compiled from the product list at synth time and copied into the agent image
+# (see lambda/Dockerfile)
+CATALOG_SNAPSHOT_PATH = "build/catalog.snapshot"
+
 
 class CoffeeOrderStack(Stack):
 
     def __init__(self, scope: Construct, construct_id: str, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
+        # The zip asset functions import Powertools (metrics, logging) and
+        # pydantic v2 from this layer, which has to match their PYTHON_3_11 runtime
         powertools_layer = aws_lambda.LayerVersion.from_layer_version_arn(
             self,
             id="lambda-powertools",
-            layer_version_arn=f"arn:aws:lambda:{Aws.REGION}:017000801446:layer:AWSLambdaPowertoolsPythonV3-python312-x86_64:5",
+            layer_version_arn=f"arn:aws:lambda:{Aws.REGION}:017000801446:layer:AWSLambdaPowertoolsPythonV3-python311-x86_64:5",
         )
 
         # Define the DynamoDB table
@@ -43,7 +53,8 @@ class CoffeeOrderStack(Stack):
             ),
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
             stream=dynamodb.StreamViewType.NEW_IMAGE,
-
+            # Expires cached Textract and Bedrock results (see lambda/result_cache.py)
+            time_to_live_attribute="expiresAt",
         )
 
 
@@ -74,7 +85,8 @@ class CoffeeOrderStack(Stack):
             timeout=Duration.seconds(30),
             memory_size=2048,
             handler="batch_upload_products.handler",
-            code=aws_lambda.Code.from_asset("batch_upload")
+            code=aws_lambda.Code.from_asset("batch_upload"),
+            layers=[powertools_layer],
         )
         # Lambda Function for Resolver
         create_stripe_products_lambda_function = aws_lambda.Function(
@@ -83,11 +95,13 @@ class CoffeeOrderStack(Stack):
             timeout=Duration.seconds(30),
             memory_size=2048,
             handler="create_stripe_products.handler",
-            code=aws_lambda.Code.from_asset("batch_upload")
+            code=aws_lambda.Code.from_asset("batch_upload"),
+            layers=[powertools_layer],
         )
 
-        # Grant Lambda access to DynamoDB
-        ecommerce_table.grant_write_data(lambda_function)
+        # Grant Lambda access to DynamoDB. It reads the products it migrates
+        # to the sharded layout (see batch_upload/catalog_keys.py)
+        ecommerce_table.grant_read_write_data(lambda_function)
         lambda_function.add_environment("ECOMMERCE_TABLE_NAME", ecommerce_table.table_name)
         # Add Lambda as a DataSource for AppSync
         lambda_ds = api.add_lambda_data_source("LambdaDataSource", lambda_function)
@@ -114,6 +128,82 @@ class CoffeeOrderStack(Stack):
 
 
 
+        # Catalog reads are resolved directly against DynamoDB, with no Lambda in
+        # the read path. Per-resolver caching is opt-in through the
+        # productCacheTtlSeconds context value (0 disables it)
+        product_cache_ttl = int(self.node.try_get_context("productCacheTtlSeconds") or 0)
+        api_cache = None
+        if product_cache_ttl > 0:
+            api_cache = appsync.CfnApiCache(
+                self, "GroceryAgentApiCache",
+                api_id=api.api_id,
+                api_caching_behavior="PER_RESOLVER_CACHING",
+                type=self.node.try_get_context("productCacheInstanceType") or "SMALL",
+                ttl=product_cache_ttl,
+            )
+
+        product_table_ds = appsync.DynamoDbDataSource(
+            self, "ProductTableDataSource",
+            api=api,
+            table=ecommerce_table,
+            read_only_access=True,
+        )
+
+        product_resolvers = {
+            "getProduct": ["$context.arguments.id"],
+            "listProducts": ["$context.arguments.category", "$context.arguments.limit",
+                             "$context.arguments.nextToken"],
+        }
+        for field_name, caching_keys in product_resolvers.items():
+            resolver = product_table_ds.create_resolver(
+                id=f"{field_name}Resolver",
+                type_name="Query",
+                field_name=field_name,
+                request_mapping_template=appsync.MappingTemplate.from_file(
+                    f"graphql/resolvers/{field_name}.request.vtl"),
+                response_mapping_template=appsync.MappingTemplate.from_file(
+                    f"graphql/resolvers/{field_name}.response.vtl"),
+                caching_config=appsync.CachingConfig(
+                    ttl=Duration.seconds(product_cache_ttl),
+                    caching_keys=caching_keys,
+                ) if api_cache else None,
+            )
+            if api_cache:
+                resolver.node.add_dependency(api_cache)
+
+        # Product writes reach Stripe and the agent's catalog indexes through
+        # the table stream, only for the products that changed (see
+        # batch_upload/catalog_stream.py). Other items in the table never
+        # invoke the function
+        catalog_stream_function = aws_lambda.Function(
+            self, "CatalogStreamLambda",
+            runtime=aws_lambda.Runtime.PYTHON_3_11,
+            timeout=Duration.seconds(60),
+            memory_size=512,
+            handler="catalog_stream.handler",
+            code=aws_lambda.Code.from_asset("batch_upload"),
+            layers=[powertools_layer],
+        )
+        catalog_stream_function.add_event_source(lambda_event_sources.DynamoEventSource(
+            ecommerce_table,
+            starting_position=aws_lambda.StartingPosition.TRIM_HORIZON,
+            batch_size=100,
+            max_batching_window=Duration.seconds(5),
+            retry_attempts=10,
+            report_batch_item_failures=True,
+            filters=[aws_lambda.FilterCriteria.filter({
+                "dynamodb": {"Keys": {"PK": {"S": aws_lambda.FilterRule.begins_with("PRODUCT#")}}}})],
+        ))
+        # The function writes the catalog change feed the agent polls
+        ecommerce_table.grant_write_data(catalog_stream_function)
+        catalog_stream_function.add_environment("ECOMMERCE_TABLE_NAME", ecommerce_table.table_name)
+        if api_cache:
+            catalog_stream_function.add_environment("APPSYNC_API_ID", api.api_id)
+            catalog_stream_function.add_to_role_policy(iam.PolicyStatement(
+                actions=["appsync:FlushApiCache"],
+                resources=[api.arn]
+            ))
+
         # Add Global Secondary Indexes (GSIs)
         ecommerce_table.add_global_secondary_index(
             index_name="userOrders",
@@ -141,21 +231,38 @@ class CoffeeOrderStack(Stack):
             projection_type=dynamodb.ProjectionType.ALL
         )
 
+        # Products by category in price order, for listProducts (see
+        # batch_upload/catalog_keys.py)
+        ecommerce_table.add_global_secondary_index(
+            index_name="productsByCategory",
+            partition_key=dynamodb.Attribute(
+                name="GSI3PK",
+                type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="GSI3SK",
+                type=dynamodb.AttributeType.NUMBER
+            ),
+            projection_type=dynamodb.ProjectionType.ALL
+        )
+
         # Step 2: Create a Lambda function
         grocery_function = aws_lambda.Function(self, "TriggerStepFunctionsWorkflow",
                                                runtime=aws_lambda.Runtime.PYTHON_3_11,
                                                timeout=Duration.seconds(30),
                                                memory_size=2048,
-                                               handler="grocery_list_processor.handler",
-                                               code=aws_lambda.Code.from_asset("lambda"))
+                                               handler="trigger_step_functions_wrokflow.handler",
+                                               code=aws_lambda.Code.from_asset("lambda"),
+                                               layers=[powertools_layer])
 
         grocery_list_bucket = aws_s3.Bucket(self, "grocery-list",
                                             versioned=False,
                                             encryption=aws_s3.BucketEncryption.S3_MANAGED,
                                             block_public_access=aws_s3.BlockPublicAccess.BLOCK_ALL)
 
-        # Step 3: Grant the Lambda function permissions to read from the S3 bucket
-        grocery_list_bucket.grant_read_write(grocery_function)
+        # Step 3: Grant the Lambda function permissions to read from the S3 bucket.
+        # It reads small images itself and never writes to the bucket
+        grocery_list_bucket.grant_read(grocery_function)
 
 
         # Step 4: Grant the Lambda function permissions to use Textract
@@ -167,16 +274,41 @@ class CoffeeOrderStack(Stack):
             resources=["*"]  # Grant access to all Textract resources
         )
         grocery_function.add_to_role_policy(textract_policy)
-        # Step 5: Add an S3 event trigger to invoke the Lambda function
+
+        # Step 4a: Textract and Bedrock results are cached in the table
+        ecommerce_table.grant_read_write_data(grocery_function)
+        grocery_function.add_environment("ECOMMERCE_TABLE_NAME", ecommerce_table.table_name)
+        # Step 4b: Textract publishes PDF job completions to an SNS topic, so the
+        # trigger Lambda starts the job and exits instead of polling for it
+        textract_completion_topic = sns.Topic(self, "TextractCompletionTopic")
+        textract_publish_role = iam.Role(self, "TextractPublishRole",
+                                         assumed_by=iam.ServicePrincipal("textract.amazonaws.com"))
+        textract_completion_topic.grant_publish(textract_publish_role)
+        textract_publish_role.grant_pass_role(grocery_function)
+        grocery_function.add_environment("TEXTRACT_SNS_TOPIC_ARN", textract_completion_topic.topic_arn)
+        grocery_function.add_environment("TEXTRACT_ROLE_ARN", textract_publish_role.role_arn)
+
+        # Step 5: Add an S3 event trigger to invoke the Lambda function, only for
+        # the images and documents it reads, so no other object written to the
+        # bucket can invoke it again. Uploads can be narrowed to a key prefix
+        # with the uploadPrefix context value
         notification = aws_s3_notifications.LambdaDestination(grocery_function)
-        grocery_list_bucket.add_event_notification(aws_s3.EventType.OBJECT_CREATED, notification)
+        upload_prefix = self.node.try_get_context("uploadPrefix")
+        for extension in ("jpg", "jpeg", "png", "pdf", "tif", "tiff"):
+            for suffix in (f".{extension}", f".{extension.upper()}"):
+                grocery_list_bucket.add_event_notification(
+                    aws_s3.EventType.OBJECT_CREATED, notification,
+                    aws_s3.NotificationKeyFilter(prefix=upload_prefix, suffix=suffix))
 
         # Step 5: Create a Dead-Letter Queue (DLQ) for the SQS queue
         dlq = sqs.Queue(self, "GroceryListDLQ",
                         retention_period=Duration.days(14))  # Retain messages for 14 days
 
         # Step 6: Create the main SQS queue with a DLQ
+        # Messages stay invisible for six poller timeouts, as Lambda recommends
+        # for SQS event sources, so a retried batch is not picked up twice
         sqs_queue = sqs.Queue(self, "GroceryListTextExtractionQueue",
+                              visibility_timeout=Duration.seconds(540),
                               dead_letter_queue=sqs.DeadLetterQueue(
                                   max_receive_count=3,  # Retry 3 times before sending to DLQ
                                   queue=dlq
@@ -188,26 +320,74 @@ class CoffeeOrderStack(Stack):
         # Step 8: Set the SQS queue URL as an environment variable for the Lambda function
         grocery_function.add_environment("SQS_QUEUE_URL", sqs_queue.queue_url)
 
+        # Step 9: Create the Lambda function that picks up finished Textract jobs
+        textract_completion_function = aws_lambda.Function(self, "TextractCompletionHandler",
+                                                           runtime=aws_lambda.Runtime.PYTHON_3_11,
+                                                           timeout=Duration.seconds(30),
+                                                           memory_size=1024,
+                                                           handler="trigger_step_functions_wrokflow.textract_completion_handler",
+                                                           code=aws_lambda.Code.from_asset("lambda"),
+                                                           layers=[powertools_layer])
+        textract_completion_function.add_to_role_policy(iam.PolicyStatement(
+            actions=["textract:GetDocumentTextDetection"],
+            resources=["*"]
+        ))
+        textract_completion_topic.add_subscription(
+            sns_subscriptions.LambdaSubscription(textract_completion_function))
+        sqs_queue.grant_send_messages(textract_completion_function)
+        textract_completion_function.add_environment("SQS_QUEUE_URL", sqs_queue.queue_url)
+        ecommerce_table.grant_read_write_data(textract_completion_function)
+        textract_completion_function.add_environment("ECOMMERCE_TABLE_NAME", ecommerce_table.table_name)
+
+        # S3 and SNS invoke both functions asynchronously and ignore what they
+        # return, so an invocation with failed records raises; Lambda retries it
+        # and then keeps the event in this queue
+        trigger_failures_queue = sqs.Queue(self, "GroceryListTriggerFailures",
+                                           retention_period=Duration.days(14))
+        for function in (grocery_function, textract_completion_function):
+            function.configure_async_invoke(
+                retry_attempts=2,
+                on_failure=lambda_destinations.SqsDestination(trigger_failures_queue))
+
         # Step 10: Create the second Lambda function (SQS Poller)
         sqs_poller_lambda = aws_lambda.Function(self, "LambdaSQSPoller",
                                                 runtime=aws_lambda.Runtime.PYTHON_3_11,
                                                 handler="lambda_sqs_poller.handler",
                                                 code=aws_lambda.Code.from_asset("lambda"),
-                                                timeout=Duration.seconds(30))
+                                                # Powertools and pydantic v2, which validates
+                                                # the extracted grocery lists, come from the layer
+                                                layers=[powertools_layer],
+                                                # Room for an escalation to the larger model
+                                                # with a doubled output budget
+                                                timeout=Duration.seconds(90))
 
         # Step 11: Grant the second Lambda function permissions to poll the SQS queue
         sqs_queue.grant_consume_messages(sqs_poller_lambda)
 
         sqs_poller_lambda.add_to_role_policy(iam.PolicyStatement(
-            actions=["bedrock:InvokeModel"],
+            actions=["bedrock:InvokeModel", "bedrock:InvokeModelWithResponseStream"],
             resources=["*"]  # Grant access to all Bedrock models
         ))
 
-        # Step 11: Add an SQS event source mapping to trigger the Lambda function
-        sqs_event_source = lambda_event_sources.SqsEventSource(sqs_queue)
+        # Step 11: Add an SQS event source mapping to trigger the Lambda function.
+        # The poller reports failed records individually, so a batch is never
+        # retried as a whole because of one bad message
+        sqs_event_source = lambda_event_sources.SqsEventSource(sqs_queue,
+                                                               batch_size=10,
+                                                               report_batch_item_failures=True)
         sqs_poller_lambda.add_event_source(sqs_event_source)
 
         sqs_poller_lambda.add_environment("SQS_QUEUE_URL", sqs_queue.queue_url)
+        ecommerce_table.grant_read_write_data(sqs_poller_lambda)
+        sqs_poller_lambda.add_environment("ECOMMERCE_TABLE_NAME", ecommerce_table.table_name)
+
+        # The extraction model chain (cheapest first) and streaming can be set
+        # per deployment; lambda/lambda_sqs_poller.py has the defaults
+        extraction_model_ids = self.node.try_get_context("extractionModelIds")
+        if extraction_model_ids:
+            sqs_poller_lambda.add_environment("EXTRACTION_MODEL_IDS", extraction_model_ids)
+        if self.node.try_get_context("extractionStreaming"):
+            sqs_poller_lambda.add_environment("EXTRACTION_STREAMING", "true")
 
         # Step 5: (Optional) Output the bucket name and Lambda function ARN
         self.bucket_name = grocery_list_bucket.bucket_name
@@ -216,6 +396,10 @@ class CoffeeOrderStack(Stack):
         self.sqs_poller_lambda_arn = sqs_poller_lambda.function_arn
         self.dlq_url = dlq.queue_url
 
+        # The agent indexes the catalog from a snapshot compiled here, before
+        # the image asset is fingerprinted, instead of reading every product
+        # shard on a cold start (see batch_upload/catalog_snapshot.py)
+        write_snapshot("batch_upload/product_list.json", CATALOG_SNAPSHOT_PATH)
         action_group_function = aws_lambda.DockerImageFunction(
             self,
             "AgentLambdaFunction",
@@ -223,12 +407,27 @@ class CoffeeOrderStack(Stack):
             function_name="AgentLambdaFunction",
             memory_size=2048,
             timeout=Duration.seconds(30),
-            code=DockerImageCode.from_image_asset("lambda"),
+            code=DockerImageCode.from_image_asset(".", file="lambda/Dockerfile"),
 
         )
         ecommerce_table.grant_full_access(action_group_function)
         action_group_function.add_environment("ECOMMERCE_TABLE_NAME",ecommerce_table.table_name)
 
+        # The handlers publish their metrics as EMF log lines, which CloudWatch
+        # turns into metrics under one namespace with a `service` dimension
+        instrumented_functions = {
+            "product-loader": lambda_function,
+            "stripe-sync": create_stripe_products_lambda_function,
+            "catalog-stream": catalog_stream_function,
+            "grocery-trigger": grocery_function,
+            "textract-completion": textract_completion_function,
+            "grocery-extraction": sqs_poller_lambda,
+            "agent": action_group_function,
+        }
+        for service, function in instrumented_functions.items():
+            function.add_environment("POWERTOOLS_METRICS_NAMESPACE", "GroceryApp")
+            function.add_environment("POWERTOOLS_SERVICE_NAME", service)
+
         agent = Agent(
             self,
             "Agent",
@@ -237,7 +436,20 @@ class CoffeeOrderStack(Stack):
                         "payment links,batch uploads a list of products into a dynamodb table and schedules meetings",
         )
 
-        executor_group = ActionGroupExecutor(lambda_=action_group_function)
+        # Opt-in warm capacity for the agent Lambda. SnapStart is not available
+        # for container image functions, so idle cold starts are avoided with
+        # provisioned concurrency on a "live" alias instead
+        agent_provisioned_concurrency = int(self.node.try_get_context("agentProvisionedConcurrency") or 0)
+        action_group_target = action_group_function
+        if agent_provisioned_concurrency > 0:
+            action_group_target = aws_lambda.Alias(
+                self, "AgentLambdaLiveAlias",
+                alias_name="live",
+                version=action_group_function.current_version,
+                provisioned_concurrent_executions=agent_provisioned_concurrency,
+            )
+
+        executor_group = ActionGroupExecutor(lambda_=action_group_target)
 
         action_group = AgentActionGroup(
             self,
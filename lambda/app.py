@@ -1,29 +1,179 @@
 
+import json
 import os
+import re
+from dataclasses import asdict
+from functools import lru_cache
 from time import time
 
-import boto3
-import stripe
-from pydantic import EmailStr, ValidationError, BaseModel, HttpUrl
+from pydantic import ValidationError, BaseModel, Field, HttpUrl, TypeAdapter, WrapValidator
 from typing_extensions import Annotated
 from aws_lambda_powertools import Logger, Tracer
 from aws_lambda_powertools.event_handler import BedrockAgentResolver
 from aws_lambda_powertools.utilities.typing import LambdaContext
 from aws_lambda_powertools.event_handler.openapi.params import Body, Query
+from aws_lambda_powertools.metrics import MetricUnit
+
+from pipeline_metrics import metrics, publish_metrics, recorder
+from session_memo import SessionMemo
 
 tracer = Tracer()
 logger = Logger()
 app = BedrockAgentResolver()
-dynamodb = boto3.resource("dynamodb")
 
 table_name = os.environ.get("ECOMMERCE_TABLE_NAME")
 
-table = dynamodb.Table(table_name)
-# Set your Stripe API key
-stripe.api_key = 'sk_test_o5XBQtVklHa7okPAhm5Ey61C00T7DHjBgB'
+
+# SDKs and clients are set up on first use by the routes that need them, so a
+# cold start only pays for what the invoked route uses. Importing stripe alone
+# takes over a second, and /current_time needs neither stripe nor boto3.
+@lru_cache(maxsize=None)
+def stripe_api():
+    import stripe
+    from stripe_guard import configure
+
+    # Set your Stripe API key
+    stripe.api_key = 'sk_test_o5XBQtVklHa7okPAhm5Ey61C00T7DHjBgB'
+    configure()
+    return stripe
+
+
+@lru_cache(maxsize=None)
+def stripe_catalog():
+    stripe_api()
+    from catalog_index import catalog_index
+    catalog_index.changed_since = catalog_changes().changed_since
+    return catalog_index
+
+
+@lru_cache(maxsize=None)
+def product_matcher():
+    from catalog_matcher import catalog_matcher
+    return catalog_matcher
+
+
+@lru_cache(maxsize=None)
+def product_loader():
+    from dynamodb_loader import BulkLoader
+    return BulkLoader(table_name, workers=4)
+
+
+@lru_cache(maxsize=None)
+def catalog_changes():
+    from catalog_changes import CatalogChangeFeed
+    return CatalogChangeFeed()
+
+
+def apply_catalog_changes() -> None:
+    """
+    Applies the products changed since the last check (see
+    batch_upload/catalog_stream.py) to the catalog index and the matcher of
+    this container, and drops them from the session memo.
+    """
+    feed = catalog_changes()
+    changes = feed.poll()
+    recorder.count("CatalogChangesApplied", len(changes))
+    # Without Stripe set up the index was never built, and importing it here
+    # would load Stripe on routes that do not use it
+    if changes and stripe_api.cache_info().currsize:
+        for change in changes:
+            for product_name in filter(None, (change.get("name"), change.get("previousName"))):
+                stripe_catalog().invalidate(product_name)
+    # Likewise a matcher that was never built reads the changes with the rest
+    # of the catalog when a route first needs it
+    if changes and product_matcher.cache_info().currsize:
+        for change in changes:
+            if change.get("removed"):
+                product_matcher().remove(change["productId"])
+            else:
+                product_matcher().upsert([change])
+
+    # Entries remembered before a change, possibly in another container
+    memo = session_memo()
+    for product_name, remembered in list(memo.products.items()):
+        if feed.changed_since(product_name, remembered["at"]):
+            memo.forget(product_name)
+
+
+def session_memo() -> SessionMemo:
+    """The memo of the conversation the current request belongs to."""
+    return app.context.get("session_memo") or SessionMemo()
+
+
+def resolve_products(product_names):
+    """
+    Resolves product names to catalog entries, reading the names resolved
+    earlier in the session from the session memo and the rest from the
+    catalog index.
+    """
+    from catalog_index import CatalogEntry
+
+    apply_catalog_changes()
+    memo = session_memo()
+    entries, missing = {}, []
+    for product_name in product_names:
+        remembered = memo.product(product_name)
+        if remembered is not None:
+            entries[product_name] = CatalogEntry(**remembered)
+        elif product_name not in missing:
+            missing.append(product_name)
+    recorder.cache_lookups("SessionMemo", len(entries), len(missing))
+    if missing:
+        for product_name, entry in stripe_catalog().lookup_many(missing).items():
+            entries[product_name] = entry
+            if entry is not None:
+                memo.remember(product_name, asdict(entry))
+    return entries
+
+
+# Stripe rejects payment links with more line items than this
+PAYMENT_LINK_MAX_LINE_ITEMS = 20
+# The parameter Stripe names when a line item's price is missing or archived
+_LINE_ITEM_PRICE_PARAM = re.compile(r"line_items\[(\d+)\]\[price\]")
+
+
+def create_payment_link(quantities) -> str:
+    """Creates a payment link for price id -> quantity through the Stripe circuit breaker."""
+    from stripe_guard import stripe_breaker
+
+    recorder.count("StripeCalls")
+    with recorder.timer("StripeDuration"):
+        payment_link = stripe_breaker.call(
+            stripe_api().PaymentLink.create,
+            line_items=[{'price': price_id, 'quantity': qty} for price_id, qty in quantities.items()],
+        )
+    return payment_link.url
+
+
+def stale_line_item(error):
+    """
+    The position of the line item a payment link was rejected for because its
+    price no longer exists or was archived, or None when Stripe rejected the
+    request for another reason.
+    """
+    match = _LINE_ITEM_PRICE_PARAM.fullmatch(getattr(error, "param", None) or "")
+    return int(match.group(1)) if match else None
+
+
+def stripe_failure(error: Exception) -> str:
+    """
+    What the agent tells the customer when Stripe is unavailable or failed,
+    so it can explain the problem instead of retrying blindly.
+    """
+    from stripe_guard import TRANSIENT_ERRORS, StripeUnavailable
+
+    recorder.count("StripeErrors")
+    if isinstance(error, StripeUnavailable):
+        logger.warning("Stripe circuit open, failing fast", retry_after=error.retry_after)
+        return (f"Payments are temporarily unavailable. Please try again in about "
+                f"{int(error.retry_after) + 1} seconds.")
+    logger.error(f"Error: {getattr(error, 'user_message', None) or error}")
+    if isinstance(error, TRANSIENT_ERRORS):
+        return "Stripe did not respond in time, so no payment link was created. Please try again shortly."
+    return f"The payment link could not be created: {getattr(error, 'user_message', None) or 'Stripe rejected it'}"
 
 from datetime import datetime
-from typing import List
+from typing import List, Optional, Tuple
 
 
 class Package(BaseModel):
@@ -46,6 +196,106 @@ class Product(BaseModel):
     tags: List[str]
 
 
+class OrderLineItem(BaseModel):
+    product_name: str
+    qty: int = Field(gt=0)
+
+
+class ItemError(BaseModel):
+    index: int
+    productId: Optional[str] = None
+    errors: List[str]
+
+
+class PopulateDbResult(BaseModel):
+    written: int
+    invalid: int
+    failed: int
+    errors: List[ItemError]
+    next_offset: Optional[int] = Field(default=None, description="Set when the list was longer than one request "
+                                                                 "accepts: send the items from this index on again")
+
+
+class ItemsPage(BaseModel):
+    items: list
+    total: int
+    next_offset: Optional[int] = None
+
+
+# Lists are validated in chunks of this many items, and at most
+# POPULATE_DB_MAX_ITEMS are accepted per request
+POPULATE_DB_CHUNK_SIZE = int(os.environ.get("POPULATE_DB_CHUNK_SIZE", "100"))
+POPULATE_DB_MAX_ITEMS = int(os.environ.get("POPULATE_DB_MAX_ITEMS", "1000"))
+LIST_OF_ITEMS_MAX_PAGE = 200
+# Payload logging keeps a summary at INFO; the capped payload itself is logged at
+# DEBUG, which POWERTOOLS_LOGGER_SAMPLE_RATE turns on for a share of requests
+LOG_PAYLOAD_MAX_CHARS = int(os.environ.get("LOG_PAYLOAD_MAX_CHARS", "2048"))
+LOG_PAYLOAD_SAMPLE_ITEMS = 3
+MAX_ERRORS_PER_ITEM = 5
+
+
+def log_payload(message: str, items: list) -> None:
+    logger.info(message, items=len(items), sample=[_ellipsize(item, 200) for item in items[:LOG_PAYLOAD_SAMPLE_ITEMS]])
+    logger.debug(message, payload=_ellipsize(items, LOG_PAYLOAD_MAX_CHARS))
+
+
+def _ellipsize(value, max_chars: int) -> str:
+    text = json.dumps(value, default=str)
+    return text if len(text) <= max_chars else f"{text[:max_chars]}... ({len(text)} chars)"
+
+
+def decode_items(list_items: list) -> list:
+    """
+    Agents pass a list parameter as one JSON-encoded string; such strings are
+    decoded and flattened into the list of item objects.
+    """
+    items = []
+    for value in list_items:
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                pass
+        if isinstance(value, list):
+            items.extend(value)
+        else:
+            items.append(value)
+    return items
+
+
+def _product_or_error(value, handler):
+    # An invalid item keeps its errors in its place in the list instead of
+    # failing the validation of the whole chunk
+    try:
+        return handler(value)
+    except ValidationError as e:
+        return e
+
+
+product_list_adapter = TypeAdapter(List[Annotated[Product, WrapValidator(_product_or_error)]])
+
+
+def validate_products(items: list, offset: int = 0) -> Tuple[List[Product], List[ItemError]]:
+    """
+    Validates a chunk of items in a single pass of product_list_adapter. When
+    some items are invalid their errors are reported per item and the models of
+    the valid ones are returned as validated.
+    """
+    products: List[Product] = []
+    item_errors: List[ItemError] = []
+    for index, (item, result) in enumerate(zip(items, product_list_adapter.validate_python(items))):
+        if isinstance(result, Product):
+            products.append(result)
+        else:
+            messages = [f"{'.'.join(str(part) for part in error['loc']) or 'item'}: {error['msg']}"
+                        for error in result.errors(include_url=False)[:MAX_ERRORS_PER_ITEM]]
+            # The id only labels the error, so one of the wrong type is left out
+            product_id = item.get("productId") if isinstance(item, dict) else None
+            item_errors.append(ItemError(index=offset + index, errors=messages,
+                                         productId=product_id if isinstance(product_id, str) else None))
+    return products, item_errors
+
+
 '''
 @app.get("/schedule_meeting", description="Schedules a meeting with the team")
 @tracer.capture_method
@@ -88,11 +338,18 @@ def list_of_items(list_items: Annotated[
             "tempor"
         ]
     }
-    ], description="A list of items")]) -> Annotated[
-    list, Body(description="returns list of items")]:
-    logger.info(f"list of items {list_items}")
+    ], description="A list of items")],
+        offset: Annotated[int, Query(description="Index of the first item to return")] = 0,
+        limit: Annotated[int, Query(description="How many items to return, at most 200")] = 50) -> Annotated[
+    ItemsPage, Body(description="returns a page of the list of items, with the offset of the next page if "
+                                "there is one")]:
+    items = decode_items(list_items)
+    log_payload("list of items", items)
 
-    return list_items
+    # Long lists are echoed back a page at a time
+    offset, limit = max(0, offset), max(1, min(limit, LIST_OF_ITEMS_MAX_PAGE))
+    end = offset + limit
+    return ItemsPage(items=items[offset:end], total=len(items), next_offset=end if end < len(items) else None)
 
 
 @app.post("/populate_db", description="Populates the database with a list of json objects gotten from a json array")
@@ -126,13 +383,17 @@ def add_products_db(list_items: Annotated[
         ]
     }
     ], description="The list items")]) -> Annotated[
-    bool, Body(description="Whether the products were added to the successfully")]:
+    PopulateDbResult, Body(description="How many products were written, the validation errors of the products "
+                                       "that were not, and where to continue when the list was too long")]:
     """
        Batch loads a list of products into DynamoDB.
 
+       Invalid products are reported one by one and do not keep the valid ones
+       from being written. Lists over POPULATE_DB_MAX_ITEMS are accepted up to
+       that many items, and `next_offset` tells the caller where to resume.
 
        Returns:
-           dict: A response indicating the status of the operation.
+           PopulateDbResult: The outcome of the operation.
        """
 
     logger.append_keys(
@@ -141,92 +402,167 @@ def add_products_db(list_items: Annotated[
         input_text=app.current_event.input_text,
 
     )
-    try:
-
-        logger.info(f"list of items {list_items}")
-
-        # Validate the input using Pydantic
-        product_list: List[Product] = [Product(**item) for item in list_items]
-
-    except ValidationError as e:
-        logger.exception("An unexpected error occurred", log=e)
-        return False
-
-    # Batch load products into DynamoDB
-    with table.batch_writer() as batch:
-        for product in product_list:
-            batch.put_item(
-                Item={
-                    "PK": "PRODUCT",
-                    "SK": f"PRODUCT#{product.productId}",
-                    "productId": product.productId,
-                    "category": product.category,
-                    "createdDate": product.createdDate,
-                    "description": product.description,
-                    "modifiedDate": product.modifiedDate,
-                    "name": product.name,
-                    "package": product.package,
-                    "pictures": product.pictures,
-                    "price": product.price,
-                    "tags": product.tags,
-                }
-            )
-
-    logger.info("Products uploaded successfully")
-    return True
+    items = decode_items(list_items)
+    log_payload("populate db", items)
+    accepted = items[:POPULATE_DB_MAX_ITEMS]
+
+    from dynamodb_loader import product_item
+
+    errors: List[ItemError] = []
+
+    def valid_products():
+        # Chunks are validated as the loader consumes them, so validation and
+        # writes overlap and only one chunk of models is held at a time
+        for start in range(0, len(accepted), POPULATE_DB_CHUNK_SIZE):
+            products, chunk_errors = validate_products(accepted[start:start + POPULATE_DB_CHUNK_SIZE], start)
+            errors.extend(chunk_errors)
+            for product in products:
+                yield product_item(product.model_dump(mode="json"))
+
+    # Batch load products into DynamoDB with concurrent batch writers
+    report = product_loader().load(valid_products())
+    recorder.count("ProductsWritten", report.written)
+    recorder.count("ProductsInvalid", len(errors))
+    recorder.count("ProductsFailed", report.failed)
+    recorder.count("DynamoDBCalls", report.requests)
+    recorder.count("DynamoDBThrottles", report.throttled)
+    result = PopulateDbResult(
+        written=report.written, invalid=len(errors), failed=report.failed, errors=errors,
+        next_offset=len(accepted) if len(items) > len(accepted) else None,
+    )
+    if errors:
+        logger.warning("Some products are invalid", invalid=len(errors), first_error=errors[0].model_dump())
+    if report.failed:
+        logger.error("Some products could not be uploaded", failed=report.failed, written=report.written)
+    logger.info("Products uploaded", written=report.written, next_offset=result.next_offset)
+    return result
 
 
 @app.get("/payment_link", description="Creates a stripe payment link")
 @tracer.capture_method
 def payment_link(
         product_name: Annotated[str, Query(description="The Product name")],
-        qty: Annotated[int, Query(description="The Product quantity")],
+        qty: Annotated[int, Query(gt=0, description="The Product quantity")],
 ) -> str:
     logger.info("product name", product_name=product_name)
     logger.info("product qty", qty=qty)
+    stripe, memo = stripe_api(), session_memo()
+    from stripe_guard import StripeUnavailable
 
     try:
-        # Step 1: Retrieve the product by name
-        products = stripe.Product.list(limit=100)  # Adjust limit as needed
-        product = None
-
-        # Filter products by name
-        for p in products.auto_paging_iter():
-            if p.name == product_name:
-                product = p
-                break
-
-        if not product:
+        # Step 1: Resolve the product and its price from the session memo or the warm catalog index
+        entry = resolve_products([product_name])[product_name]
+        if not entry:
             logger.error(f"No product found with name: {product_name}")
             return f"No product found with name: {product_name}"
 
-        logger.info(f"Product found! ID: {product.id}")
-
-        # Step 2: Retrieve the price for the product
-        prices = stripe.Price.list(product=product.id, limit=1)  # Get the first price
-        if not prices.data:
-            logger.error(f"No price found for product ID: {product.id}")
-            return f"No price found for product ID: {product.id}"
-
-        price = prices.data[0]  # Get the first price in the list
-        logger.debug(f"Price found! ID: {price.id}, Amount: {price.unit_amount / 100} {price.currency.upper()}")
-
-        # Step 3: Create a payment link using the Price ID
-        payment_link = stripe.PaymentLink.create(
-            line_items=[
-                {
-                    'price': price.id,
-                    'quantity': qty,
-                },
-            ],
-        )
-        logger.info(f"Payment Link URL: {payment_link.url}")
-        return f"Payment Link URL: {payment_link}"
+        logger.info(f"Product found! ID: {entry.product_id}, Price ID: {entry.price_id}")
+
+        # A link already created in this conversation for the same cart is reused
+        quantities = {entry.price_id: qty}
+        link = memo.cart_link(quantities)
+        if link:
+            recorder.count("PaymentLinksReused")
+            return f"Payment Link URL: {link}"
+
+        # Step 2: Create a payment link using the Price ID
+        url = create_payment_link(quantities)
+        logger.info(f"Payment Link URL: {url}")
+        memo.set_cart(quantities, url)
+        return f"Payment Link URL: {url}"
+
+    except stripe.error.InvalidRequestError as e:
+        if stale_line_item(e) is None:
+            return stripe_failure(e)
+        # The cached price was archived since the index was built
+        stripe_catalog().invalidate(product_name)
+        memo.forget(product_name)
+        logger.error(f"Error: {e.user_message}")
+        return f"The price of {product_name} has changed. Please ask for the payment link again."
+
+    except (stripe.error.StripeError, StripeUnavailable) as e:
+        return stripe_failure(e)
 
 
+@app.post("/order_payment_link", description="Creates a single stripe payment link for a whole order made up of "
+                                             "several products and their quantities")
+@tracer.capture_method
+def order_payment_link(
+        line_items: Annotated[List[OrderLineItem], Body(embed=True, description="The products in the order, each "
+                                                                                "with its product name and quantity")],
+) -> Annotated[str, Body(description="The payment link URL, or the product names that could not be found")]:
+    logger.info("order line items", line_items=len(line_items))
+    stripe, memo = stripe_api(), session_memo()
+    from stripe_guard import StripeUnavailable
+
+    if not line_items:
+        return "The order has no items"
 
-    except stripe.error.StripeError as e:
+    try:
+        # Step 1: Resolve every product in one pass against the session memo and the catalog index
+        entries = resolve_products(item.product_name for item in line_items)
+        not_found = sorted({name for name, entry in entries.items() if entry is None})
+        if not_found:
+            logger.error(f"No product found with names: {not_found}")
+            return f"No product found with names: {', '.join(not_found)}"
+
+        # Step 2: Merge repeated products so each price appears once
+        quantities = {}
+        for item in line_items:
+            price_id = entries[item.product_name].price_id
+            quantities[price_id] = quantities.get(price_id, 0) + item.qty
+
+        if len(quantities) > PAYMENT_LINK_MAX_LINE_ITEMS:
+            return f"A payment link can hold at most {PAYMENT_LINK_MAX_LINE_ITEMS} different products"
+
+        # A link already created in this conversation for the same cart is reused
+        link = memo.cart_link(quantities)
+        if link:
+            recorder.count("PaymentLinksReused")
+            return f"Payment Link URL: {link}"
+
+        # Step 3: Create one payment link holding all the line items
+        url = create_payment_link(quantities)
+        logger.info(f"Payment Link URL: {url}")
+        memo.set_cart(quantities, url)
+        return f"Payment Link URL: {url}"
+
+    except stripe.error.InvalidRequestError as e:
+        stale = stale_line_item(e)
+        if stale is None or stale >= len(quantities):
+            return stripe_failure(e)
+        # The cached price was archived since the index was built
+        stale_price = list(quantities)[stale]
+        changed = sorted({item.product_name for item in line_items
+                          if entries[item.product_name].price_id == stale_price})
+        for product_name in changed:
+            stripe_catalog().invalidate(product_name)
+            memo.forget(product_name)
         logger.error(f"Error: {e.user_message}")
+        return f"The price of {', '.join(changed)} has changed. Please ask for the payment link again."
+
+    except (stripe.error.StripeError, StripeUnavailable) as e:
+        return stripe_failure(e)
+
+
+@app.post("/match_items", description="Matches free-text grocery items, such as '2kg lemons', to the closest "
+                                      "products in the catalog")
+@tracer.capture_method
+def match_items(
+        items: Annotated[List[str], Body(embed=True, description="The grocery items as the customer wrote them")],
+        top_k: Annotated[int, Query(description="How many candidate products to return per item")] = 3,
+) -> Annotated[list, Body(description="For every item, the best matching products with their id, name, price "
+                                      "and score")]:
+    logger.info("matching items", items=len(items), top_k=top_k)
+    apply_catalog_changes()
+
+    matches = product_matcher().match_many(items, top_k=max(1, min(top_k, 10)))
+    recorder.count("ItemsMatched", sum(1 for item_matches in matches.values() if item_matches))
+    recorder.count("ItemsUnmatched", sum(1 for item_matches in matches.values() if not item_matches))
+    return [
+        {"item": item, "matches": [asdict(match) for match in item_matches]}
+        for item, item_matches in matches.items()
+    ]
 
 
 @app.get("/current_time", description="Gets the current time in seconds")
@@ -235,10 +571,35 @@ def current_time() -> int:
     return int(time())
 
 
+def _size(value) -> int:
+    return len(json.dumps(value, separators=(",", ":")).encode("utf-8")) if value else 0
+
+
+@publish_metrics
 @logger.inject_lambda_context
 @tracer.capture_lambda_handler
 def lambda_handler(event: dict, context: LambdaContext):
-    return app.resolve(event, context)
+    # Every metric of the invocation is reported per route
+    metrics.add_dimension(name="route", value=event.get("apiPath") or "unknown")
+    recorder.observe("RequestSize", _size(event.get("parameters")) + _size(event.get("requestBody")),
+                     MetricUnit.Bytes)
+
+    # The session memo travels in the agent's session attributes, which Bedrock
+    # sends back with every later request of the same conversation
+    session_attributes = event.get("sessionAttributes")
+    memo = SessionMemo.from_attributes(session_attributes)
+    app.append_context(session_memo=memo)
+    with recorder.timer("RequestDuration"):
+        response = app.resolve(event, context)
+    recorder.observe("ResponseSize", _size(response.get("response", {}).get("responseBody")), MetricUnit.Bytes)
+    if response.get("response", {}).get("httpStatusCode", 200) >= 400:
+        recorder.count("RequestsFailed")
+    if memo.changed:
+        response["sessionAttributes"] = memo.to_attributes(session_attributes)
+    elif session_attributes:
+        # Returned unchanged so the memo is carried on to the next turn
+        response["sessionAttributes"] = session_attributes
+    return response
 
 
 if __name__ == "__main__":
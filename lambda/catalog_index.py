@@ -0,0 +1,231 @@
+"""
+Warm-container index of the Stripe catalog used by the agent action group.
+
+The index maps a normalized product name to the Stripe product id and the price
+used when creating payment links. It is built with one paged bulk fetch of the
+active prices (with their products expanded) and lives at module scope, so warm
+invocations answer lookups from memory until the TTL expires or the index is
+invalidated. Names that are not in the index trigger a targeted search for the
+missing products only, never a full rescan.
+
+Every Stripe request goes through the Stripe circuit breaker (see
+stripe_guard.py). When Stripe cannot be reached to rebuild an expired index,
+the old entries keep answering until it can.
+
+The module-level index shares each bulk fetch with the other agent containers
+through a `SharedLookup`, so a burst of cold containers lists the prices once.
+Entries of a shared fetch for products that changed after it was made (per
+`changed_since`, see batch_upload/catalog_changes.py) are left out, and the
+next lookup of those names searches Stripe for them.
+"""
+import json
+import os
+import re
+import threading
+from dataclasses import asdict, dataclass
+from time import monotonic
+from typing import Callable, Dict, Iterable, Optional
+
+import stripe
+from aws_lambda_powertools import Logger
+
+from pipeline_metrics import recorder
+from stripe_guard import TRANSIENT_ERRORS, SharedLookup, StripeUnavailable, stripe_breaker
+
+logger = Logger(child=True)
+
+CATALOG_INDEX_TTL_SECONDS = int(os.environ.get("CATALOG_INDEX_TTL_SECONDS", "300"))
+# Names that were searched for and not found are remembered for a short while so
+# a model repeating a bad name does not hit the Stripe search API every turn.
+CATALOG_NEGATIVE_TTL_SECONDS = int(os.environ.get("CATALOG_NEGATIVE_TTL_SECONDS", "60"))
+
+# Maximum number of OR-ed clauses in a single Stripe search query.
+SEARCH_CLAUSE_LIMIT = 10
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_name(name: str) -> str:
+    """Case-folds a product name and collapses runs of whitespace."""
+    return _WHITESPACE.sub(" ", name).strip().casefold()
+
+
+@dataclass(frozen=True)
+class CatalogEntry:
+    name: str
+    product_id: str
+    price_id: str
+    unit_amount: Optional[int] = None
+    currency: Optional[str] = None
+
+
+def _entry_from(product, price) -> CatalogEntry:
+    return CatalogEntry(
+        name=product.name,
+        product_id=product.id,
+        price_id=price.id,
+        unit_amount=price.get("unit_amount"),
+        currency=price.get("currency"),
+    )
+
+
+def _escape_search_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("'", "\\'")
+
+
+class CatalogIndex:
+    """
+    Normalized product name -> product id -> default price id, with a TTL.
+    """
+
+    def __init__(self, ttl_seconds: int = CATALOG_INDEX_TTL_SECONDS,
+                 negative_ttl_seconds: int = CATALOG_NEGATIVE_TTL_SECONDS,
+                 page_size: int = 100, shared: Optional[SharedLookup] = None,
+                 changed_since: Optional[Callable[[str, float], bool]] = None):
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.page_size = page_size
+        self.shared = shared
+        self.changed_since = changed_since
+        self._entries: Dict[str, CatalogEntry] = {}
+        self._misses: Dict[str, float] = {}
+        self._built_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def is_stale(self) -> bool:
+        return self._built_at is None or monotonic() - self._built_at >= self.ttl_seconds
+
+    def invalidate(self, product_name: Optional[str] = None) -> None:
+        """
+        Drops a single product from the index, or the whole index when no name
+        is given. The next lookup rebuilds whatever was dropped.
+        """
+        with self._lock:
+            if product_name is None:
+                self._entries.clear()
+                self._misses.clear()
+                self._built_at = None
+            else:
+                key = normalize_name(product_name)
+                self._entries.pop(key, None)
+                self._misses.pop(key, None)
+
+    def _stripe(self, request: Callable, *args, **kwargs):
+        """Sends one Stripe request through the circuit breaker."""
+        recorder.count("StripeCalls")
+        return stripe_breaker.call(request, *args, **kwargs)
+
+    def _active_prices(self) -> list:
+        prices = stripe.Price.list(active=True, limit=self.page_size, expand=["data.product"])
+        return list(prices.auto_paging_iter())
+
+    def _fetch_entries(self) -> Dict[str, CatalogEntry]:
+        entries: Dict[str, CatalogEntry] = {}
+        for price in self._stripe(self._active_prices):
+            product = price.product
+            if isinstance(product, str) or not product.get("active", True):
+                continue
+            key = normalize_name(product.name)
+            # Prefer the product's default price when a product has several.
+            if key not in entries or product.get("default_price") == price.id:
+                entries[key] = _entry_from(product, price)
+        return entries
+
+    def _shared_entries(self) -> Dict[str, CatalogEntry]:
+        value, built_at = self.shared.get(
+            "catalog-index", lambda: json.dumps([asdict(entry) for entry in self._fetch_entries().values()]))
+        entries = (CatalogEntry(**fields) for fields in json.loads(value))
+        return {normalize_name(entry.name): entry for entry in entries
+                if self.changed_since is None or not self.changed_since(entry.name, built_at)}
+
+    def refresh(self) -> None:
+        """
+        Rebuilds the index from a single paged listing of the active prices.
+        """
+        recorder.count("CatalogIndexRefreshes")
+        entries = self._fetch_entries() if self.shared is None else self._shared_entries()
+
+        with self._lock:
+            self._entries = entries
+            self._misses.clear()
+            self._built_at = monotonic()
+        logger.info("Catalog index built", products=len(entries))
+
+    def lookup(self, product_name: str) -> Optional[CatalogEntry]:
+        return self.lookup_many([product_name])[product_name]
+
+    def lookup_many(self, product_names: Iterable[str]) -> Dict[str, Optional[CatalogEntry]]:
+        """
+        Resolves several product names in one pass. Names already in the index
+        are answered from memory and the rest are searched for together.
+        """
+        if self.is_stale:
+            try:
+                self.refresh()
+            except (StripeUnavailable, *TRANSIENT_ERRORS) as e:
+                if not self._entries:
+                    raise
+                logger.warning("Catalog index could not be rebuilt, using the expired one", error=str(e))
+
+        now = monotonic()
+        results: Dict[str, Optional[CatalogEntry]] = {}
+        missing: Dict[str, str] = {}
+        for product_name in product_names:
+            key = normalize_name(product_name)
+            results[product_name] = self._entries.get(key)
+            if results[product_name] is not None:
+                continue
+            missed_at = self._misses.get(key)
+            if missed_at is None or now - missed_at >= self.negative_ttl_seconds:
+                missing.setdefault(key, product_name)
+
+        hits = sum(1 for entry in results.values() if entry is not None)
+        recorder.cache_lookups("CatalogIndex", hits, len(results) - hits)
+        if missing:
+            found = self._search(missing)
+            for product_name in results:
+                if results[product_name] is None:
+                    results[product_name] = found.get(normalize_name(product_name))
+        return results
+
+    def _search(self, missing: Dict[str, str]) -> Dict[str, CatalogEntry]:
+        """
+        Looks up products that are missing from the index, e.g. because they were
+        created after the index was built. Names are OR-ed together, up to the
+        clause limit of the Stripe search API per call.
+        """
+        logger.info("Catalog index miss, searching Stripe", product_names=list(missing.values()))
+        found: Dict[str, CatalogEntry] = {}
+        keys = list(missing)
+        for start in range(0, len(keys), SEARCH_CLAUSE_LIMIT):
+            chunk = keys[start:start + SEARCH_CLAUSE_LIMIT]
+            query = " OR ".join(f"name:'{_escape_search_value(missing[key])}'" for key in chunk)
+            result = self._stripe(stripe.Product.search, query=query, limit=100, expand=["data.default_price"])
+            for product in result.data:
+                key = normalize_name(product.name)
+                if key not in missing or key in found or not product.get("active", True):
+                    continue
+                price = product.get("default_price")
+                if not price or isinstance(price, str):
+                    prices = self._stripe(stripe.Price.list, product=product.id, active=True, limit=1)
+                    if not prices.data:
+                        continue
+                    price = prices.data[0]
+                found[key] = _entry_from(product, price)
+
+        now = monotonic()
+        with self._lock:
+            for key in missing:
+                if key in found:
+                    self._entries[key] = found[key]
+                    self._misses.pop(key, None)
+                else:
+                    self._misses[key] = now
+        return found
+
+
+catalog_index = CatalogIndex(shared=SharedLookup())
@@ -0,0 +1,228 @@
+"""
+In-memory fuzzy matcher from free-text grocery items to catalog products.
+
+Products are loaded once per container from the catalog snapshot shipped with
+the function while the table still holds that catalog (see
+catalog_snapshot.py), and otherwise from the product shards of GroceryAppTable,
+read in parallel (see catalog_keys.py). Every refresh after the TTL checks the
+snapshot again with one GetItem. The products go into two inverted indexes:
+
+- a token index over the product `name`, `tags` and `category` (name tokens
+  weigh more), for whole-word matches such as "lemons" -> "Fresh Lemons";
+- a trigram index over the name tokens, for misspellings and plural or singular
+  forms such as "lemon" or "lemmons".
+
+A query only visits the products that share a token or trigram with it, so a
+lookup costs microseconds rather than a table read. The index is updated in
+place: `upsert` and `remove` touch only the postings of the products that
+changed, and `refresh` re-reads the table but re-indexes only what differs.
+"""
+import heapq
+import os
+import re
+import threading
+from collections import defaultdict
+from dataclasses import dataclass
+from time import monotonic
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import boto3
+
+from catalog_keys import query_product_shards
+from catalog_snapshot import CatalogSnapshot, load_snapshot
+from pipeline_metrics import recorder
+
+CATALOG_MATCHER_TTL_SECONDS = int(os.environ.get("CATALOG_MATCHER_TTL_SECONDS", "900"))
+
+NAME_WEIGHT = 3.0
+TAG_WEIGHT = 1.0
+CATEGORY_WEIGHT = 1.0
+TRIGRAM_WEIGHT = 4.0
+MIN_SCORE = 1.0
+
+_TOKEN = re.compile(r"[a-z]+")
+# Quantities and units that describe how much to buy rather than what
+_QUANTITY = re.compile(r"\b\d+(?:[.,]\d+)?\s*(?:kg|kgs|g|gr|grams?|l|ml|lbs?|pcs|x)?\b|\bx\s*\d+\b")
+_STOPWORDS = frozenset({"of", "and", "the", "a", "an", "kg", "kgs", "g", "gr", "gram", "grams", "l", "ml", "lb",
+                        "lbs", "pcs", "pack", "packs", "x"})
+
+
+def tokenize(text: str) -> List[str]:
+    text = _QUANTITY.sub(" ", text.casefold())
+    return [token for token in _TOKEN.findall(text) if token not in _STOPWORDS]
+
+
+def trigrams(token: str) -> set:
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+@dataclass(frozen=True)
+class ProductDoc:
+    product_id: str
+    name: str
+    category: str
+    tags: Tuple[str, ...]
+    price: Optional[int] = None
+
+    @classmethod
+    def from_item(cls, item: dict) -> "ProductDoc":
+        price = item.get("price")
+        return cls(
+            product_id=item["productId"],
+            name=item["name"],
+            category=item.get("category", ""),
+            tags=tuple(item.get("tags") or ()),
+            price=int(price) if price is not None else None,
+        )
+
+
+@dataclass(frozen=True)
+class Match:
+    product_id: str
+    name: str
+    price: Optional[int]
+    score: float
+
+
+class CatalogMatcher:
+
+    def __init__(self, table=None, ttl_seconds: int = CATALOG_MATCHER_TTL_SECONDS,
+                 snapshot: Optional[CatalogSnapshot] = None):
+        self._table = table
+        self.ttl_seconds = ttl_seconds
+        self.snapshot = snapshot
+        self._docs: Dict[str, ProductDoc] = {}
+        self._tokens: Dict[str, Dict[str, float]] = defaultdict(dict)
+        self._trigrams: Dict[str, set] = defaultdict(set)
+        self._doc_tokens: Dict[str, List[str]] = {}
+        self._name_trigrams: Dict[str, set] = {}
+        self._built_at: Optional[float] = None
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._docs)
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = boto3.resource("dynamodb").Table(os.environ.get("ECOMMERCE_TABLE_NAME"))
+        return self._table
+
+    @property
+    def is_stale(self) -> bool:
+        return self._built_at is None or monotonic() - self._built_at >= self.ttl_seconds
+
+    def _index(self, doc: ProductDoc) -> None:
+        weights: Dict[str, float] = defaultdict(float)
+        for token in tokenize(doc.name):
+            weights[token] = max(weights[token], NAME_WEIGHT)
+        for tag in doc.tags:
+            for token in tokenize(tag):
+                weights[token] = max(weights[token], TAG_WEIGHT)
+        for token in tokenize(doc.category):
+            weights[token] = max(weights[token], CATEGORY_WEIGHT)
+        for token, weight in weights.items():
+            self._tokens[token][doc.product_id] = weight
+        self._doc_tokens[doc.product_id] = list(weights)
+
+        name_trigrams = set().union(*(trigrams(token) for token in tokenize(doc.name)))
+        for gram in name_trigrams:
+            self._trigrams[gram].add(doc.product_id)
+        self._name_trigrams[doc.product_id] = name_trigrams
+        self._docs[doc.product_id] = doc
+
+    def remove(self, product_id: str) -> None:
+        with self._lock:
+            if self._docs.pop(product_id, None) is None:
+                return
+            for token in self._doc_tokens.pop(product_id):
+                del self._tokens[token][product_id]
+                if not self._tokens[token]:
+                    del self._tokens[token]
+            for gram in self._name_trigrams.pop(product_id):
+                self._trigrams[gram].discard(product_id)
+                if not self._trigrams[gram]:
+                    del self._trigrams[gram]
+
+    def upsert(self, items: Iterable[dict]) -> int:
+        """
+        Adds or replaces products and returns how many actually changed.
+        """
+        changed = 0
+        with self._lock:
+            for item in items:
+                doc = ProductDoc.from_item(item)
+                if self._docs.get(doc.product_id) == doc:
+                    continue
+                self.remove(doc.product_id)
+                self._index(doc)
+                changed += 1
+        return changed
+
+    def _scan_products(self) -> Iterable[dict]:
+        return query_product_shards(
+            self.table,
+            on_query=lambda: recorder.count("DynamoDBCalls"),
+            ProjectionExpression="productId, #name, category, tags, price",
+            ExpressionAttributeNames={"#name": "name"},
+        )
+
+    def _load_products(self) -> Iterable[dict]:
+        if self.snapshot is not None:
+            recorder.count("DynamoDBCalls")
+            if self.snapshot.is_current(self.table):
+                recorder.count("CatalogSnapshotLoads")
+                return self.snapshot.products()
+            recorder.count("CatalogSnapshotStale")
+        return self._scan_products()
+
+    def refresh(self) -> int:
+        """
+        Re-reads the catalog and applies only the differences to the index.
+        Returns the number of products added, changed or removed.
+        """
+        recorder.count("CatalogMatcherRefreshes")
+        items = list(self._load_products())
+        with self._lock:
+            seen = {item["productId"] for item in items}
+            removed = [product_id for product_id in self._docs if product_id not in seen]
+            for product_id in removed:
+                self.remove(product_id)
+            changed = self.upsert(items) + len(removed)
+            self._built_at = monotonic()
+        return changed
+
+    def match(self, text: str, top_k: int = 3) -> List[Match]:
+        if self.is_stale:
+            self.refresh()
+
+        query_tokens = tokenize(text)
+        if not query_tokens:
+            return []
+        query_trigrams = set().union(*(trigrams(token) for token in query_tokens))
+
+        scores: Dict[str, float] = defaultdict(float)
+        shared: Dict[str, int] = defaultdict(int)
+        with self._lock:
+            for token in query_tokens:
+                for product_id, weight in self._tokens.get(token, {}).items():
+                    scores[product_id] += weight
+            for gram in query_trigrams:
+                for product_id in self._trigrams.get(gram, ()):
+                    shared[product_id] += 1
+            for product_id, count in shared.items():
+                union = len(query_trigrams) + len(self._name_trigrams[product_id]) - count
+                scores[product_id] += TRIGRAM_WEIGHT * count / union
+
+            best = heapq.nlargest(top_k, scores.items(), key=lambda entry: entry[1])
+            return [
+                Match(product_id, self._docs[product_id].name, self._docs[product_id].price, round(score, 3))
+                for product_id, score in best if score >= MIN_SCORE
+            ]
+
+    def match_many(self, texts: Iterable[str], top_k: int = 3) -> Dict[str, List[Match]]:
+        return {text: self.match(text, top_k) for text in texts}
+
+
+catalog_matcher = CatalogMatcher(snapshot=load_snapshot())
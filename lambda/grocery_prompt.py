@@ -0,0 +1,121 @@
+"""
+Token-budgeted prompts for grocery list extraction.
+
+Textract output is cleaned line by line before it reaches the model: lines
+without letters, receipt boilerplate (totals, tax, payment and store details)
+and URLs or phone numbers are dropped. Token counts are estimated locally from
+the text length, so no tokenizer call is needed. Texts over the input budget
+are split on line boundaries into chunks that are extracted separately and
+merged with `merge_grocery_lists`.
+
+The generation budget grows with the number of lines, since each line is at
+most one item of roughly `OUTPUT_TOKENS_PER_ITEM` tokens of JSON.
+"""
+import os
+import re
+from math import ceil
+from typing import Iterable, List
+
+from model.grocery_list import GroceryList, GroceryListItem
+
+PROMPT_CHUNK_TOKENS = int(os.environ.get("PROMPT_CHUNK_TOKENS", "1500"))
+MAX_OUTPUT_TOKENS = int(os.environ.get("EXTRACTION_MAX_OUTPUT_TOKENS", "4096"))
+# Cap of the budget a larger model gets after the previous one ran out of tokens
+ESCALATED_MAX_OUTPUT_TOKENS = int(os.environ.get("EXTRACTION_ESCALATED_MAX_OUTPUT_TOKENS", "8192"))
+# English text averages about four characters per token; stay on the safe side
+CHARS_PER_TOKEN = 3.5
+OUTPUT_BASE_TOKENS = 64
+OUTPUT_TOKENS_PER_ITEM = 24
+
+_WHITESPACE = re.compile(r"[ \t\r\f\v]+")
+_LETTER = re.compile(r"[^\W\d_]")
+_NOISE = re.compile(
+    r"\b(?:sub-?total|total|tax|vat|change|cash|card|visa|mastercard|amex|debit|credit|balance|"
+    r"receipt|invoice|cashier|till|terminal|auth(?:orization)?|thank(?:s| you)|welcome|"
+    r"tel|phone|fax)\b|https?://|www\.|@\w+\.\w+",
+    re.IGNORECASE,
+)
+
+PROMPT_TEMPLATE = """You are a helpful assistant that extracts grocery items alongside their amount in kg and quantity if available, from text.
+    Respond with ONLY a JSON object in the following format, using null when the amount in kg or the count is not given:
+    {{"items": [{{"item": "Lemons", "kg": 2, "count": null}}, {{"item": "Eggs", "kg": null, "count": 12}}]}}
+
+    If the text does NOT contain a grocery list, respond with: {{"items": []}}
+
+    Here is the text:
+    {text}"""
+
+
+def estimate_tokens(text: str) -> int:
+    return ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def clean_lines(text: str) -> List[str]:
+    """
+    Returns the lines of `text` that may name a grocery item, with whitespace
+    collapsed.
+    """
+    lines = []
+    for line in text.splitlines():
+        line = _WHITESPACE.sub(" ", line).strip()
+        if line and _LETTER.search(line) and not _NOISE.search(line):
+            lines.append(line)
+    return lines
+
+
+def chunk_lines(lines: List[str], max_tokens: int = PROMPT_CHUNK_TOKENS) -> List[List[str]]:
+    """
+    Splits lines into consecutive chunks of at most `max_tokens` estimated
+    tokens each. A single line over the budget gets a chunk of its own.
+    """
+    chunks, chunk, used = [], [], 0
+    for line in lines:
+        tokens = estimate_tokens(line) + 1
+        if chunk and used + tokens > max_tokens:
+            chunks.append(chunk)
+            chunk, used = [], 0
+        chunk.append(line)
+        used += tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def output_budget(lines: List[str]) -> int:
+    return min(MAX_OUTPUT_TOKENS, OUTPUT_BASE_TOKENS + OUTPUT_TOKENS_PER_ITEM * len(lines))
+
+
+def escalated_budget(budget: int) -> int:
+    """The budget for the next model when an answer was cut off at `budget` tokens."""
+    return min(ESCALATED_MAX_OUTPUT_TOKENS, budget * 2)
+
+
+def build_prompt(lines: List[str]) -> str:
+    return PROMPT_TEMPLATE.format(text="\n".join(lines))
+
+
+def _add(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+
+def merge_grocery_lists(lists: Iterable[GroceryList]) -> GroceryList:
+    """
+    Merges the extractions of several chunks in order of first appearance.
+    Chunks never share a line, so an item named in more than one chunk was
+    listed more than once and its amounts are added up.
+    """
+    merged = {}
+    for grocery_list in lists:
+        for item in grocery_list.items:
+            key = " ".join(item.item.split()).casefold()
+            if key not in merged:
+                merged[key] = item
+            else:
+                seen = merged[key]
+                merged[key] = GroceryListItem(item=seen.item, kg=_add(seen.kg, item.kg),
+                                              count=_add(seen.count, item.count))
+    return GroceryList(items=list(merged.values()))
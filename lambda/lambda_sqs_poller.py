@@ -1,80 +1,238 @@
+import hashlib
 import json
 import boto3
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.config import Config
 from aws_lambda_powertools import Logger
+from aws_lambda_powertools.metrics import MetricUnit
 from aws_lambda_powertools.utilities.data_classes import event_source, SQSEvent
+from aws_lambda_powertools.utilities.data_classes.sqs_event import SQSRecord
 
-sqs_client = boto3.client('sqs')
-bedrock_client = boto3.client('bedrock-runtime')
+from grocery_prompt import (build_prompt, chunk_lines, clean_lines, escalated_budget, merge_grocery_lists,
+                            output_budget)
+from model.grocery_list import GroceryList
+from order_drafts import save_order_draft
+from pipeline_metrics import publish_metrics, recorder
+from result_cache import result_cache, text_hash
+
+# Records of one batch are sent to Bedrock concurrently, bounded by this many workers
+extraction_concurrency = int(os.environ.get("EXTRACTION_CONCURRENCY", "10"))
+# Chunks of one long text are extracted concurrently, bounded by this many workers
+chunk_concurrency = int(os.environ.get("CHUNK_CONCURRENCY", "4"))
+
+bedrock_client = boto3.client('bedrock-runtime',
+                              config=Config(max_pool_connections=extraction_concurrency * chunk_concurrency,
+                                            retries={"mode": "adaptive", "max_attempts": 4}))
+
+orders_table = boto3.resource('dynamodb').Table(os.environ.get("ECOMMERCE_TABLE_NAME"))
 
-# Get the SQS queue URL and Bedrock inference profile ARN from environment variables
-sqs_queue_url = os.environ["SQS_QUEUE_URL"]
 logger = Logger()
 
+# Models are tried in order: a cheap, fast model first, and the next one only
+# when the previous answer is not a valid grocery list
+EXTRACTION_MODEL_IDS = [model_id.strip() for model_id in os.environ.get(
+    "EXTRACTION_MODEL_IDS",
+    "anthropic.claude-3-haiku-20240307-v1:0,anthropic.claude-3-5-sonnet-20240620-v1:0",
+).split(",") if model_id.strip()]
+# Extraction is not a creative task; temperature 0 also makes repeated
+# extractions of the same text agree, which is what the result cache assumes
+EXTRACTION_TEMPERATURE = float(os.environ.get("EXTRACTION_TEMPERATURE", "0"))
+EXTRACTION_TOP_P = float(os.environ["EXTRACTION_TOP_P"]) if os.environ.get("EXTRACTION_TOP_P") else None
+EXTRACTION_STREAMING = os.environ.get("EXTRACTION_STREAMING", "false").lower() == "true"
+# Bump when the prompt changes so cached extractions from the old prompt are not reused
+EXTRACTION_PROMPT_VERSION = "3"
 
-@event_source(data_class=SQSEvent)
-@logger.inject_lambda_context(log_event=True)
-def handler(event: SQSEvent, context):
-    # Log the event for debugging
-    logger.info(f"Received event:  {json.dumps(event)}")
-
-    for record in event.records:
-        logger.info(f"Received event: {record}")
-        event_body = json.loads(record.body)
-        logger.info(f"Received event body: {event_body}")
-
-        message_body = json.loads(record.body)
-        logger.info("Processing message:", message_body)
-
-        # Extract the text from the message
-        extracted_text = message_body.get('text')
-
-        # Use the Bedrock foundation model to manipulate the text
-        # Use the Bedrock foundation model to extract a grocery list
-        prompt = f"""You are a helpful assistant that extracts grocery items alongside their amount in kg and quantity if available, from text. 
-        If the text contains a grocery list, respond with ONLY the list of items alongside their amount in kg and count if available in the following format:
-        - Item 1, kg, count
-        - Item 2,kg, count
-        - Item 3,kg, count
-
-        If the text does NOT contain a grocery list, respond with: "No grocery list found."
-
-        Here is the text:
-        {extracted_text}"""
-        response = bedrock_client.invoke_model(
-
-            modelId="anthropic.claude-3-5-sonnet-20240620-v1:0",  # Use the correct model ID
-            body=json.dumps({
-                "messages": [
-                    {
-                        "role": "user",  # The role of the message (user or assistant)
-                        "content": prompt  # The actual prompt
-                    }
-                ],
-                "max_tokens": 300,  # Maximum number of tokens to generate
-                "temperature": 0.7,  # Controls randomness (0 = deterministic, 1 = creative)
-                "top_p": 0.9,  # Controls diversity (0 = narrow, 1 = diverse)
-                "anthropic_version": "bedrock-2023-05-31"  # Required for Claude 3 models
-            })
-        )
+
+def parse_grocery_list(model_output):
+    """
+    Validates the model's JSON answer. Anything around the JSON object, such as
+    a sentence the model added despite the instructions, is ignored.
+    """
+    start, end = model_output.find("{"), model_output.rfind("}")
+    if start == -1 or end < start:
+        raise ValueError(f"No JSON object in model output: {model_output[:200]}")
+    return GroceryList.model_validate_json(model_output[start:end + 1])
+
+
+def extraction_cache_salt():
+    """Everything besides the text that decides what an extraction returns."""
+    return (",".join(EXTRACTION_MODEL_IDS), f"temperature={EXTRACTION_TEMPERATURE}",
+            f"top_p={EXTRACTION_TOP_P}", EXTRACTION_PROMPT_VERSION)
+
+
+def extraction_request(lines, max_tokens):
+    request = {
+        "messages": [
+            {
+                "role": "user",  # The role of the message (user or assistant)
+                "content": build_prompt(lines)  # The actual prompt
+            }
+        ],
+        "max_tokens": max_tokens,  # Scaled with the number of lines that may be items
+        "temperature": EXTRACTION_TEMPERATURE,  # Controls randomness (0 = deterministic, 1 = creative)
+        "anthropic_version": "bedrock-2023-05-31"  # Required for Claude 3 models
+    }
+    if EXTRACTION_TOP_P is not None:
+        request["top_p"] = EXTRACTION_TOP_P  # Controls diversity (0 = narrow, 1 = diverse)
+    return json.dumps(request)
+
+
+def record_token_usage(usage):
+    recorder.count("BedrockInputTokens", usage.get('input_tokens', 0))
+    recorder.count("BedrockOutputTokens", usage.get('output_tokens', 0))
+
+
+def read_response_stream(response):
+    """
+    Assembles the text of a streamed Claude response. Returns the text and the
+    stop reason.
+    """
+    parts, stop_reason, started = [], None, time.perf_counter()
+    for event in response['body']:
+        chunk = json.loads(event['chunk']['bytes'])
+        if chunk['type'] == 'content_block_delta':
+            if not parts:
+                recorder.observe("BedrockFirstTokenDuration", (time.perf_counter() - started) * 1000)
+            parts.append(chunk['delta'].get('text', ''))
+        elif chunk['type'] == 'message_start':
+            record_token_usage(chunk.get('message', {}).get('usage', {}))
+        elif chunk['type'] == 'message_delta':
+            stop_reason = chunk['delta'].get('stop_reason')
+            record_token_usage(chunk.get('usage', {}))
+    return "".join(parts), stop_reason
+
+
+def invoke_model(model_id, body):
+    """Calls one model and returns its answer text and stop reason."""
+    recorder.count("BedrockCalls")
+    with recorder.timer("BedrockDuration"):
+        if EXTRACTION_STREAMING:
+            return read_response_stream(bedrock_client.invoke_model_with_response_stream(modelId=model_id, body=body))
+        response = bedrock_client.invoke_model(modelId=model_id, body=body)
         # Parse the response from Bedrock
         response_body = json.loads(response['body'].read())
-        manipulated_text = response_body['content'][0]['text']  # Extract the generated text
-
-        # Check if the response contains a grocery list or a "No grocery list found" message
-        if "No grocery list found." in manipulated_text:
-            print("No grocery list found in the extracted text.")
-        else:
-            print("Grocery List:\n", manipulated_text)
-
-        # Delete the message from the queue after processing
-        receipt_handle = record['receiptHandle']
-        sqs_client.delete_message(
-            QueueUrl=sqs_queue_url,
-            ReceiptHandle=receipt_handle
-        )
-
-    return {
-        'statusCode': 200,
-        'body': json.dumps('Message processing complete!')
-    }
+    record_token_usage(response_body.get('usage', {}))
+    return response_body['content'][0]['text'], response_body.get('stop_reason')
+
+
+def invoke_extraction(lines):
+    """
+    Asks the Bedrock foundation models to extract the grocery items in
+    `lines`, escalating along EXTRACTION_MODEL_IDS while the answer does not
+    validate. An answer cut off at the output budget is retried with a larger
+    budget, as the next model would be cut off at the same place.
+    """
+    max_tokens = output_budget(lines)
+    error = None
+    for model_id in EXTRACTION_MODEL_IDS:
+        text, stop_reason = invoke_model(model_id, extraction_request(lines, max_tokens))
+        if stop_reason == 'max_tokens':
+            recorder.count("ExtractionTruncated")
+            logger.warning("Extraction hit the output token budget", model_id=model_id, lines=len(lines),
+                           max_tokens=max_tokens)
+            max_tokens = escalated_budget(max_tokens)
+        try:
+            return parse_grocery_list(text)
+        except ValueError as e:
+            logger.warning("Extraction did not validate, trying the next model", model_id=model_id, error=str(e))
+            recorder.count("ExtractionEscalations")
+            error = e
+    raise error
+
+
+def extract_grocery_list(extracted_text):
+    """
+    Extracts a grocery list from the text. Noise is stripped first, and text
+    over the prompt budget is split into chunks that are extracted
+    concurrently and merged.
+    """
+    lines = clean_lines(extracted_text)
+    if not lines:
+        return GroceryList()
+    chunks = chunk_lines(lines)
+    recorder.count("ExtractionChunks", len(chunks))
+    if len(chunks) == 1:
+        return invoke_extraction(lines)
+
+    logger.info("Extracting long text in chunks", lines=len(lines), chunks=len(chunks))
+    with ThreadPoolExecutor(max_workers=min(chunk_concurrency, len(chunks))) as executor:
+        return merge_grocery_lists(executor.map(invoke_extraction, chunks))
+
+
+def order_owner(message_body):
+    """
+    The user an upload belongs to: an explicit userId in the message, else the
+    first segment of the object key (uploads are expected under <userId>/...).
+    """
+    if message_body.get('userId'):
+        return message_body['userId']
+    key = message_body.get('key') or ''
+    return key.split('/', 1)[0] if '/' in key else 'anonymous'
+
+
+def process_record(record: SQSRecord):
+    recorder.observe("MessageSize", len(record.body.encode("utf-8")), MetricUnit.Bytes)
+    message_body = json.loads(record.body)
+    logger.info("Processing message", message_id=record.message_id, key=message_body.get('key'))
+
+    # Extract the text from the message
+    extracted_text = message_body.get('text')
+
+    # The same list text always yields the same extraction, so repeats skip Bedrock
+    cache_key = text_hash(extracted_text, *extraction_cache_salt())
+    cached = result_cache.get("bedrock", cache_key)
+    if cached is not None:
+        grocery_list = GroceryList.model_validate_json(cached)
+    else:
+        grocery_list = extract_grocery_list(extracted_text)
+        result_cache.put("bedrock", cache_key, grocery_list.model_dump_json())
+
+    recorder.count("ExtractedItems", len(grocery_list.items))
+    if not grocery_list.items:
+        logger.info("No grocery list found in the extracted text", key=message_body.get('key'))
+        return
+
+    # The order id is derived from the upload and its extraction, so a retried
+    # message overwrites the same draft instead of creating another one
+    source = {"bucket": message_body.get('bucket'), "key": message_body.get('key')}
+    order_id = hashlib.sha256(f"{source['bucket']}/{source['key']}/{cache_key}".encode("utf-8")).hexdigest()[:16]
+    written = save_order_draft(orders_table, order_id, order_owner(message_body), grocery_list, source)
+    recorder.count("OrderDraftsSaved")
+    logger.info("Order draft saved", order_id=order_id, lines=len(grocery_list.items), items_written=written)
+
+
+def timed_process_record(record: SQSRecord):
+    with recorder.timer("RecordDuration"):
+        process_record(record)
+
+
+@publish_metrics
+@event_source(data_class=SQSEvent)
+@logger.inject_lambda_context
+def handler(event: SQSEvent, context):
+    """
+    Processes a batch of SQS records concurrently. Successful records are
+    deleted by the event source mapping; only the records listed in
+    batchItemFailures go back to the queue to be retried.
+    """
+    records = list(event.records)
+    batch_item_failures = []
+
+    with ThreadPoolExecutor(max_workers=max(1, min(extraction_concurrency, len(records)))) as executor:
+        futures = {executor.submit(timed_process_record, record): record for record in records}
+        for future in as_completed(futures):
+            record = futures[future]
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Failed to process message", message_id=record.message_id)
+                batch_item_failures.append({"itemIdentifier": record.message_id})
+
+    cache_counts = result_cache.flush_stats()
+    recorder.cache_lookups("BedrockCache", cache_counts.get("bedrock_hits", 0), cache_counts.get("bedrock_misses", 0))
+    recorder.count("RecordsReceived", len(records))
+    recorder.count("RecordsFailed", len(batch_item_failures))
+    logger.info("Batch processed", records=len(records), failed=len(batch_item_failures), result_cache=cache_counts)
+    return {"batchItemFailures": batch_item_failures}
@@ -0,0 +1,12 @@
+from pydantic import BaseModel, Field
+from typing import List, Optional
+
+
+class GroceryListItem(BaseModel):
+    item: str = Field(min_length=1)
+    kg: Optional[float] = Field(default=None, ge=0)
+    count: Optional[int] = Field(default=None, ge=0)
+
+
+class GroceryList(BaseModel):
+    items: List[GroceryListItem] = Field(default_factory=list)
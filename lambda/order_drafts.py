@@ -0,0 +1,69 @@
+"""
+Persists extracted grocery lists as draft orders in GroceryAppTable.
+
+An order is one header item and one item per grocery line, all under
+`PK=ORDER#<orderId>`:
+
+- the header and every line carry `GSI1PK=USER#<userId>`, so the `userOrders`
+  index returns a user's orders together with their lines;
+- every line carries `GSI2PK=ITEM#<normalized item>`, so the `orderProducts`
+  index finds the orders a grocery item appears in. Catalog matching can later
+  re-point a line at `PRODUCT#<productId>`.
+"""
+import re
+from datetime import datetime, timezone
+from decimal import Decimal
+
+from model.grocery_list import GroceryList
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _normalize_item(item: str) -> str:
+    return _WHITESPACE.sub(" ", item).strip().casefold()
+
+
+def order_items(order_id: str, user_id: str, grocery_list: GroceryList, source: dict) -> list:
+    created_date = datetime.now(timezone.utc).isoformat()
+    items = [{
+        "PK": f"ORDER#{order_id}",
+        "SK": "ORDER",
+        "GSI1PK": f"USER#{user_id}",
+        "GSI1SK": f"ORDER#{order_id}",
+        "orderId": order_id,
+        "userId": user_id,
+        "status": "DRAFT",
+        "itemCount": len(grocery_list.items),
+        "source": source,
+        "createdDate": created_date,
+    }]
+    for n, line in enumerate(grocery_list.items, start=1):
+        item = {
+            "PK": f"ORDER#{order_id}",
+            "SK": f"ITEM#{n:03d}",
+            "GSI1PK": f"USER#{user_id}",
+            "GSI1SK": f"ORDER#{order_id}#ITEM#{n:03d}",
+            "GSI2PK": f"ITEM#{_normalize_item(line.item)}",
+            "GSI2SK": f"ORDER#{order_id}",
+            "orderId": order_id,
+            "item": line.item,
+            "createdDate": created_date,
+        }
+        if line.kg is not None:
+            item["kg"] = Decimal(str(line.kg))
+        if line.count is not None:
+            item["count"] = line.count
+        items.append(item)
+    return items
+
+
+def save_order_draft(table, order_id: str, user_id: str, grocery_list: GroceryList, source: dict) -> int:
+    """
+    Writes the order header and its lines with one batch writer and returns the
+    number of items written.
+    """
+    items = order_items(order_id, user_id, grocery_list, source)
+    with table.batch_writer() as batch:
+        for item in items:
+            batch.put_item(Item=item)
+    return len(items)
@@ -0,0 +1,154 @@
+"""
+CloudWatch metrics of the grocery pipeline, in the embedded metric format.
+
+The handlers fan their work out to thread pools, while the Powertools metric
+set is shared by the whole process and not safe to add to from several threads.
+Measurements are therefore taken anywhere with `recorder.count`,
+`recorder.observe` and `recorder.timer`, and a handler decorated with
+`publish_metrics` moves them into Powertools from its own thread when it
+returns: counts as one summed value, durations and sizes as one value per
+observation so CloudWatch can compute percentiles. Powertools then prints them
+as one EMF document per invocation.
+
+The namespace comes from POWERTOOLS_METRICS_NAMESPACE and the `service`
+dimension from POWERTOOLS_SERVICE_NAME. `captured_metrics` collects what is
+published inside a block instead of printing it, for tests and benchmarks.
+"""
+import functools
+import io
+import json
+import threading
+import time
+from contextlib import contextmanager, redirect_stdout
+from typing import Dict, List
+
+from aws_lambda_powertools import Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+
+metrics = Metrics()
+
+
+class MetricsRecorder:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts: Dict[str, list] = {}
+        self._samples: Dict[str, list] = {}
+
+    def count(self, name: str, value: float = 1, unit: MetricUnit = MetricUnit.Count) -> None:
+        with self._lock:
+            total = self._counts.setdefault(name, [unit, 0])
+            total[1] += value
+
+    def observe(self, name: str, value: float, unit: MetricUnit = MetricUnit.Milliseconds) -> None:
+        with self._lock:
+            self._samples.setdefault(name, [unit, []])[1].append(value)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Observes the duration of the block in milliseconds, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - started) * 1000)
+
+    def cache_lookups(self, name: str, hits: int, misses: int) -> None:
+        """Counts cache hits and misses and adds the invocation's hit rate."""
+        if hits + misses == 0:
+            return
+        self.count(f"{name}Hits", hits)
+        self.count(f"{name}Misses", misses)
+        self.observe(f"{name}HitRate", 100 * hits / (hits + misses), MetricUnit.Percent)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._counts, self._samples = {}, {}
+
+    def publish(self) -> None:
+        """Adds everything recorded so far to the Powertools metric set and starts over."""
+        with self._lock:
+            counts, self._counts = self._counts, {}
+            samples, self._samples = self._samples, {}
+        for name, (unit, value) in counts.items():
+            metrics.add_metric(name=name, unit=unit, value=value)
+        for name, (unit, values) in samples.items():
+            for value in values:
+                metrics.add_metric(name=name, unit=unit, value=value)
+
+
+recorder = MetricsRecorder()
+
+
+def publish_metrics(handler):
+    """
+    Decorates a Lambda handler so the metrics it recorded are flushed as EMF
+    when it returns or raises.
+    """
+    @metrics.log_metrics
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            recorder.publish()
+
+    return wrapper
+
+
+def read_emf(output: str) -> List[dict]:
+    """The EMF documents among the lines of `output`."""
+    documents = []
+    for line in output.splitlines():
+        if not line.startswith("{"):
+            continue
+        try:
+            document = json.loads(line)
+        except ValueError:
+            continue
+        if isinstance(document, dict) and "_aws" in document:
+            documents.append(document)
+    return documents
+
+
+class CapturedMetrics:
+
+    def __init__(self):
+        self.documents: List[dict] = []
+
+    def values(self, name: str) -> List[float]:
+        found = []
+        for document in self.documents:
+            value = document.get(name)
+            if value is not None:
+                found.extend(value if isinstance(value, list) else [value])
+        return found
+
+    def total(self, name: str) -> float:
+        return sum(self.values(name))
+
+    def units(self) -> Dict[str, str]:
+        return {metric["Name"]: metric["Unit"] for document in self.documents
+                for directive in document["_aws"]["CloudWatchMetrics"] for metric in directive["Metrics"]}
+
+    def counts(self) -> Dict[str, float]:
+        """The total of every Count metric."""
+        return {name: self.total(name) for name, unit in sorted(self.units().items()) if unit == "Count"}
+
+    def dimensions(self, name: str) -> List[dict]:
+        """The dimension values of each document that holds `name`."""
+        return [{key: document[key] for directive in document["_aws"]["CloudWatchMetrics"]
+                 for dimension_set in directive["Dimensions"] for key in dimension_set}
+                for document in self.documents if name in document]
+
+
+@contextmanager
+def captured_metrics():
+    """Collects the EMF documents flushed inside the block instead of printing them."""
+    captured = CapturedMetrics()
+    output = io.StringIO()
+    try:
+        with redirect_stdout(output):
+            yield captured
+    finally:
+        captured.documents.extend(read_emf(output.getvalue()))
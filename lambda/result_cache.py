@@ -0,0 +1,108 @@
+"""
+Result cache for the paid steps of the grocery list pipeline.
+
+Textract output is cached under the S3 object's ETag and Bedrock extractions
+under a hash of the normalized input text, so an upload that was seen before
+skips both services. Entries live in GroceryAppTable under their own partition
+keys (`CACHE#<namespace>#<key>`) and expire through the table's `expiresAt` TTL
+attribute. Hit and miss counts are kept per container and added to a single
+stats item once per invocation.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Optional
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get("RESULT_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))
+STATS_PK = "CACHE#STATS"
+# Keep well under the 400 KB DynamoDB item limit
+MAX_VALUE_BYTES = 350 * 1024
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def text_hash(text: str, *salt: str) -> str:
+    """
+    Hashes text after case-folding and collapsing whitespace, so the same list
+    with different line breaks or spacing maps to one key. `salt` is mixed in
+    to keep results from different models or prompts apart.
+    """
+    normalized = _WHITESPACE.sub(" ", text).strip().casefold()
+    return hashlib.sha256("\n".join((*salt, normalized)).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+
+    def __init__(self, table_name: Optional[str] = None, ttl_seconds: int = RESULT_CACHE_TTL_SECONDS, table=None):
+        self.table_name = table_name or os.environ.get("ECOMMERCE_TABLE_NAME")
+        self.ttl_seconds = ttl_seconds
+        self._table = table
+        self._lock = threading.Lock()
+        self.stats = Counter()
+        self._unflushed = Counter()
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = boto3.resource("dynamodb").Table(self.table_name)
+        return self._table
+
+    def _record(self, namespace: str, outcome: str) -> None:
+        with self._lock:
+            self.stats[f"{namespace}_{outcome}"] += 1
+            self._unflushed[f"{namespace}_{outcome}"] += 1
+
+    def get(self, namespace: str, key: str) -> Optional[str]:
+        try:
+            item = self.table.get_item(Key={"PK": f"CACHE#{namespace}#{key}", "SK": "RESULT"}).get("Item")
+        except (BotoCoreError, ClientError) as e:
+            # The cache is an optimization, a failing read is treated as a miss
+            print(f"Result cache read failed: {e}")
+            item = None
+        # DynamoDB deletes expired items lazily, so check the TTL ourselves
+        if item is None or int(item["expiresAt"]) < time.time():
+            self._record(namespace, "misses")
+            return None
+        self._record(namespace, "hits")
+        return item["value"]
+
+    def put(self, namespace: str, key: str, value: str) -> None:
+        if len(value.encode("utf-8")) > MAX_VALUE_BYTES:
+            return
+        try:
+            self.table.put_item(Item={
+                "PK": f"CACHE#{namespace}#{key}",
+                "SK": "RESULT",
+                "value": value,
+                "expiresAt": int(time.time()) + self.ttl_seconds,
+            })
+        except (BotoCoreError, ClientError) as e:
+            print(f"Result cache write failed: {e}")
+
+    def flush_stats(self) -> dict:
+        """
+        Adds the hit and miss counts since the last flush to the stats item and
+        returns them.
+        """
+        with self._lock:
+            counts, self._unflushed = self._unflushed, Counter()
+        if counts:
+            try:
+                self.table.update_item(
+                    Key={"PK": STATS_PK, "SK": "TOTALS"},
+                    UpdateExpression="ADD " + ", ".join(f"#{name} :{name}" for name in counts),
+                    ExpressionAttributeNames={f"#{name}": name for name in counts},
+                    ExpressionAttributeValues={f":{name}": count for name, count in counts.items()},
+                )
+            except (BotoCoreError, ClientError) as e:
+                print(f"Result cache stats update failed: {e}")
+        return dict(counts)
+
+
+result_cache = ResultCache()
@@ -0,0 +1,99 @@
+"""
+Per-conversation memo for the agent's action group.
+
+Product names resolved to Stripe ids and prices, and the cart last turned into
+a payment link, are kept in one session attribute of the Bedrock agent
+session. Bedrock sends the session attributes back with every later request of
+the same session, so follow-up turns, such as changing the quantity of a
+product already discussed, read them from the event instead of calling Stripe
+or DynamoDB, whichever Lambda container serves them.
+
+Entries expire after SESSION_MEMO_TTL_SECONDS so a price change reaches an
+ongoing conversation, and the oldest products are dropped when the attribute
+would outgrow SESSION_MEMO_MAX_BYTES.
+"""
+import json
+import os
+import time
+from typing import Dict, Optional
+
+SESSION_MEMO_ATTRIBUTE = "groceryMemo"
+SESSION_MEMO_TTL_SECONDS = int(os.environ.get("SESSION_MEMO_TTL_SECONDS", "900"))
+SESSION_MEMO_MAX_BYTES = int(os.environ.get("SESSION_MEMO_MAX_BYTES", "8192"))
+SESSION_MEMO_VERSION = 1
+
+
+def _key(product_name: str) -> str:
+    return " ".join(product_name.split()).casefold()
+
+
+class SessionMemo:
+
+    def __init__(self, products: Optional[Dict[str, dict]] = None, cart: Optional[dict] = None,
+                 ttl_seconds: int = SESSION_MEMO_TTL_SECONDS):
+        self.products = products or {}
+        self.cart = cart
+        self.ttl_seconds = ttl_seconds
+        self.changed = False
+
+    @classmethod
+    def from_attributes(cls, session_attributes: Optional[dict]) -> "SessionMemo":
+        """Reads the memo from the event's session attributes; a missing or unreadable memo starts empty."""
+        raw = (session_attributes or {}).get(SESSION_MEMO_ATTRIBUTE)
+        try:
+            memo = json.loads(raw) if raw else {}
+        except ValueError:
+            memo = {}
+        if memo.get("v") != SESSION_MEMO_VERSION:
+            return cls()
+        return cls(products=memo.get("products"), cart=memo.get("cart"))
+
+    def _fresh(self, stored_at: int) -> bool:
+        return time.time() - stored_at < self.ttl_seconds
+
+    def product(self, product_name: str) -> Optional[dict]:
+        entry = self.products.get(_key(product_name))
+        if entry is None or not self._fresh(entry["at"]):
+            return None
+        return entry["entry"]
+
+    def remember(self, product_name: str, entry: dict) -> None:
+        self.products[_key(product_name)] = {"entry": entry, "at": int(time.time())}
+        self.changed = True
+
+    def forget(self, product_name: str) -> None:
+        if self.products.pop(_key(product_name), None) is not None:
+            self.changed = True
+        if self.cart is not None:
+            self.cart = None
+            self.changed = True
+
+    def cart_link(self, quantities: Dict[str, int]) -> Optional[str]:
+        """The payment link created earlier in the session for exactly these price quantities."""
+        if self.cart is None or not self._fresh(self.cart["at"]) or self.cart["items"] != quantities:
+            return None
+        return self.cart["link"]
+
+    def set_cart(self, quantities: Dict[str, int], link: str) -> None:
+        self.cart = {"items": dict(quantities), "link": link, "at": int(time.time())}
+        self.changed = True
+
+    def to_attributes(self, session_attributes: Optional[dict]) -> dict:
+        """
+        Returns `session_attributes` with the memo written into it. The
+        oldest products are dropped while the memo is over the size limit.
+        """
+        products = sorted(self.products.items(), key=lambda item: item[1]["at"])
+        cart = self.cart
+        while True:
+            raw = json.dumps({"v": SESSION_MEMO_VERSION, "products": dict(products), "cart": cart},
+                             separators=(",", ":"))
+            if len(raw.encode("utf-8")) <= SESSION_MEMO_MAX_BYTES:
+                break
+            if products:
+                products.pop(0)
+            elif cart is not None:
+                cart = None
+            else:
+                break
+        return {**(session_attributes or {}), SESSION_MEMO_ATTRIBUTE: raw}
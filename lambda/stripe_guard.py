@@ -0,0 +1,213 @@
+"""
+Guards around the Stripe calls of the agent action group.
+
+Every payment link turn calls Stripe, and without a bound a slow Stripe holds
+each agent turn until the Lambda times out. Two things keep the agent
+responsive:
+
+- `configure` gives the Stripe client an explicit timeout
+  (STRIPE_TIMEOUT_SECONDS) and a bounded number of network retries;
+- `CircuitBreaker` fails every call at once with StripeUnavailable after
+  STRIPE_BREAKER_FAILURES consecutive connection, rate limit or server errors.
+  After STRIPE_BREAKER_RESET_SECONDS it lets a single call through, and
+  closes again when that call succeeds.
+
+Cold containers started together would each rebuild the same data from
+Stripe. `SharedLookup` keeps the result of such a read in GroceryAppTable for
+a few seconds: the first container to miss takes a lease item and calls
+Stripe, and the others wait briefly for its result instead of calling Stripe
+themselves.
+
+Errors about the request itself, such as an unknown price, mean Stripe is up
+and do not count as failures.
+"""
+import os
+import threading
+import time
+from time import monotonic
+from typing import Callable, Optional, Tuple
+
+import boto3
+import stripe
+from botocore.exceptions import BotoCoreError, ClientError
+
+from pipeline_metrics import recorder
+
+STRIPE_TIMEOUT_SECONDS = float(os.environ.get("STRIPE_TIMEOUT_SECONDS", "5"))
+STRIPE_MAX_NETWORK_RETRIES = int(os.environ.get("STRIPE_MAX_NETWORK_RETRIES", "1"))
+STRIPE_BREAKER_FAILURES = int(os.environ.get("STRIPE_BREAKER_FAILURES", "3"))
+STRIPE_BREAKER_RESET_SECONDS = float(os.environ.get("STRIPE_BREAKER_RESET_SECONDS", "30"))
+# Shared results must expire well within the lookback of the catalog change
+# feed, so a container reading one still sees the changes made since it was built
+STRIPE_SHARED_TTL_SECONDS = int(os.environ.get("STRIPE_SHARED_TTL_SECONDS", "30"))
+STRIPE_SHARED_WAIT_SECONDS = float(os.environ.get("STRIPE_SHARED_WAIT_SECONDS", "3"))
+# Keep well under the 400 KB DynamoDB item limit
+MAX_SHARED_VALUE_BYTES = 350 * 1024
+
+# Timeouts surface as APIConnectionError
+TRANSIENT_ERRORS = (stripe.error.APIConnectionError, stripe.error.RateLimitError, stripe.error.APIError)
+
+
+def configure() -> None:
+    stripe.default_http_client = stripe.new_default_http_client(timeout=STRIPE_TIMEOUT_SECONDS)
+    stripe.max_network_retries = STRIPE_MAX_NETWORK_RETRIES
+
+
+class StripeUnavailable(Exception):
+    """Raised instead of calling Stripe while the circuit breaker is open."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Stripe is unavailable, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold: int = STRIPE_BREAKER_FAILURES,
+                 reset_seconds: float = STRIPE_BREAKER_RESET_SECONDS, clock: Callable[[], float] = monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._clock = clock
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "half-open" if self._clock() - self._opened_at >= self.reset_seconds else "open"
+
+    def _admit(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            waited = self._clock() - self._opened_at
+            if waited < self.reset_seconds or self._probing:
+                recorder.count("StripeCallsRejected")
+                raise StripeUnavailable(max(self.reset_seconds - waited, 1.0))
+            # Let this one call probe whether Stripe recovered
+            self._probing = True
+
+    def _record(self, failed: bool) -> None:
+        with self._lock:
+            probing, self._probing = self._probing, False
+            if not failed:
+                self._failures, self._opened_at = 0, None
+                return
+            self._failures += 1
+            if probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or probing:
+                    recorder.count("StripeCircuitOpened")
+                self._opened_at = self._clock()
+
+    def call(self, request: Callable, *args, **kwargs):
+        self._admit()
+        try:
+            result = request(*args, **kwargs)
+        except TRANSIENT_ERRORS:
+            self._record(failed=True)
+            raise
+        except BaseException:
+            self._record(failed=False)
+            raise
+        self._record(failed=False)
+        return result
+
+
+stripe_breaker = CircuitBreaker()
+
+
+class SharedLookup:
+    """
+    Shares the result of a Stripe read between containers for `ttl_seconds`.
+
+    The result is stored under `PK=STRIPE_SHARED#<key>, SK=RESULT` and the
+    lease under `SK=LEASE`, both expiring through the table's `expiresAt` TTL
+    attribute. The table is only an optimization: when it cannot be read or
+    written, or the lease holder takes longer than `wait_seconds`, the caller
+    reads Stripe itself.
+    """
+
+    def __init__(self, table=None, ttl_seconds: int = STRIPE_SHARED_TTL_SECONDS,
+                 wait_seconds: float = STRIPE_SHARED_WAIT_SECONDS, poll_seconds: float = 0.2,
+                 clock: Callable[[], float] = time.time, sleep: Callable[[float], None] = time.sleep):
+        self._table = table
+        self.ttl_seconds = ttl_seconds
+        self.wait_seconds = wait_seconds
+        self.poll_seconds = poll_seconds
+        self._clock = clock
+        self._sleep = sleep
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = boto3.resource("dynamodb").Table(os.environ.get("ECOMMERCE_TABLE_NAME"))
+        return self._table
+
+    def _read(self, key: str) -> Optional[dict]:
+        try:
+            item = self.table.get_item(Key={"PK": f"STRIPE_SHARED#{key}", "SK": "RESULT"},
+                                       ConsistentRead=True).get("Item")
+        except (BotoCoreError, ClientError) as e:
+            print(f"Shared Stripe result read failed: {e}")
+            return None
+        # DynamoDB deletes expired items lazily, so check the TTL ourselves
+        if item is None or float(item["expiresAt"]) < self._clock():
+            return None
+        return item
+
+    def _take_lease(self, key: str) -> bool:
+        """Whether this container should call Stripe, i.e. no other container holds the lease."""
+        now = self._clock()
+        try:
+            self.table.put_item(
+                Item={"PK": f"STRIPE_SHARED#{key}", "SK": "LEASE", "expiresAt": int(now + self.wait_seconds) + 1},
+                ConditionExpression="attribute_not_exists(PK) OR expiresAt < :now",
+                ExpressionAttributeValues={":now": int(now)},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                return False
+            print(f"Shared Stripe lease failed: {e}")
+        except BotoCoreError as e:
+            print(f"Shared Stripe lease failed: {e}")
+        return True
+
+    def _publish(self, key: str, value: str, built_at: float) -> None:
+        if len(value.encode("utf-8")) > MAX_SHARED_VALUE_BYTES:
+            print(f"Shared Stripe result {key} is too large to share")
+            return
+        try:
+            self.table.put_item(Item={
+                "PK": f"STRIPE_SHARED#{key}",
+                "SK": "RESULT",
+                "value": value,
+                "builtAt": str(built_at),
+                "expiresAt": int(built_at) + self.ttl_seconds,
+            })
+        except (BotoCoreError, ClientError) as e:
+            print(f"Shared Stripe result write failed: {e}")
+
+    def get(self, key: str, read: Callable[[], str]) -> Tuple[str, float]:
+        """
+        Returns the shared result for `key` and the epoch time it was read from
+        Stripe at, calling `read` and sharing what it returns when no other
+        container did so recently.
+        """
+        item = self._read(key)
+        if item is None and not self._take_lease(key):
+            deadline = self._clock() + self.wait_seconds
+            while item is None and self._clock() < deadline:
+                self._sleep(self.poll_seconds)
+                item = self._read(key)
+        if item is not None:
+            recorder.count("StripeSharedHits")
+            return item["value"], float(item["builtAt"])
+
+        recorder.count("StripeSharedMisses")
+        built_at = self._clock()
+        value = read()
+        self._publish(key, value, built_at)
+        return value, built_at
@@ -0,0 +1,80 @@
+"""
+Assembly of Textract LINE blocks into the text sent to Bedrock.
+
+Responses from `DetectDocumentText` and every page of
+`GetDocumentTextDetection` are read in one pass: line texts are collected in a
+list and joined once, so a document with tens of thousands of blocks costs
+linear time. Lines whose confidence is below the threshold are dropped, which
+keeps smudges, stamps and background noise out of the prompt.
+
+When `keep_layout` is set the confidence, page and bounding box of every kept
+line are stored alongside the text in compact columns (typed arrays) rather
+than one dict per line.
+"""
+import os
+from array import array
+from dataclasses import dataclass, field
+from typing import Iterable, List, Optional, Tuple
+
+# Textract confidences range from 0 to 100
+TEXTRACT_MIN_CONFIDENCE = float(os.environ.get("TEXTRACT_MIN_CONFIDENCE", "40"))
+
+
+@dataclass
+class TextractLines:
+    """
+    Kept lines in reading order. `confidence`, `page` and `bbox` are empty
+    unless the lines were read with `keep_layout`; `bbox` holds four floats
+    (left, top, width, height) per line.
+    """
+    lines: List[str] = field(default_factory=list)
+    confidence: array = field(default_factory=lambda: array("f"))
+    page: array = field(default_factory=lambda: array("I"))
+    bbox: array = field(default_factory=lambda: array("f"))
+    dropped: int = 0
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    @property
+    def text(self) -> str:
+        return "".join(line + "\n" for line in self.lines)
+
+    def box(self, index: int) -> Tuple[float, float, float, float]:
+        return tuple(self.bbox[index * 4:index * 4 + 4])
+
+    def to_columns(self) -> dict:
+        return {
+            "lines": self.lines,
+            "confidence": [round(value, 2) for value in self.confidence],
+            "page": self.page.tolist(),
+            "bbox": [round(value, 4) for value in self.bbox],
+        }
+
+
+def read_lines(pages: Iterable[List[dict]], min_confidence: Optional[float] = None,
+               keep_layout: bool = False) -> TextractLines:
+    """
+    Reads the LINE blocks of one or more block lists, e.g. the `Blocks` of each
+    result page of an asynchronous job.
+    """
+    threshold = TEXTRACT_MIN_CONFIDENCE if min_confidence is None else min_confidence
+    result = TextractLines()
+    # Local bindings keep the per-block work down on large documents
+    lines_append = result.lines.append
+    for blocks in pages:
+        for block in blocks:
+            if block["BlockType"] != "LINE":
+                continue
+            confidence = block.get("Confidence", 100.0)
+            if confidence < threshold:
+                result.dropped += 1
+                continue
+            lines_append(block["Text"])
+            if keep_layout:
+                box = block.get("Geometry", {}).get("BoundingBox", {})
+                result.confidence.append(confidence)
+                result.page.append(block.get("Page", 1))
+                result.bbox.extend((box.get("Left", 0.0), box.get("Top", 0.0),
+                                    box.get("Width", 0.0), box.get("Height", 0.0)))
+    return result
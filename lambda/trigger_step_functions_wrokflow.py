@@ -1,135 +1,379 @@
+import hashlib
 import json
 import boto3
 import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import unquote_plus
+from aws_lambda_powertools.metrics import MetricUnit
+from botocore.config import Config
+from botocore.exceptions import ClientError
 
+from pipeline_metrics import publish_metrics, recorder
+from result_cache import result_cache
+from textract_lines import read_lines
 
-def handler(event, context):
-    # Log the event for debugging
-    print("Received event: " + json.dumps(event))
+# Clients are created once per container and reused by every invocation, so
+# warm invocations skip client construction and reuse pooled keep-alive
+# connections instead of opening a new TLS connection per call.
+client_config = Config(
+    max_pool_connections=int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", "20")),
+    retries={"mode": "adaptive", "max_attempts": 5},
+    tcp_keepalive=True,
+    connect_timeout=5,
+    read_timeout=30,
+)
+textract = boto3.client('textract', region_name='us-east-1', config=client_config)
+sqs_client = boto3.client('sqs', config=client_config)
+s3_client = boto3.client('s3', config=client_config)
 
-    # Initialize Textract, S3, and SQS clients
-    textract = boto3.client('textract',region_name='us-east-1')
-    s3_client = boto3.client('s3',region_name='us-east-1')
-    sqs_client = boto3.client('sqs')
+# Records of one S3 event are extracted concurrently, bounded by this many workers
+record_concurrency = int(os.environ.get("RECORD_CONCURRENCY", "10"))
+# SendMessageBatch accepts up to 10 entries and 256 KB of payload per call
+SQS_BATCH_SIZE = 10
+SQS_BATCH_MAX_BYTES = 256 * 1024
 
-    # Get the SQS queue URL from the environment variable
-    sqs_queue_url = os.environ["SQS_QUEUE_URL"]
+# Images up to this size are read once by the function and sent to Textract
+# inline, the rest is read by Textract from S3
+TEXTRACT_BYTES_MAX_BYTES = int(os.environ.get("TEXTRACT_BYTES_MAX_BYTES", str(5 * 1024 * 1024)))
+# The synchronous Textract API accepts documents up to 10 MB
+TEXTRACT_SYNC_MAX_BYTES = 10 * 1024 * 1024
+IMAGE_EXTENSIONS = {"jpg", "jpeg", "png"}
+# Possibly multi-page, so always detected with the asynchronous API
+DOCUMENT_EXTENSIONS = {"pdf", "tif", "tiff"}
 
-    for record in event['Records']:
-        bucket_name = record['s3']['bucket']['name']
-        object_key = unquote_plus(record['s3']['object']['key'])  # Decode the object key
 
-        print(f"Processing file from bucket: {bucket_name}, key: {object_key}")
+def process_record(record):
+    """
+    Extracts the text of one uploaded object. Returns the message body to send
+    to the SQS extraction queue, or None when there is nothing to send yet.
+    """
+    bucket_name = record['s3']['bucket']['name']
+    object_key = unquote_plus(record['s3']['object']['key'])  # Decode the object key
 
-        # Get the file type
-        file_extension = object_key.split('.')[-1].lower()
+    print(f"Processing file from bucket: {bucket_name}, key: {object_key}")
+    recorder.observe("ObjectSize", record['s3']['object'].get('size', 0), MetricUnit.Bytes)
 
-        # Handle PDF files
-        if file_extension == 'pdf':
-            print("PDF file detected. Converting to JPEG...")
-            jpeg_key = convert_pdf_to_jpeg(s3_client, bucket_name, object_key)
-            if not jpeg_key:
-                print("Failed to convert PDF to JPEG.")
-                continue
-            object_key = jpeg_key  # Update the object key to the converted JPEG file
+    # Get the file type. The bucket notification is filtered to these types
+    # already, this also keeps anything else written to the bucket out
+    file_extension = object_key.split('.')[-1].lower()
+    if file_extension not in IMAGE_EXTENSIONS | DOCUMENT_EXTENSIONS:
+        print(f"Skipping {object_key}, not an image or document")
+        return None
+    size = record['s3']['object'].get('size')
+    if size == 0:
+        print(f"Skipping {object_key}, the object is empty")
+        return None
+
+    # Uploads with a known ETag reuse the text Textract returned last time
+    etag = record['s3']['object'].get('eTag')
+    detected_text = result_cache.get("textract", etag) if etag else None
+    if detected_text is not None:
+        print(f"Reusing cached text for ETag {etag}")
+    else:
+        # Multi-page documents and files too large for the synchronous API go
+        # through the asynchronous Textract API; the text is sent on by
+        # textract_completion_handler once Textract publishes the job
+        # completion to SNS.
+        if file_extension in DOCUMENT_EXTENSIONS or (size or 0) > TEXTRACT_SYNC_MAX_BYTES:
+            print("Document detected. Starting asynchronous text detection...")
+            job_id = start_text_detection(textract, bucket_name, object_key, etag)
+            if not job_id:
+                raise RuntimeError(f"Failed to start text detection for {object_key}")
+            return None
 
         # Extract text using Textract
-        detected_text = extract_text_from_file(textract, bucket_name, object_key)
+        if size is not None and size <= TEXTRACT_BYTES_MAX_BYTES:
+            document = read_object(bucket_name, object_key, size, etag)
+            if document is None:
+                return None
+            detected_text = extract_text_from_bytes(textract, document, object_key)
+        else:
+            detected_text = extract_text_from_file(textract, bucket_name, object_key)
         if not detected_text:
             print("No text detected in the file.")
-            continue
+            return None
+        if etag:
+            result_cache.put("textract", etag, detected_text)
 
-        print("Detected Text:\n", detected_text)
+    print("Detected Text:\n", detected_text)
+    return {
+        "text": detected_text,
+        "bucket": bucket_name,
+        "key": object_key
+    }
+
+
+def send_messages(sqs_queue_url, messages):
+    """
+    Sends message bodies to the queue with SendMessageBatch, at most 10 entries
+    and 256 KB per call. Returns the messages SQS did not accept as
+    `{"key", "error"}` dicts.
+    """
+    failures = []
+    batch, batch_bytes = [], 0
+
+    def flush():
+        # Entry ids only need to be unique within a call, so the position is used
+        # and mapped back to the object key when SQS rejects an entry
+        entries = [{'Id': str(i), 'MessageBody': body} for i, (_, body) in enumerate(batch)]
+        recorder.count("SqsCalls")
+        try:
+            with recorder.timer("SqsSendDuration"):
+                response = sqs_client.send_message_batch(QueueUrl=sqs_queue_url, Entries=entries)
+        except Exception as e:
+            failures.extend({"key": key, "error": str(e)} for key, _ in batch)
+        else:
+            failures.extend({"key": batch[int(entry['Id'])][0], "error": entry.get('Message', entry['Code'])}
+                            for entry in response.get('Failed', []))
+
+    for message in messages:
+        body = json.dumps(message)
+        size = len(body.encode("utf-8"))
+        recorder.observe("MessageSize", size, MetricUnit.Bytes)
+        if batch and (len(batch) == SQS_BATCH_SIZE or batch_bytes + size > SQS_BATCH_MAX_BYTES):
+            flush()
+            batch, batch_bytes = [], 0
+        batch.append((message['key'], body))
+        batch_bytes += size
+    if batch:
+        flush()
+    recorder.count("MessagesSent", len(messages) - len(failures))
+    return failures
 
-        # Send the detected text to the SQS queue
-        sqs_client.send_message(
-            QueueUrl=sqs_queue_url,
-            MessageBody=json.dumps({
-                "text": detected_text,
-                "bucket": bucket_name,
-                "key": object_key
-            })
-        )
 
+class RecordsFailed(Exception):
+    """
+    Raised after the other records of an event were handled, so Lambda retries
+    the asynchronous invocation and then hands it to the on-failure
+    destination. Records that succeeded are read from the result cache on the
+    retry rather than extracted again.
+    """
+
+    def __init__(self, failures, total):
+        super().__init__(f"{len(failures)} of {total} records failed: {json.dumps(failures)}")
+        self.failures = failures
+
+
+def record_cache_stats():
+    counts = result_cache.flush_stats()
+    print(f"Result cache counts: {counts}")
+    recorder.cache_lookups("TextractCache", counts.get("textract_hits", 0), counts.get("textract_misses", 0))
+
+
+def timed_process_record(record):
+    with recorder.timer("RecordDuration"):
+        return process_record(record)
+
+
+@publish_metrics
+def handler(event, context):
+    # Log the event for debugging
+    print("Received event: " + json.dumps(event))
+
+    # Get the SQS queue URL from the environment variable
+    sqs_queue_url = os.environ["SQS_QUEUE_URL"]
+
+    # Records are independent, so they are extracted concurrently and the
+    # invocation takes about as long as its slowest object. A failing record
+    # does not hold back the others, and fails the invocation once they are done.
+    records = event['Records']
+    messages, failures = [], []
+    with ThreadPoolExecutor(max_workers=max(1, min(record_concurrency, len(records)))) as executor:
+        futures = {executor.submit(timed_process_record, record): record for record in records}
+        for future in as_completed(futures):
+            object_key = unquote_plus(futures[future]['s3']['object']['key'])
+            try:
+                message = future.result()
+            except Exception as e:
+                print(f"Error processing {object_key}: {e}")
+                failures.append({"key": object_key, "error": str(e)})
+                continue
+            if message:
+                messages.append(message)
+
+    # Send the detected text to the SQS queue
+    failures.extend(send_messages(sqs_queue_url, messages))
+
+    record_cache_stats()
+    recorder.count("RecordsReceived", len(records))
+    recorder.count("RecordsFailed", len(failures))
+    if failures:
+        # S3 ignores the response of an asynchronous invocation
+        raise RecordsFailed(failures, len(records))
     return {
         'statusCode': 200,
-        'body': json.dumps('Text extraction and SQS sending complete!')
+        'body': json.dumps('Text extraction and SQS sending complete!'),
     }
 
 
-def convert_pdf_to_jpeg(s3_client, bucket_name, pdf_key):
+def read_object(bucket_name, object_key, size, etag=None):
     """
-    Converts a PDF file to JPEG using Amazon Textract.
-    Returns the S3 key of the converted JPEG file.
-
+    Reads a small object in one ranged GET of the size given by the
+    notification. The ETag pins the read to the notified version of the object;
+    returns None when the object was replaced since, as its new version has a
+    notification of its own.
     """
+    kwargs = {'IfMatch': etag} if etag else {}
+    recorder.count("S3Calls")
+    try:
+        response = s3_client.get_object(Bucket=bucket_name, Key=object_key, Range=f"bytes=0-{size - 1}", **kwargs)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('PreconditionFailed', 'NoSuchKey'):
+            raise
+        print(f"Skipping {object_key}, it was replaced or deleted after the upload")
+        return None
+    return response['Body'].read()
+
 
+def start_text_detection(textract, bucket_name, document_key, etag=None):
+    """
+    Starts an asynchronous Textract text detection job for a document and
+    returns the job id without waiting for it. Textract notifies the SNS topic in
+    TEXTRACT_SNS_TOPIC_ARN when the job finishes. The ETag is passed along as
+    the job tag so the completion handler can cache the result.
+    """
     print(f"Bucket name here is {bucket_name}")
-    print(f"Keys here is {pdf_key}")
+    print(f"Keys here is {document_key}")
     try:
-        # Use Textract to convert PDF to JPEG
-        textract = boto3.client('textract',region_name='us-east-1')
+        # The same object version always maps to the same token, so a retried
+        # S3 notification does not start a second job.
+        token = hashlib.sha256(f"{bucket_name}/{document_key}/{etag}".encode("utf-8")).hexdigest()[:64]
+        kwargs = {'JobTag': etag} if etag else {}
+        recorder.count("TextractCalls")
         response = textract.start_document_text_detection(
             DocumentLocation={
                 'S3Object': {
                     'Bucket': bucket_name,
-                    'Name': pdf_key
+                    'Name': document_key
                 }
             },
-            OutputConfig={
-                'S3Bucket': bucket_name,
-                'S3Prefix': 'converted/'
-            }
+            ClientRequestToken=token,
+            NotificationChannel={
+                'SNSTopicArn': os.environ["TEXTRACT_SNS_TOPIC_ARN"],
+                'RoleArn': os.environ["TEXTRACT_ROLE_ARN"]
+            },
+            **kwargs
         )
-
-        # Wait for the conversion to complete
         job_id = response['JobId']
-        print(f"Started Textract job for PDF conversion: {job_id}")
+        recorder.count("TextractJobsStarted")
+        print(f"Started Textract job for document: {job_id}")
+        return job_id
 
-        # Poll for job completion (simplified for demonstration)
-        while True:
-            status = textract.get_document_text_detection(JobId=job_id)
-            if status['JobStatus'] in ['SUCCEEDED', 'FAILED']:
-                break
+    except Exception as e:
+        print(f"Error starting text detection for document: {e}")
+        return None
 
-        if status['JobStatus'] == 'FAILED':
-            print("PDF to JPEG conversion failed.")
-            return None
 
-        # Get the output JPEG file key
-        jpeg_key = status['DocumentLocation']['S3Object']['Name']
-        print(f"PDF converted to JPEG: {jpeg_key}")
-        return jpeg_key
+@publish_metrics
+def textract_completion_handler(event, context):
+    """
+    Receives Textract job completion notifications from SNS, reads the
+    paginated results of each successful job and sends the text to the SQS
+    extraction queue.
+    """
+    print("Received event: " + json.dumps(event))
 
-    except Exception as e:
-        print(f"Error converting PDF to JPEG: {e}")
-        return None
+    sqs_queue_url = os.environ["SQS_QUEUE_URL"]
+
+    messages = []
+    for record in event['Records']:
+        message = json.loads(record['Sns']['Message'])
+        job_id = message['JobId']
+        bucket_name = message['DocumentLocation']['S3Bucket']
+        object_key = message['DocumentLocation']['S3ObjectName']
+
+        if message['Status'] != 'SUCCEEDED':
+            print(f"Textract job {job_id} for {object_key} finished with status {message['Status']}")
+            recorder.count("TextractJobsFailed")
+            continue
+
+        with recorder.timer("RecordDuration"):
+            detected_text = get_detection_results(textract, job_id)
+        if not detected_text:
+            print("No text detected in the file.")
+            continue
+        if message.get('JobTag'):
+            result_cache.put("textract", message['JobTag'], detected_text)
+
+        messages.append({
+            "text": detected_text,
+            "bucket": bucket_name,
+            "key": object_key
+        })
+
+    failures = send_messages(sqs_queue_url, messages)
+
+    record_cache_stats()
+    recorder.count("RecordsReceived", len(event['Records']))
+    recorder.count("RecordsFailed", len(failures))
+    if failures:
+        raise RecordsFailed(failures, len(event['Records']))
+    return {
+        'statusCode': 200,
+        'body': json.dumps('Textract results sent to SQS!'),
+    }
+
+
+def detection_result_pages(textract, job_id):
+    """
+    Yields the blocks of every result page of a finished asynchronous text
+    detection job.
+    """
+    kwargs = {'JobId': job_id, 'MaxResults': 1000}
+    while True:
+        recorder.count("TextractCalls")
+        with recorder.timer("TextractDuration"):
+            response = textract.get_document_text_detection(**kwargs)
+        if 'NextToken' not in kwargs:
+            # Every result page repeats the page count of the whole document
+            recorder.count("TextractPages", response.get('DocumentMetadata', {}).get('Pages', 1))
+        yield response['Blocks']
+        if 'NextToken' not in response:
+            return
+        kwargs['NextToken'] = response['NextToken']
+
+
+def get_detection_results(textract, job_id):
+    """
+    Reads every page of a finished asynchronous text detection job and returns
+    the detected lines as a string.
+    """
+    lines = read_lines(detection_result_pages(textract, job_id))
+    record_lines(lines)
+    if lines.dropped:
+        print(f"Dropped {lines.dropped} low-confidence lines from job {job_id}")
+    return lines.text
 
 
 def extract_text_from_file(textract, bucket_name, object_key):
     """
-    Extracts text from a file (JPEG or PDF) using Amazon Textract.
-    Returns the extracted text as a string.
+    Extracts text from a file (JPEG or PNG) using Amazon Textract.
+    Returns the extracted text as a string. Textract errors are raised so the
+    handler can report the record as failed.
     """
-    try:
-        response = textract.detect_document_text(
-            Document={
-                'S3Object': {
-                    'Bucket': bucket_name,
-                    'Name': object_key
-                }
-            }
-        )
+    return detect_text(textract, {'S3Object': {'Bucket': bucket_name, 'Name': object_key}}, object_key)
 
-        # Extract the detected text
-        detected_text = ""
-        for item in response['Blocks']:
-            if item['BlockType'] == 'LINE':
-                detected_text += item['Text'] + "\n"
 
-        return detected_text
+def extract_text_from_bytes(textract, document, object_key):
+    """Like extract_text_from_file, for an image already read from S3."""
+    return detect_text(textract, {'Bytes': document}, object_key)
 
-    except Exception as e:
-        print(f"Error extracting text from file: {e}")
-        return None
+
+def detect_text(textract, document, object_key):
+    recorder.count("TextractCalls")
+    with recorder.timer("TextractDuration"):
+        response = textract.detect_document_text(Document=document)
+
+    recorder.count("TextractPages", response.get('DocumentMetadata', {}).get('Pages', 1))
+
+    # Extract the detected text
+    lines = read_lines([response['Blocks']])
+    record_lines(lines)
+    if lines.dropped:
+        print(f"Dropped {lines.dropped} low-confidence lines from {object_key}")
+    return lines.text
+
+
+def record_lines(lines):
+    recorder.count("TextractLines", len(lines))
+    recorder.count("TextractLinesDropped", lines.dropped)
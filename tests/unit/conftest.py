@@ -0,0 +1,60 @@
+import os
+import sys
+from contextlib import contextmanager
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The Lambda sources are deployed as flat asset directories, so their modules
+# import each other by bare name. Append rather than prepend so the CDK app.py
+# at the repository root keeps precedence over lambda/app.py.
+for asset_dir in ("lambda", "batch_upload"):
+    path = os.path.join(ROOT, asset_dir)
+    if path not in sys.path:
+        sys.path.append(path)
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ.setdefault("POWERTOOLS_TRACE_DISABLED", "true")
+os.environ.setdefault("POWERTOOLS_METRICS_NAMESPACE", "GroceryApp")
+os.environ.setdefault("ECOMMERCE_TABLE_NAME", "GroceryAppTable")
+
+
+class FakeTable:
+    """In-memory stand-in for the GroceryAppTable resource."""
+
+    def __init__(self):
+        self.items = {}
+        self.batch_writes = 0
+
+    def get_item(self, Key):
+        item = self.items.get((Key["PK"], Key["SK"]))
+        return {"Item": dict(item)} if item is not None else {}
+
+    def put_item(self, Item):
+        self.items[(Item["PK"], Item["SK"])] = dict(Item)
+
+    @contextmanager
+    def batch_writer(self):
+        self.batch_writes += 1
+        yield self
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues):
+        assert UpdateExpression.startswith("ADD ")
+        item = self.items.setdefault((Key["PK"], Key["SK"]), dict(Key))
+        for clause in UpdateExpression[4:].split(", "):
+            name, value = clause.split(" ")
+            attribute = ExpressionAttributeNames[name]
+            item[attribute] = item.get(attribute, 0) + ExpressionAttributeValues[value]
+
+
+@pytest.fixture(autouse=True)
+def fake_table(monkeypatch):
+    """Points the shared result cache and the order drafts at an in-memory table."""
+    import lambda_sqs_poller
+    import result_cache
+
+    table = FakeTable()
+    monkeypatch.setattr(result_cache.result_cache, "_table", table)
+    monkeypatch.setattr(lambda_sqs_poller, "orders_table", table)
+    return table
@@ -0,0 +1,667 @@
+"""
+In-process stand-ins for the services the grocery pipeline calls: DynamoDB,
+SQS, S3, Textract, Bedrock and Stripe.
+
+Every fake answers the calls the handlers make with the same response shapes
+as the real service. It sleeps for a configurable latency per call and fails a
+configurable share of calls the way the real service does when it throttles.
+Calls and throttles are counted per `service.operation` in a shared
+`CallStats`.
+
+Throttles stand for what is left after the SDK's own retries, so they reach
+the handler code as the error it would see in production. The exception is
+BatchWriteItem, where throttling returns part of the batch as UnprocessedItems.
+
+The Lambda context and the stream and agent events the handlers are invoked
+with are built here too, for the unit tests and benchmarks/bench_pipeline.py.
+"""
+import hashlib
+import importlib.util
+import io
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+import stripe
+from boto3.dynamodb.types import TypeDeserializer
+from botocore.exceptions import ClientError
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_stream_sequence = itertools.count(100000000000000000000)
+
+
+@dataclass
+class Faults:
+    """Latency and throttling applied to every call of one service."""
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    throttle_rate: float = 0.0
+
+
+class CallStats:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = Counter()
+        self.throttled = Counter()
+
+    def record(self, operation, throttled=False):
+        with self._lock:
+            self.calls[operation] += 1
+            if throttled:
+                self.throttled[operation] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return Counter(self.calls), Counter(self.throttled)
+
+
+class FakeService:
+    name = "service"
+    throttle_code = "ThrottlingException"
+
+    def __init__(self, stats, faults=None, seed=0):
+        self.stats = stats
+        self.faults = faults or Faults()
+        self._random = random.Random(f"{self.name}-{seed}")
+        self._random_lock = threading.Lock()
+
+    def _should_throttle(self):
+        with self._random_lock:
+            jitter = self._random.uniform(0, self.faults.jitter_ms)
+            throttle = self._random.random() < self.faults.throttle_rate
+        delay = self.faults.latency_ms + jitter
+        if delay:
+            time.sleep(delay / 1000)
+        return throttle
+
+    def _call(self, operation):
+        """Applies the latency and raises the service's throttling error for a throttled call."""
+        throttled = self._should_throttle()
+        self.stats.record(f"{self.name}.{operation}", throttled)
+        if throttled:
+            raise ClientError({"Error": {"Code": self.throttle_code, "Message": "Rate exceeded"}}, operation)
+
+
+class FakeDynamoDB(FakeService):
+    """
+    One table shared by the client API (BatchWriteItem, used by the bulk
+    loader) and the resource API (`table()`, used by the Lambda handlers).
+    """
+    name = "dynamodb"
+    throttle_code = "ProvisionedThroughputExceededException"
+    page_size = 100
+
+    def __init__(self, stats, faults=None, seed=0):
+        super().__init__(stats, faults, seed)
+        self.items = {}
+        self._lock = threading.Lock()
+        self._deserializer = TypeDeserializer()
+
+    def table(self):
+        return _FakeTable(self)
+
+    def batch_write_item(self, RequestItems):
+        throttled = self._should_throttle()
+        self.stats.record("dynamodb.batch_write_item", throttled)
+        (table_name, requests), = RequestItems.items()
+        if throttled:
+            # Throttled batches come back partially written
+            keep = max(1, len(requests) // 2)
+            requests, unprocessed = requests[:keep], requests[keep:]
+        else:
+            unprocessed = []
+        with self._lock:
+            for request in requests:
+                item = {name: self._deserializer.deserialize(value)
+                        for name, value in request["PutRequest"]["Item"].items()}
+                self.items[(item["PK"], item["SK"])] = item
+        return {"UnprocessedItems": {table_name: unprocessed} if unprocessed else {}}
+
+
+class _FakeTable:
+
+    def __init__(self, db):
+        self.db = db
+
+    def get_item(self, Key, **kwargs):
+        self.db._call("get_item")
+        item = self.db.items.get((Key["PK"], Key["SK"]))
+        return {"Item": dict(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None):
+        self.db._call("put_item")
+        with self.db._lock:
+            key = (Item["PK"], Item["SK"])
+            if ConditionExpression and not _condition_holds(ConditionExpression, ExpressionAttributeValues,
+                                                            self.db.items.get(key)):
+                raise ClientError({"Error": {"Code": "ConditionalCheckFailedException",
+                                             "Message": "The conditional request failed"}}, "PutItem")
+            self.db.items[key] = dict(Item)
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+                    **kwargs):
+        self.db._call("update_item")
+        action = UpdateExpression[:4]
+        if action not in ("ADD ", "SET "):
+            raise NotImplementedError(UpdateExpression)
+        with self.db._lock:
+            item = self.db.items.setdefault((Key["PK"], Key["SK"]), dict(Key))
+            for clause in UpdateExpression[4:].split(", "):
+                name, value = clause.replace(" = ", " ").split(" ")
+                attribute = ExpressionAttributeNames[name]
+                if action == "SET ":
+                    item[attribute] = ExpressionAttributeValues[value]
+                else:
+                    item[attribute] = item.get(attribute, 0) + ExpressionAttributeValues[value]
+
+    def query(self, KeyConditionExpression, ExclusiveStartKey=None, IndexName=None, **kwargs):
+        self.db._call("query")
+        conditions = _key_conditions(KeyConditionExpression)
+        with self.db._lock:
+            keys = sorted(key for key, item in self.db.items.items()
+                          if all(test(item.get(name)) for name, test in conditions))
+        if ExclusiveStartKey:
+            keys = [key for key in keys if key > (ExclusiveStartKey["PK"], ExclusiveStartKey["SK"])]
+        page = keys[:self.db.page_size]
+        response = {"Items": [dict(self.db.items[key]) for key in page], "Count": len(page)}
+        if len(keys) > len(page):
+            response["LastEvaluatedKey"] = {"PK": page[-1][0], "SK": page[-1][1]}
+        return response
+
+    @contextmanager
+    def batch_writer(self, overwrite_by_pkeys=None):
+        writer = _FakeBatchWriter(self.db)
+        yield writer
+        writer.flush()
+
+
+class _FakeBatchWriter:
+
+    def __init__(self, db):
+        self.db = db
+        self.pending = []
+
+    def put_item(self, Item):
+        self._add((Item["PK"], Item["SK"]), dict(Item))
+
+    def delete_item(self, Key):
+        self._add((Key["PK"], Key["SK"]), None)
+
+    def _add(self, key, item):
+        self.pending.append((key, item))
+        if len(self.pending) == 25:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        self.db._call("batch_write_item")
+        with self.db._lock:
+            for key, item in self.pending:
+                if item is None:
+                    self.db.items.pop(key, None)
+                else:
+                    self.db.items[key] = item
+        self.pending = []
+
+
+def _key_conditions(condition):
+    """Turns a boto3 Key(...).eq(...) & Key(...).begins_with(...) or .gt(...) condition into attribute tests."""
+    expression = condition.get_expression()
+    if expression["operator"] == "AND":
+        return [test for part in expression["values"] for test in _key_conditions(part)]
+    key, value = expression["values"]
+    if expression["operator"] == "=":
+        return [(key.name, lambda actual: actual == value)]
+    if expression["operator"] == "begins_with":
+        return [(key.name, lambda actual: isinstance(actual, str) and actual.startswith(value))]
+    if expression["operator"] == ">":
+        return [(key.name, lambda actual: actual is not None and actual > value)]
+    raise NotImplementedError(expression["operator"])
+
+
+def _condition_holds(condition, values, item):
+    """Evaluates a condition of OR-ed `attribute_not_exists(a)` and `a < :v` clauses against an item."""
+    for clause in condition.split(" OR "):
+        not_exists = re.fullmatch(r"attribute_not_exists\((\w+)\)", clause)
+        if not_exists:
+            if item is None or not_exists.group(1) not in item:
+                return True
+            continue
+        attribute, operator, value = clause.split(" ")
+        if operator != "<":
+            raise NotImplementedError(clause)
+        if item is not None and attribute in item and item[attribute] < values[value]:
+            return True
+    return False
+
+
+class FakeSQS(FakeService):
+    name = "sqs"
+    throttle_code = "RequestThrottled"
+
+    def __init__(self, stats, faults=None, seed=0):
+        super().__init__(stats, faults, seed)
+        self.messages = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def send_message(self, QueueUrl, MessageBody):
+        self._call("send_message")
+        with self._lock:
+            self.messages.append(MessageBody)
+        return {"MessageId": str(next(self._ids))}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self._call("send_message_batch")
+        with self._lock:
+            self.messages.extend(entry["MessageBody"] for entry in Entries)
+        return {"Successful": [{"Id": entry["Id"], "MessageId": str(next(self._ids))} for entry in Entries],
+                "Failed": []}
+
+    def drain(self, batch_size=10):
+        """Yields the queued messages as Lambda SQS events of up to `batch_size` records."""
+        with self._lock:
+            messages, self.messages = self.messages, []
+        for start in range(0, len(messages), batch_size):
+            yield {"Records": [
+                {"messageId": f"msg-{start + n}", "receiptHandle": f"handle-{start + n}", "eventSource": "aws:sqs",
+                 "body": body}
+                for n, body in enumerate(messages[start:start + batch_size])
+            ]}
+
+
+class FakeS3(FakeService):
+    name = "s3"
+    throttle_code = "SlowDown"
+
+    def __init__(self, stats, faults=None, seed=0):
+        super().__init__(stats, faults, seed)
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body):
+        self._call("put_object")
+        body = Body.encode("utf-8") if isinstance(Body, str) else Body
+        etag = hashlib.md5(body).hexdigest()
+        self.objects[(Bucket, Key)] = (body, etag)
+        return {"ETag": f'"{etag}"'}
+
+    def get_object(self, Bucket, Key, Range=None, IfMatch=None):
+        self._call("get_object")
+        body, etag = self.objects[(Bucket, Key)]
+        if IfMatch is not None and IfMatch.strip('"') != etag:
+            raise ClientError({"Error": {"Code": "PreconditionFailed", "Message": "At least one of the pre-conditions "
+                                                                                   "you specified did not hold"}},
+                              "GetObject")
+        if Range:
+            start, end = (int(bound) for bound in Range.split("=", 1)[1].split("-"))
+            body = body[start:end + 1]
+        return {"Body": io.BytesIO(body), "ContentLength": len(body), "ETag": f'"{etag}"'}
+
+    def head_object(self, Bucket, Key):
+        self._call("head_object")
+        body, etag = self.objects[(Bucket, Key)]
+        return {"ContentLength": len(body), "ETag": f'"{etag}"'}
+
+    def notification(self, bucket, keys):
+        """The ObjectCreated event S3 would send for `keys`."""
+        records = []
+        for key in keys:
+            body, etag = self.objects[(bucket, key)]
+            records.append({
+                "eventSource": "aws:s3", "eventName": "ObjectCreated:Put",
+                "s3": {"bucket": {"name": bucket}, "object": {"key": key, "size": len(body), "eTag": etag}},
+            })
+        return {"Records": records}
+
+
+class FakeTextract(FakeService):
+    """Detects one LINE per line of text stored in the fake S3 objects."""
+    name = "textract"
+    throttle_code = "ProvisionedThroughputExceededException"
+    results_per_page = 1000
+
+    def __init__(self, stats, s3, faults=None, seed=0):
+        super().__init__(stats, faults, seed)
+        self.s3 = s3
+        self.jobs = {}
+        self.completed = set()
+        self._lock = threading.Lock()
+
+    def _blocks(self, bucket, key):
+        body, _ = self.s3.objects[(bucket, key)]
+        blocks = []
+        for n, line in enumerate(body.decode("utf-8").splitlines()):
+            blocks.append({
+                "BlockType": "LINE", "Text": line, "Confidence": 99.0, "Page": 1,
+                "Geometry": {"BoundingBox": {"Left": 0.1, "Top": n * 0.02, "Width": 0.6, "Height": 0.015}},
+            })
+            blocks.extend({"BlockType": "WORD", "Text": word, "Confidence": 99.0, "Page": 1}
+                          for word in line.split())
+        return blocks
+
+    def detect_document_text(self, Document):
+        self._call("detect_document_text")
+        if "Bytes" in Document:
+            body = Document["Bytes"]
+            key = ("bytes", hashlib.md5(body).hexdigest())
+            self.s3.objects.setdefault(key, (body, key[1]))
+            return {"Blocks": self._blocks(*key)}
+        location = Document["S3Object"]
+        return {"Blocks": self._blocks(location["Bucket"], location["Name"])}
+
+    def start_document_text_detection(self, DocumentLocation, ClientRequestToken=None, NotificationChannel=None,
+                                      JobTag=None):
+        self._call("start_document_text_detection")
+        location = DocumentLocation["S3Object"]
+        job_id = hashlib.sha256(f"{location['Bucket']}/{location['Name']}/{ClientRequestToken}".encode()).hexdigest()
+        with self._lock:
+            self.jobs[job_id] = {"bucket": location["Bucket"], "key": location["Name"], "tag": JobTag}
+        return {"JobId": job_id}
+
+    def get_document_text_detection(self, JobId, MaxResults=1000, NextToken=None):
+        self._call("get_document_text_detection")
+        job = self.jobs[JobId]
+        blocks = self._blocks(job["bucket"], job["key"])
+        start = int(NextToken or 0)
+        page_size = min(MaxResults, self.results_per_page)
+        response = {"JobStatus": "SUCCEEDED", "Blocks": blocks[start:start + page_size]}
+        if start + page_size < len(blocks):
+            response["NextToken"] = str(start + page_size)
+        return response
+
+    def completions(self):
+        """Yields the SNS events Textract would publish for the jobs started so far."""
+        with self._lock:
+            jobs = {job_id: job for job_id, job in self.jobs.items() if job_id not in self.completed}
+            self.completed.update(jobs)
+        for job_id, job in jobs.items():
+            message = {"JobId": job_id, "Status": "SUCCEEDED", "API": "StartDocumentTextDetection",
+                       "JobTag": job["tag"], "DocumentLocation": {"S3ObjectName": job["key"],
+                                                                  "S3Bucket": job["bucket"]}}
+            yield {"Records": [{"Sns": {"Message": json.dumps(message)}}]}
+
+
+class FakeBedrock(FakeService):
+    """
+    Answers extraction prompts with one item per line of the prompt text, e.g.
+    "2kg lemons" becomes {"item": "lemons", "kg": 2}. `ms_per_output_token`
+    adds generation time proportional to the answer length.
+    """
+    name = "bedrock"
+    _LINE = re.compile(r"^\s*(?:(\d+(?:\.\d+)?)\s*(kg)?\s*x?\s+)?(.+?)\s*$", re.IGNORECASE)
+
+    def __init__(self, stats, faults=None, seed=0, ms_per_output_token=0.0):
+        super().__init__(stats, faults, seed)
+        self.ms_per_output_token = ms_per_output_token
+
+    def _answer(self, prompt):
+        text = prompt.rsplit("Here is the text:", 1)[-1]
+        items = []
+        for line in text.strip().splitlines():
+            amount, kg, name = self._LINE.match(line).groups()
+            if amount is None:
+                items.append({"item": name, "kg": None, "count": None})
+            elif kg:
+                items.append({"item": name, "kg": float(amount), "count": None})
+            else:
+                items.append({"item": name, "kg": None, "count": int(float(amount))})
+        return json.dumps({"items": items})
+
+    def _generate(self, body):
+        request = json.loads(body)
+        answer = self._answer(request["messages"][0]["content"])
+        return answer, len(request["messages"][0]["content"]) // 4, len(answer) // 4
+
+    def invoke_model(self, modelId, body, **kwargs):
+        self._call("invoke_model")
+        answer, input_tokens, output_tokens = self._generate(body)
+        if self.ms_per_output_token:
+            time.sleep(output_tokens * self.ms_per_output_token / 1000)
+        return {"body": io.BytesIO(json.dumps({
+            "content": [{"type": "text", "text": answer}],
+            "stop_reason": "end_turn",
+            "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+        }).encode("utf-8"))}
+
+    def invoke_model_with_response_stream(self, modelId, body, **kwargs):
+        self._call("invoke_model_with_response_stream")
+        answer, input_tokens, output_tokens = self._generate(body)
+
+        def events():
+            yield {"type": "message_start", "message": {"usage": {"input_tokens": input_tokens}}}
+            for start in range(0, len(answer), 16):
+                # About four tokens per delta
+                if self.ms_per_output_token:
+                    time.sleep(4 * self.ms_per_output_token / 1000)
+                yield {"type": "content_block_delta", "index": 0,
+                       "delta": {"type": "text_delta", "text": answer[start:start + 16]}}
+            yield {"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                   "usage": {"output_tokens": output_tokens}}
+            yield {"type": "message_stop"}
+
+        return {"body": ({"chunk": {"bytes": json.dumps(event).encode("utf-8")}} for event in events())}
+
+
+class StripeObj(dict):
+    __getattr__ = dict.get
+
+
+class _ListResult(dict):
+    __getattr__ = dict.get
+
+    def __init__(self, data, has_more=False):
+        super().__init__(data=data, has_more=has_more)
+
+    def auto_paging_iter(self):
+        return iter(self.data)
+
+
+class FakeStripe(FakeService):
+    """
+    The parts of the Stripe Products, Prices and Payment Links APIs the catalog
+    sync and the agent use. `install()` swaps them into the stripe module.
+    """
+    name = "stripe"
+
+    def __init__(self, stats, faults=None, seed=0):
+        super().__init__(stats, faults, seed)
+        self.products = {}
+        self.prices = {}
+        self._idempotent = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()
+
+    def _call(self, operation):
+        throttled = self._should_throttle()
+        self.stats.record(f"stripe.{operation}", throttled)
+        if throttled:
+            raise stripe.error.RateLimitError("Too many requests hit the API too quickly.")
+
+    def _id(self, prefix):
+        return f"{prefix}_{next(self._ids):06d}"
+
+    def _expanded(self, product):
+        return StripeObj(product, default_price=self.prices.get(product["default_price"]))
+
+    def _once(self, key, create):
+        with self._lock:
+            if key is not None and key in self._idempotent:
+                return self._idempotent[key]
+            result = create()
+            if key is not None:
+                self._idempotent[key] = result
+            return result
+
+    # Products
+    def product_list(self, active=True, limit=100, expand=None, starting_after=None):
+        self._call("product_list")
+        with self._lock:
+            products = [p for p in self.products.values() if p["active"] == active]
+        if starting_after is not None:
+            products = products[[p["id"] for p in products].index(starting_after) + 1:]
+        return _ListResult([self._expanded(p) for p in products[:limit]], has_more=len(products) > limit)
+
+    def product_search(self, query, limit=100, expand=None):
+        self._call("product_search")
+        names = {name.replace("\\'", "'").casefold() for name in re.findall(r"name:'((?:[^'\\]|\\.)*)'", query)}
+        product_ids = set(re.findall(r"metadata\['productId'\]:'([^']*)'", query))
+        with self._lock:
+            return _ListResult([self._expanded(p) for p in self.products.values()
+                                if p["name"].casefold() in names
+                                or (p.get("metadata") or {}).get("productId") in product_ids][:limit])
+
+    def product_retrieve(self, id, expand=None):
+        self._call("product_retrieve")
+        with self._lock:
+            if id not in self.products:
+                raise stripe.error.InvalidRequestError(f"No such product: '{id}'", "id", code="resource_missing")
+            return self._expanded(self.products[id])
+
+    def product_create(self, name, default_price_data=None, idempotency_key=None, id=None, **fields):
+        self._call("product_create")
+
+        def create():
+            if id in self.products:
+                raise stripe.error.InvalidRequestError(f"Product already exists with ID '{id}'", "id",
+                                                       code="resource_already_exists")
+            product = StripeObj(id=id or self._id("prod"), name=name, active=True, default_price=None, **fields)
+            self.products[product.id] = product
+            if default_price_data:
+                price = self._new_price(product.id, **default_price_data)
+                product["default_price"] = price.id
+            return product
+        return self._once(idempotency_key, create)
+
+    def product_modify(self, id, idempotency_key=None, **changes):
+        self._call("product_modify")
+        with self._lock:
+            self.products[id].update(changes)
+            return self.products[id]
+
+    # Prices
+    def _new_price(self, product, unit_amount, currency):
+        price = StripeObj(id=self._id("price"), product=product, unit_amount=unit_amount, currency=currency,
+                          active=True)
+        self.prices[price.id] = price
+        return price
+
+    def price_list(self, active=True, limit=100, expand=None, product=None):
+        self._call("price_list")
+        with self._lock:
+            prices = [p for p in self.prices.values()
+                      if p["active"] == active and (product is None or p["product"] == product)]
+            if expand and "data.product" in expand:
+                prices = [StripeObj(p, product=self.products[p["product"]]) for p in prices]
+            return _ListResult(prices[:limit] if product else prices)
+
+    def price_create(self, product, unit_amount, currency, idempotency_key=None):
+        self._call("price_create")
+        return self._once(idempotency_key, lambda: self._new_price(product, unit_amount, currency))
+
+    def price_retrieve(self, id):
+        self._call("price_retrieve")
+        return self.prices[id]
+
+    def price_modify(self, id, **changes):
+        self._call("price_modify")
+        with self._lock:
+            self.prices[id].update(changes)
+            return self.prices[id]
+
+    # Payment links
+    def payment_link_create(self, line_items):
+        self._call("payment_link_create")
+        with self._lock:
+            for n, line in enumerate(line_items):
+                param = f"line_items[{n}][price]"
+                if line["price"] not in self.prices:
+                    raise stripe.error.InvalidRequestError(f"No such price: '{line['price']}'", param,
+                                                           code="resource_missing")
+                if not self.prices[line["price"]].get("active"):
+                    raise stripe.error.InvalidRequestError("The price specified is inactive. This field only "
+                                                           "accepts active prices.", param)
+        link_id = self._id("plink")
+        return StripeObj(id=link_id, url=f"https://buy.stripe.com/test_{link_id}")
+
+    @contextmanager
+    def install(self):
+        namespaces = {
+            "Product": StripeObj(list=self.product_list, search=self.product_search, retrieve=self.product_retrieve,
+                                 create=self.product_create, modify=self.product_modify),
+            "Price": StripeObj(list=self.price_list, create=self.price_create, retrieve=self.price_retrieve,
+                               modify=self.price_modify),
+            "PaymentLink": StripeObj(create=self.payment_link_create),
+        }
+        originals = {name: getattr(stripe, name) for name in namespaces}
+        for name, namespace in namespaces.items():
+            setattr(stripe, name, namespace)
+        try:
+            yield self
+        finally:
+            for name, original in originals.items():
+                setattr(stripe, name, original)
+
+
+@dataclass
+class FakeContext:
+    function_name: str = "benchmark"
+    memory_limit_in_mb: int = 1024
+    invoked_function_arn: str = "arn:aws:lambda:us-east-1:123456789012:function:benchmark"
+    aws_request_id: str = "benchmark"
+
+    def get_remaining_time_in_millis(self):
+        return 900_000
+
+
+def load_agent_app():
+    """lambda/app.py, loaded by path because the CDK app at the repository root is also called app."""
+    if "agent_app" not in sys.modules:
+        spec = importlib.util.spec_from_file_location("agent_app", os.path.join(ROOT, "lambda", "app.py"))
+        module = importlib.util.module_from_spec(spec)
+        sys.modules["agent_app"] = module
+        spec.loader.exec_module(module)
+    return sys.modules["agent_app"]
+
+
+def stream_event(products, event_name="MODIFY"):
+    """A GroceryAppTable stream event with one NEW_IMAGE record per product."""
+    from dynamodb_loader import product_item, serialize_item
+
+    records = []
+    for product in products:
+        image = serialize_item(product_item(product))
+        records.append({
+            "eventName": event_name,
+            "dynamodb": {
+                "Keys": {"PK": image["PK"], "SK": image["SK"]},
+                "NewImage": image,
+                "SequenceNumber": str(next(_stream_sequence)),
+            },
+        })
+    return {"Records": records}
+
+
+def agent_event(path, method, parameters=None, body=None, session_id="benchmark-session"):
+    event = {
+        "messageVersion": "1.0",
+        "agent": {"name": "GroceryAgent", "id": "AGENT", "alias": "TSTALIASID", "version": "DRAFT"},
+        "inputText": "benchmark", "sessionId": session_id, "actionGroup": "GroceryActions",
+        "apiPath": path, "httpMethod": method,
+        "parameters": [{"name": name, "type": "string", "value": value} for name, value in (parameters or {}).items()],
+        "sessionAttributes": {}, "promptSessionAttributes": {},
+    }
+    if body is not None:
+        event["requestBody"] = {"content": {"application/json": {"properties": [
+            {"name": name, "type": "array", "value": value} for name, value in body.items()
+        ]}}}
+    return event
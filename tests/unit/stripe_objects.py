@@ -0,0 +1,15 @@
+"""Minimal stand-ins for the Stripe objects the catalog tests hand to the code under test."""
+
+
+class StripeObj(dict):
+    __getattr__ = dict.get
+
+
+class ListResult(dict):
+    __getattr__ = dict.get
+
+    def __init__(self, data, has_more=False):
+        super().__init__(data=data, has_more=has_more)
+
+    def auto_paging_iter(self):
+        return iter(self.data)
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Modules the agent Lambda must only load from the routes that use them
+DEFERRED_MODULES = ("stripe", "boto3", "catalog_index", "catalog_matcher", "catalog_snapshot", "dynamodb_loader",
+                    "stripe_guard")
+IMPORT_BUDGET_MS = float(os.environ.get("AGENT_IMPORT_BUDGET_MS", "1500"))
+
+
+def import_profile(module: str, cwd: str) -> dict:
+    """
+    Imports a module in a fresh interpreter with -X importtime and returns the
+    cumulative import time in milliseconds of every module it loaded.
+    """
+    env = dict(os.environ, PYTHONPATH=os.path.join(ROOT, "batch_upload"), ECOMMERCE_TABLE_NAME="GroceryAppTable",
+               AWS_DEFAULT_REGION="us-east-1")
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=cwd, env=env, capture_output=True, text=True, check=True)
+    profile = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        profile[name.strip()] = int(cumulative) / 1000
+    return profile
+
+
+def test_agent_import_defers_heavy_dependencies():
+    profile = import_profile("app", cwd=os.path.join(ROOT, "lambda"))
+
+    report = "\n".join(f"{ms:10.1f} ms  {name}" for name, ms in
+                       sorted(profile.items(), key=lambda entry: -entry[1])[:15])
+    print(f"Agent Lambda import profile:\n{report}")
+
+    assert not [name for name in DEFERRED_MODULES if name in profile], report
+    assert profile["app"] < IMPORT_BUDGET_MS, report
@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+from catalog_changes import CatalogChangeFeed
+from catalog_keys import product_key
+from dynamodb_loader import BulkLoader
+from tests.unit.pipeline_fakes import CallStats, FakeContext, FakeDynamoDB, agent_event, load_agent_app
+
+
+def _product(n, **changes):
+    product = {
+        "productId": f"product-{n}", "category": "fruit", "createdDate": "2017-04-17T01:14:03-02:00",
+        "description": "d", "modifiedDate": "2019-03-13T12:18:27-01:00", "name": f"Product {n}",
+        "package": {"height": 1, "length": 1, "weight": 1, "width": 1},
+        "pictures": ["https://example.com/p.jpg"], "price": 100 + n, "tags": ["a"],
+    }
+    product.update(changes)
+    return product
+
+
+@pytest.fixture
+def agent(monkeypatch):
+    app = load_agent_app()
+    monkeypatch.setattr(app, "catalog_changes", lambda: CatalogChangeFeed(table=FakeDynamoDB(CallStats()).table()))
+    dynamodb = FakeDynamoDB(CallStats())
+    loader = BulkLoader("GroceryAppTable", client=dynamodb, workers=2)
+    monkeypatch.setattr(app, "product_loader", lambda: loader)
+    return app, dynamodb
+
+
+def _call(app, path, **parameters):
+    response = app.lambda_handler(agent_event(path, "POST", parameters=parameters), FakeContext())
+    assert response["response"]["httpStatusCode"] == 200
+    return json.loads(response["response"]["responseBody"]["application/json"]["body"])
+
+
+def test_populate_db_writes_valid_products_and_reports_invalid_ones(agent):
+    app, dynamodb = agent
+    items = [_product(n) for n in range(250)]
+    items[3] = _product(3, price="free", pictures=["not a url"])
+    items[140] = "not a product"
+    items[200] = _product(200, productId=200)
+
+    result = _call(app, "/populate_db", list_items=json.dumps(items))
+
+    assert result["written"] == 247 and result["invalid"] == 3 and result["failed"] == 0
+    assert [error["index"] for error in result["errors"]] == [3, 140, 200]
+    assert result["errors"][2]["productId"] is None
+    assert result["errors"][0]["productId"] == "product-3"
+    assert {message.split(":")[0] for message in result["errors"][0]["errors"]} == {"price", "pictures.0"}
+    assert result["next_offset"] is None
+    assert (product_key("product-249")["PK"], "PRODUCT#product-249") in dynamodb.items
+    assert (product_key("product-3")["PK"], "PRODUCT#product-3") not in dynamodb.items
+
+
+def test_populate_db_accepts_oversized_lists_in_pages(agent, monkeypatch):
+    app, dynamodb = agent
+    monkeypatch.setattr(app, "POPULATE_DB_MAX_ITEMS", 100)
+    items = [_product(n) for n in range(230)]
+
+    first = _call(app, "/populate_db", list_items=json.dumps(items))
+    second = _call(app, "/populate_db", list_items=json.dumps(items[first["next_offset"]:]))
+
+    assert (first["written"], first["next_offset"]) == (100, 100)
+    assert (second["written"], second["next_offset"]) == (100, 100)
+    assert len(dynamodb.items) == 200
+
+
+def test_list_of_items_echoes_a_page(agent):
+    app, _ = agent
+    items = [{"n": n} for n in range(120)]
+
+    page = _call(app, "/list_of_items", list_items=json.dumps(items), offset="100", limit="50")
+
+    assert page == {"items": items[100:], "total": 120, "next_offset": None}
+    assert _call(app, "/list_of_items", list_items=json.dumps(items))["next_offset"] == 50
+
+
+def test_payload_logging_is_capped(agent):
+    app, _ = agent
+    assert len(app._ellipsize([_product(n) for n in range(500)], 2048)) < 2100
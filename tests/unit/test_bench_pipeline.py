@@ -0,0 +1,38 @@
+import pytest
+from botocore.exceptions import ClientError
+
+import trigger_step_functions_wrokflow as trigger
+from benchmarks import bench_pipeline
+from tests.unit.pipeline_fakes import CallStats, Faults, FakeSQS
+
+
+def test_pipeline_runs_every_stage_against_the_fakes():
+    textract = trigger.textract
+
+    reports = {report.stage: report for report in bench_pipeline.main(
+        ["--products", "40", "--uploads", "12", "--records-per-event", "4", "--agent-requests", "3", "--json"])}
+
+    assert set(reports) == {
+        "stripe_sync", "product_load", "catalog_stream", "trigger", "textract_completion", "poller", "agent /current_time",
+        "agent /match_items", "agent /payment_link", "agent /order_payment_link", "agent /populate_db",
+    }
+    assert all(report.failed == 0 for report in reports.values())
+    assert reports["stripe_sync"].calls["stripe.product_create"] == 40
+    assert "stripe.product_list" not in reports["catalog_stream"].calls
+    assert reports["trigger"].calls["sqs.send_message_batch"] == 3
+    assert reports["poller"].units == 12 and reports["poller"].calls["bedrock.invoke_model"] == 12
+    assert reports["agent /payment_link"].calls["stripe.payment_link_create"] == 3
+    assert reports["poller"].percentile(0.99) >= reports["poller"].percentile(0.5) > 0
+    # The handler modules are left as they were
+    assert trigger.textract is textract
+
+
+def test_fakes_count_calls_and_throttle():
+    stats = CallStats()
+    sqs = FakeSQS(stats, Faults(throttle_rate=1.0))
+
+    with pytest.raises(ClientError) as error:
+        sqs.send_message(QueueUrl="queue", MessageBody="{}")
+
+    assert error.value.response["Error"]["Code"] == "RequestThrottled"
+    assert stats.calls["sqs.send_message"] == stats.throttled["sqs.send_message"] == 1
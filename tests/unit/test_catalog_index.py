@@ -0,0 +1,64 @@
+import stripe
+
+from catalog_index import CatalogIndex, normalize_name
+from tests.unit.stripe_objects import ListResult, StripeObj
+
+
+def _price(price_id, product, amount=100):
+    return StripeObj(id=price_id, product=product, unit_amount=amount, currency="usd")
+
+
+def test_normalize_name():
+    assert normalize_name("  Fresh   LEMONS ") == "fresh lemons"
+
+
+def test_lookup_is_served_from_one_bulk_fetch(monkeypatch):
+    lemons = StripeObj(id="prod_1", name="Fresh Lemons", active=True, default_price="price_b")
+    peach = StripeObj(id="prod_2", name="Fresh Peach", active=True, default_price=None)
+    calls = []
+
+    def price_list(**kwargs):
+        calls.append(kwargs)
+        return ListResult([_price("price_a", lemons), _price("price_b", lemons), _price("price_c", peach)])
+
+    monkeypatch.setattr(stripe.Price, "list", price_list)
+    index = CatalogIndex(ttl_seconds=300)
+
+    assert index.lookup("fresh lemons").price_id == "price_b"
+    assert index.lookup("Fresh Peach").product_id == "prod_2"
+    assert len(calls) == 1
+    assert calls[0]["expand"] == ["data.product"]
+
+    index.invalidate()
+    index.lookup("Fresh Peach")
+    assert len(calls) == 2
+
+
+def test_miss_falls_back_to_targeted_search(monkeypatch):
+    mango = StripeObj(id="prod_3", name="Mango", active=True, default_price=None)
+    kiwi = StripeObj(id="prod_4", name="Kiwi", active=True, default_price=_price("price_k", "prod_4"))
+    searches = []
+
+    def price_list(**kwargs):
+        if "product" in kwargs:
+            return ListResult([_price("price_m", kwargs["product"])])
+        return ListResult([])
+
+    def product_search(query, limit, expand):
+        searches.append(query)
+        return ListResult([p for p in (mango, kiwi) if p.name.lower() in query.lower()])
+
+    monkeypatch.setattr(stripe.Price, "list", price_list)
+    monkeypatch.setattr(stripe.Product, "search", product_search)
+    index = CatalogIndex(ttl_seconds=300)
+
+    assert index.lookup("Mango").price_id == "price_m"
+    assert index.lookup("mango").price_id == "price_m"
+    assert index.lookup("Durian") is None
+    assert index.lookup("Durian") is None
+    assert searches == ["name:'Mango'", "name:'Durian'"]
+
+    results = index.lookup_many(["Mango", "kiwi", "Durian", "O'Neil Pears"])
+    assert results["kiwi"].price_id == "price_k"
+    assert results["Durian"] is None and results["O'Neil Pears"] is None
+    assert searches[-1] == "name:'kiwi' OR name:'O\\'Neil Pears'"
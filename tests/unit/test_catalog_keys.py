@@ -0,0 +1,72 @@
+import json
+import os
+import re
+from collections import Counter
+
+from catalog_keys import LEGACY_PRODUCT_PK, PRODUCT_SHARDS, product_key, product_shard, query_product_shards
+from catalog_stream import product_changes
+from dynamodb_loader import BulkLoader, migrate_legacy_products, product_item, serialize_item
+from tests.unit.pipeline_fakes import CallStats, FakeDynamoDB
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+with open(os.path.join(ROOT, "batch_upload", "product_list.json")) as f:
+    CATALOG = json.load(f)
+
+
+def test_shards_follow_the_id_and_match_the_resolvers():
+    assert 16 % PRODUCT_SHARDS == 0
+    assert product_shard("4c1fadaa-213a-4ea8-aa32-58c217604e3c") == 0xc % PRODUCT_SHARDS
+    assert product_key("4c1fadaa-213a-4ea8-aa32-58c217604e3C") == {
+        "PK": "PRODUCT#04", "SK": "PRODUCT#4c1fadaa-213a-4ea8-aa32-58c217604e3C"}
+    assert product_shard("product-x") == 0
+    for resolver in ("getProduct", "listProducts"):
+        with open(os.path.join(ROOT, "graphql", "resolvers", f"{resolver}.request.vtl")) as template:
+            source = template.read()
+        assert re.search(r"#set\(\$shardCount = (\d+)\)", source).group(1) == str(PRODUCT_SHARDS)
+        # The partition key is padded to two digits like shard_pk, not built with a fixed 0
+        assert "toDynamoDBJson($pk)" in source and 'toDynamoDBJson("PRODUCT#0' not in source
+
+
+def test_scatter_gather_reads_every_shard_once():
+    dynamodb = FakeDynamoDB(CallStats())
+    table = dynamodb.table()
+    with table.batch_writer() as batch:
+        for product in CATALOG:
+            batch.put_item(Item=product_item(product))
+    queries = []
+
+    products = list(query_product_shards(table, on_query=lambda: queries.append(1)))
+
+    assert sorted(product["productId"] for product in products) == sorted(p["productId"] for p in CATALOG)
+    assert len(queries) == PRODUCT_SHARDS
+    assert len(Counter(product_shard(p["productId"]) for p in CATALOG)) > 1
+
+
+def test_legacy_products_are_moved_to_their_shard():
+    dynamodb = FakeDynamoDB(CallStats())
+    dynamodb.page_size = 5
+    table = dynamodb.table()
+    legacy = [dict(product_item(product), PK=LEGACY_PRODUCT_PK) for product in CATALOG]
+    for item in legacy:
+        del item["GSI3PK"], item["GSI3SK"]
+        table.put_item(Item=item)
+    table.put_item(Item={"PK": "CACHE#textract", "SK": "abc"})
+    loader = BulkLoader("GroceryAppTable", client=dynamodb, workers=2)
+
+    report = migrate_legacy_products(table, loader)
+
+    assert report.written == len(CATALOG) and report.failed == 0
+    assert {pk for pk, _ in dynamodb.items} == {"CACHE#textract"} | {
+        product_key(p["productId"])["PK"] for p in CATALOG}
+    lemons = dynamodb.items[tuple(product_key(CATALOG[0]["productId"]).values())]
+    assert lemons["GSI3PK"] == f"CATEGORY#{CATALOG[0]['category']}" and lemons["GSI3SK"] == CATALOG[0]["price"]
+    assert migrate_legacy_products(table, loader).items == 0
+
+
+def test_stream_skips_the_legacy_partition():
+    image = serialize_item(dict(product_item(CATALOG[0]), PK=LEGACY_PRODUCT_PK))
+    record = {"eventName": "REMOVE", "dynamodb": {
+        "Keys": {"PK": image["PK"], "SK": image["SK"]}, "SequenceNumber": "1"}}
+
+    assert product_changes([record]) == ({}, {})
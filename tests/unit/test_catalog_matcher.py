@@ -0,0 +1,68 @@
+import json
+import os
+
+from catalog_keys import PRODUCT_SHARDS, product_key, shard_pk
+from catalog_matcher import CatalogMatcher, tokenize
+
+PRODUCT_LIST = os.path.join(os.path.dirname(__file__), "..", "..", "batch_upload", "product_list.json")
+
+
+class FakeProductTable:
+    def __init__(self, items, page_size=7):
+        self.items = items
+        self.page_size = page_size
+        self.queries = 0
+
+    def shard(self, pk):
+        return [item for item in self.items if product_key(item["productId"])["PK"] == pk]
+
+    def query(self, **kwargs):
+        self.queries += 1
+        _, pk = kwargs["KeyConditionExpression"].get_expression()["values"]
+        items = self.shard(pk)
+        start = kwargs.get("ExclusiveStartKey", {}).get("offset", 0)
+        response = {"Items": items[start:start + self.page_size]}
+        if start + self.page_size < len(items):
+            response["LastEvaluatedKey"] = {"offset": start + self.page_size}
+        return response
+
+
+def _catalog():
+    with open(PRODUCT_LIST) as product_list:
+        return json.load(product_list)
+
+
+def test_tokenize_drops_quantities_and_units():
+    assert tokenize("2kg Lemons") == ["lemons"]
+    assert tokenize("Eggs x 12, 1.5 l of milk") == ["eggs", "milk"]
+
+
+def test_matches_free_text_items_to_products():
+    table = FakeProductTable(_catalog())
+    matcher = CatalogMatcher(table=table)
+
+    results = matcher.match_many(["2kg lemons", "lemmon", "peaches x3", "apple", "12 eggs"], top_k=2)
+
+    assert results["2kg lemons"][0].name == "Fresh Lemons"
+    assert results["lemmon"][0].name == "Fresh Lemons"
+    assert results["peaches x3"][0].name == "Fresh Peach"
+    assert results["apple"][0].name == "fresh apples"
+    assert results["12 eggs"] == []
+    # Built once from the paginated shards, then served from memory
+    pages = [max(1, -(-len(table.shard(shard_pk(shard))) // table.page_size)) for shard in range(PRODUCT_SHARDS)]
+    assert table.queries == sum(pages)
+
+
+def test_refresh_only_reindexes_changed_products():
+    catalog = _catalog()
+    table = FakeProductTable(catalog)
+    matcher = CatalogMatcher(table=table)
+    assert matcher.refresh() == len(catalog)
+
+    lemons = dict(catalog[0], name="Organic Lemons")
+    table.items = [lemons] + catalog[2:]
+
+    assert matcher.refresh() == 2
+    assert len(matcher) == len(catalog) - 1
+    assert matcher.match("organic lemons")[0].product_id == lemons["productId"]
+    assert all(match.name != "Fresh Peach" for match in matcher.match("peach"))
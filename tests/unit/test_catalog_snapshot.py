@@ -0,0 +1,80 @@
+import json
+import os
+
+import pytest
+
+import batch_upload_products
+import catalog_stream
+from catalog_matcher import CatalogMatcher
+from catalog_snapshot import CatalogSnapshot, load_snapshot, write_snapshot
+from dynamodb_loader import BulkLoader, product_item
+from tests.unit.pipeline_fakes import CallStats, FakeContext, FakeDynamoDB, FakeStripe, stream_event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+PRODUCT_LIST = os.path.join(ROOT, "batch_upload", "product_list.json")
+
+with open(PRODUCT_LIST) as f:
+    CATALOG = json.load(f)
+
+
+def test_snapshot_round_trips_the_product_list(tmp_path):
+    path = str(tmp_path / "catalog.snapshot")
+    version = write_snapshot(PRODUCT_LIST, path)
+    modified_at = os.stat(path).st_mtime_ns
+
+    snapshot = CatalogSnapshot.open(path)
+
+    assert len(snapshot) == len(CATALOG) and snapshot.version == version
+    fields = ("productId", "name", "category", "tags", "price")
+    assert sorted(snapshot.products(), key=lambda p: p["productId"]) == sorted(
+        ({key: product[key] for key in fields} for product in CATALOG), key=lambda p: p["productId"])
+    assert write_snapshot(PRODUCT_LIST, path) == version and os.stat(path).st_mtime_ns == modified_at
+
+    changed = tmp_path / "product_list.json"
+    changed.write_text(json.dumps([dict(CATALOG[0], price=CATALOG[0]["price"] + 1)] + CATALOG[1:]))
+    assert write_snapshot(str(changed), str(tmp_path / "changed.snapshot")) != version
+    assert load_snapshot(str(tmp_path / "missing.snapshot")) is None
+
+
+@pytest.fixture
+def loaded(monkeypatch, tmp_path):
+    """The product list loaded into a fake table by the product loader, and its snapshot."""
+    dynamodb = FakeDynamoDB(CallStats())
+    table = dynamodb.table()
+    monkeypatch.setattr(batch_upload_products, "table", table)
+    monkeypatch.setattr(batch_upload_products, "loader", BulkLoader("GroceryAppTable", client=dynamodb, workers=2))
+    monkeypatch.setattr(batch_upload_products, "product_source", PRODUCT_LIST)
+    monkeypatch.setattr(catalog_stream, "table", table)
+    assert batch_upload_products.handler({}, FakeContext())
+
+    write_snapshot(PRODUCT_LIST, str(tmp_path / "catalog.snapshot"))
+    dynamodb.stats.calls.clear()
+    return dynamodb, CatalogSnapshot.open(str(tmp_path / "catalog.snapshot"))
+
+
+def test_matcher_indexes_a_current_snapshot_without_reading_the_shards(loaded):
+    dynamodb, snapshot = loaded
+    matcher = CatalogMatcher(table=dynamodb.table(), snapshot=snapshot)
+
+    assert matcher.match("2kg lemons")[0].name == "Fresh Lemons"
+    assert len(matcher) == len(CATALOG)
+    assert dict(dynamodb.stats.calls) == {"dynamodb.get_item": 1}
+
+
+def test_product_writes_that_differ_from_the_list_retire_the_snapshot(loaded):
+    dynamodb, snapshot = loaded
+    repriced = dict(CATALOG[2], price=CATALOG[2]["price"] + 50)
+    with FakeStripe(CallStats()).install():
+        catalog_stream.handler(stream_event(CATALOG[:2]), FakeContext())
+        assert snapshot.is_current(dynamodb.table())
+
+        dynamodb.table().put_item(Item=product_item(repriced))
+        catalog_stream.handler(stream_event([repriced]), FakeContext())
+    assert not snapshot.is_current(dynamodb.table())
+
+    matcher = CatalogMatcher(table=dynamodb.table(), snapshot=snapshot)
+    dynamodb.stats.calls.clear()
+    matcher.refresh()
+    assert dynamodb.stats.calls["dynamodb.query"] >= 8
+    assert next(m for m in matcher.match(repriced["name"]) if m.product_id == repriced["productId"]).price == \
+        repriced["price"]
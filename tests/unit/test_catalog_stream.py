@@ -0,0 +1,164 @@
+import json
+import os
+from functools import lru_cache
+
+import pytest
+import stripe
+
+import catalog_stream
+from catalog_changes import CATALOG_CHANGE_PK, CatalogChangeFeed, change_item, record_changes
+from catalog_matcher import CatalogMatcher
+from session_memo import SessionMemo
+from stripe_sync import StripeCatalogSync
+from tests.unit.pipeline_fakes import CallStats, FakeContext, FakeDynamoDB, FakeStripe, load_agent_app, stream_event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+with open(os.path.join(ROOT, "batch_upload", "product_list.json")) as f:
+    CATALOG = json.load(f)[:12]
+
+
+@pytest.fixture
+def synced(monkeypatch):
+    """Stripe holding the synced catalog, and the stream processor writing to a fake table."""
+    stripe_fake = FakeStripe(CallStats())
+    dynamodb = FakeDynamoDB(CallStats())
+    monkeypatch.setattr(catalog_stream, "table", dynamodb.table())
+    with stripe_fake.install():
+        StripeCatalogSync().run(CATALOG)
+        stripe_fake.stats.calls.clear()
+        yield stripe_fake, dynamodb
+
+
+def _stripe_product(stripe_fake, product_id):
+    return next(p for p in stripe_fake.products.values() if p.metadata["productId"] == product_id)
+
+
+def _changes(dynamodb):
+    return [item for (pk, _), item in sorted(dynamodb.items.items()) if pk == CATALOG_CHANGE_PK]
+
+
+def test_price_change_replaces_only_that_products_price(synced):
+    stripe_fake, dynamodb = synced
+    product = dict(CATALOG[2], price=CATALOG[2]["price"] + 50)
+    old_price = _stripe_product(stripe_fake, product["productId"]).default_price
+
+    response = catalog_stream.handler(stream_event([product]), FakeContext())
+
+    stripe_product = _stripe_product(stripe_fake, product["productId"])
+    assert response == {"batchItemFailures": []}
+    assert stripe_fake.prices[stripe_product.default_price].unit_amount == product["price"]
+    assert not stripe_fake.prices[old_price].active
+    assert "stripe.product_list" not in stripe_fake.stats.calls and "stripe.product_search" not in stripe_fake.stats.calls
+    assert stripe_fake.stats.calls["stripe.product_retrieve"] == 1
+    [change] = _changes(dynamodb)
+    assert (change["productId"], change["price"], change["removed"]) == (product["productId"], product["price"], False)
+
+
+def test_a_product_edited_right_after_its_creation_is_not_created_twice(synced, monkeypatch):
+    stripe_fake, _ = synced
+    # Stripe Search lags writes by up to a minute
+    monkeypatch.setattr(stripe.Product, "search", lambda **kwargs: stripe_fake.product_search("name:''"))
+    product = dict(CATALOG[0], productId="new-product", name="Blood Oranges")
+
+    catalog_stream.handler(stream_event([product]), FakeContext())
+    catalog_stream.handler(stream_event([dict(product, price=product["price"] + 10)]), FakeContext())
+
+    [created] = [p for p in stripe_fake.products.values() if p.metadata["productId"] == "new-product"]
+    assert created.id == "new-product"
+    assert stripe_fake.prices[created.default_price].unit_amount == product["price"] + 10
+
+
+def test_a_product_back_in_the_catalog_is_reactivated(synced):
+    stripe_fake, _ = synced
+    event = stream_event([CATALOG[0]], event_name="REMOVE")
+    del event["Records"][0]["dynamodb"]["NewImage"]
+    catalog_stream.handler(event, FakeContext())
+
+    StripeCatalogSync().run(CATALOG)
+
+    assert _stripe_product(stripe_fake, CATALOG[0]["productId"]).active
+    assert len(stripe_fake.products) == len(CATALOG)
+
+
+def test_deletes_archive_and_unrelated_items_are_skipped(synced):
+    stripe_fake, dynamodb = synced
+    event = stream_event([CATALOG[0]], event_name="REMOVE")
+    del event["Records"][0]["dynamodb"]["NewImage"]
+    event["Records"].append({"eventName": "INSERT", "dynamodb": {
+        "Keys": {"PK": {"S": "CACHE#textract"}, "SK": {"S": "abc"}}, "NewImage": {}, "SequenceNumber": "1"}})
+
+    catalog_stream.handler(event, FakeContext())
+
+    assert not _stripe_product(stripe_fake, CATALOG[0]["productId"]).active
+    [change] = _changes(dynamodb)
+    assert change["removed"] and change["name"] == CATALOG[0]["name"]
+
+
+def test_failed_products_are_retried_from_their_first_record(synced, monkeypatch):
+    stripe_fake, dynamodb = synced
+    changed = [dict(product, description="new") for product in CATALOG[:3]]
+    event = stream_event(changed)
+    failing_id = _stripe_product(stripe_fake, changed[1]["productId"]).id
+    modify = stripe.Product.modify
+
+    def flaky_modify(id, **changes):
+        if id == failing_id:
+            raise stripe.error.InvalidRequestError("No such product", "id")
+        return modify(id, **changes)
+
+    monkeypatch.setattr(stripe.Product, "modify", flaky_modify)
+    response = catalog_stream.handler(event, FakeContext())
+
+    first_failed = event["Records"][1]["dynamodb"]["SequenceNumber"]
+    assert response == {"batchItemFailures": [{"itemIdentifier": first_failed}]}
+    assert {change["productId"] for change in _changes(dynamodb)} == {changed[0]["productId"], changed[2]["productId"]}
+
+
+def test_feed_returns_each_change_once():
+    table = FakeDynamoDB(CallStats()).table()
+    feed = CatalogChangeFeed(table=table, check_interval_seconds=0)
+    record_changes(table, [change_item(CATALOG[0]), change_item(CATALOG[1], previous_name="Old Name")])
+
+    assert [change["productId"] for change in feed.poll()] == [CATALOG[0]["productId"], CATALOG[1]["productId"]]
+    assert feed.poll() == []
+    assert feed.changed_since("old  name", 0) and not feed.changed_since(CATALOG[2]["name"], 0)
+
+
+def test_agent_applies_changes_to_the_matcher_and_the_memo(monkeypatch):
+    app = load_agent_app()
+    table = FakeDynamoDB(CallStats()).table()
+    feed = CatalogChangeFeed(table=table, check_interval_seconds=0)
+    matcher = CatalogMatcher(table=table)
+    matcher.upsert(CATALOG)
+    matcher.refresh = lambda: 0
+    monkeypatch.setattr(app, "catalog_changes", lambda: feed)
+    monkeypatch.setattr(app, "product_matcher", lru_cache(maxsize=None)(lambda: matcher))
+    app.product_matcher()
+    renamed = dict(CATALOG[0], name="Blood Oranges")
+    record_changes(table, [change_item(renamed, previous_name=CATALOG[0]["name"])])
+
+    memo = SessionMemo()
+    memo.remember(CATALOG[0]["name"], {"name": CATALOG[0]["name"]})
+    memo.products[CATALOG[0]["name"].casefold()]["at"] = 0
+    app.app.append_context(session_memo=memo)
+    try:
+        app.apply_catalog_changes()
+    finally:
+        app.app.clear_context()
+
+    assert matcher.match("blood oranges")[0].product_id == CATALOG[0]["productId"]
+    assert memo.product(CATALOG[0]["name"]) is None
+
+
+def test_agent_leaves_an_unbuilt_matcher_alone(monkeypatch):
+    app = load_agent_app()
+    table = FakeDynamoDB(CallStats()).table()
+    monkeypatch.setattr(app, "catalog_changes", lambda: CatalogChangeFeed(table=table, check_interval_seconds=0))
+    product_matcher = lru_cache(maxsize=None)(lambda: pytest.fail("the matcher must not be built"))
+    monkeypatch.setattr(app, "product_matcher", product_matcher)
+    record_changes(table, [change_item(CATALOG[0])])
+
+    app.apply_catalog_changes()
+
+    assert product_matcher.cache_info().currsize == 0
@@ -1,3 +1,5 @@
+import json
+
 import aws_cdk as core
 import aws_cdk.assertions as assertions
 
@@ -13,3 +15,108 @@ def test_sqs_queue_created():
 #     template.has_resource_properties("AWS::SQS::Queue", {
 #         "VisibilityTimeout": 300
 #     })
+
+
+def test_product_queries_use_cached_dynamodb_resolvers():
+    app = core.App(context={"productCacheTtlSeconds": 60})
+    stack = CoffeeOrderStack(app, "coffee-order")
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::AppSync::ApiCache", {
+        "ApiCachingBehavior": "PER_RESOLVER_CACHING",
+        "Ttl": 60,
+    })
+    for field_name in ("getProduct", "listProducts"):
+        template.has_resource_properties("AWS::AppSync::Resolver", {
+            "TypeName": "Query",
+            "FieldName": field_name,
+            "Kind": "UNIT",
+            "CachingConfig": assertions.Match.object_like({"Ttl": 60}),
+        })
+    template.has_resource_properties("AWS::AppSync::DataSource", {"Type": "AMAZON_DYNAMODB"})
+
+
+def test_agent_provisioned_concurrency_is_opt_in():
+    app = core.App(context={"agentProvisionedConcurrency": 2})
+    stack = CoffeeOrderStack(app, "coffee-order")
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::Lambda::Alias", {
+        "Name": "live",
+        "ProvisionedConcurrencyConfig": {"ProvisionedConcurrentExecutions": 2},
+    })
+
+
+def test_catalog_stream_only_receives_product_records():
+    app = core.App(context={"productCacheTtlSeconds": 60})
+    stack = CoffeeOrderStack(app, "coffee-order")
+    template = assertions.Template.from_stack(stack)
+
+    template.has_resource_properties("AWS::Lambda::EventSourceMapping", {
+        "FunctionResponseTypes": ["ReportBatchItemFailures"],
+        "FilterCriteria": {"Filters": [{"Pattern": json.dumps(
+            {"dynamodb": {"Keys": {"PK": {"S": [{"prefix": "PRODUCT#"}]}}}}, separators=(",", ":"))}]},
+    })
+    template.has_resource_properties("AWS::Lambda::Function", {
+        "Handler": "catalog_stream.handler",
+        "Environment": {"Variables": assertions.Match.object_like({
+            "APPSYNC_API_ID": assertions.Match.any_value()})},
+    })
+
+
+def test_uploads_only_notify_for_supported_documents():
+    app = core.App(context={"uploadPrefix": "lists/"})
+    stack = CoffeeOrderStack(app, "coffee-order")
+    template = assertions.Template.from_stack(stack)
+
+    notifications = template.find_resources("Custom::S3BucketNotifications")
+    configurations, = [resource["Properties"]["NotificationConfiguration"]["LambdaFunctionConfigurations"]
+                       for resource in notifications.values()]
+    filters = {frozenset((rule["Name"], rule["Value"]) for rule in configuration["Filter"]["Key"]["FilterRules"])
+               for configuration in configurations}
+    assert {("prefix", "lists/"), ("suffix", ".jpg")} in filters
+    assert {("prefix", "lists/"), ("suffix", ".PDF")} in filters
+    assert len(filters) == len(configurations) == 12
+
+
+def test_synth_compiles_the_catalog_snapshot_for_the_agent_image():
+    from batch_upload.catalog_snapshot import CatalogSnapshot
+    from coffee_order.coffee_order_stack import CATALOG_SNAPSHOT_PATH
+
+    app = core.App()
+    CoffeeOrderStack(app, "coffee-order")
+
+    with open("batch_upload/product_list.json") as f:
+        products = json.load(f)
+    snapshot = CatalogSnapshot.open(CATALOG_SNAPSHOT_PATH)
+    assert len(snapshot) == len(products)
+    assert {p["productId"]: p["name"] for p in snapshot.products()} == {p["productId"]: p["name"] for p in products}
+
+
+def test_failed_trigger_invocations_are_retried_then_queued():
+    app = core.App()
+    stack = CoffeeOrderStack(app, "coffee-order")
+    template = assertions.Template.from_stack(stack)
+
+    template.resource_count_is("AWS::Lambda::EventInvokeConfig", 2)
+    template.has_resource_properties("AWS::Lambda::EventInvokeConfig", {
+        "MaximumRetryAttempts": 2,
+        "DestinationConfig": {"OnFailure": {"Destination": assertions.Match.any_value()}},
+    })
+
+
+def test_zip_functions_get_the_powertools_layer_for_their_runtime():
+    app = core.App()
+    stack = CoffeeOrderStack(app, "coffee-order")
+    template = assertions.Template.from_stack(stack)
+
+    handlers = {"batch_upload_products.handler", "create_stripe_products.handler", "catalog_stream.handler",
+                "trigger_step_functions_wrokflow.handler",
+                "trigger_step_functions_wrokflow.textract_completion_handler", "lambda_sqs_poller.handler"}
+    functions = [f["Properties"] for f in template.find_resources("AWS::Lambda::Function").values()
+                 if f["Properties"].get("Handler") in handlers]
+    assert len(functions) == len(handlers)
+    for function in functions:
+        assert function["Runtime"] == "python3.11"
+        [layer] = function["Layers"]
+        assert "AWSLambdaPowertoolsPythonV3-python311-x86_64" in json.dumps(layer)
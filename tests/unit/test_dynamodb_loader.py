@@ -0,0 +1,102 @@
+import io
+import json
+import threading
+from decimal import Decimal
+
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+import dynamodb_loader
+from dynamodb_loader import BulkLoader, iter_json_items, product_item
+
+
+class FakeDynamoDB:
+    """BatchWriteItem stand-in that throttles the first few calls."""
+
+    def __init__(self, throttle_calls=3, unprocessed_calls=3):
+        self.items = {}
+        self.calls = 0
+        self.throttle_calls = throttle_calls
+        self.unprocessed_calls = unprocessed_calls
+        self.lock = threading.Lock()
+
+    def batch_write_item(self, RequestItems):
+        (table_name, requests), = RequestItems.items()
+        assert len(requests) <= 25
+        with self.lock:
+            self.calls += 1
+            call = self.calls
+        if call <= self.throttle_calls:
+            raise ClientError({"Error": {"Code": "ProvisionedThroughputExceededException"}}, "BatchWriteItem")
+        written, unprocessed = requests, []
+        if call <= self.throttle_calls + self.unprocessed_calls:
+            written, unprocessed = requests[:10], requests[10:]
+        with self.lock:
+            for request in written:
+                item = request["PutRequest"]["Item"]
+                self.items[(item["PK"]["S"], item["SK"]["S"])] = item
+        return {"UnprocessedItems": {table_name: unprocessed} if unprocessed else {}}
+
+
+def _product(n):
+    return {
+        "productId": str(n), "category": "fruit", "createdDate": "2017-04-17", "description": "d",
+        "modifiedDate": "2019-03-13", "name": f"Product {n}",
+        "package": {"height": 1, "length": 2, "weight": 3.5, "width": 4}, "pictures": [], "price": 100 + n,
+        "tags": ["a"],
+    }
+
+
+def test_iter_json_items_streams_arrays_and_json_lines():
+    products = [_product(n) for n in range(50)]
+    array = io.StringIO(json.dumps(products, indent=4))
+    lines = io.StringIO("\n".join(json.dumps(p) for p in products) + "\n")
+
+    streamed = list(iter_json_items(array, chunk_size=64))
+    assert [p["productId"] for p in streamed] == [p["productId"] for p in products]
+    assert streamed[0]["package"]["weight"] == Decimal("3.5")
+    assert list(iter_json_items(lines, chunk_size=64)) == streamed
+    assert list(iter_json_items(io.StringIO("[]"))) == []
+
+
+def test_bulk_loader_retries_throttling_and_unprocessed_items(monkeypatch):
+    monkeypatch.setattr(dynamodb_loader.time, "sleep", lambda seconds: None)
+    client = FakeDynamoDB()
+    loader = BulkLoader("GroceryAppTable", client=client, workers=4)
+
+    report = loader.load(product_item(_product(n)) for n in range(5000))
+
+    assert report.items == report.written == 5000
+    assert report.failed == 0
+    assert len(client.items) == 5000
+    assert client.items[("PRODUCT#07", "PRODUCT#7")]["price"] == {"N": "107"}
+    assert client.items[("PRODUCT#07", "PRODUCT#7")]["GSI3PK"] == {"S": "CATEGORY#fruit"}
+    assert report.items_per_second > 0
+
+
+def test_bulk_loader_reports_items_that_never_go_through(monkeypatch):
+    monkeypatch.setattr(dynamodb_loader.time, "sleep", lambda seconds: None)
+
+    class StuckDynamoDB:
+        def batch_write_item(self, RequestItems):
+            return {"UnprocessedItems": RequestItems}
+
+    loader = BulkLoader("GroceryAppTable", client=StuckDynamoDB(), workers=2, max_attempts=3)
+
+    report = loader.load(product_item(_product(n)) for n in range(30))
+
+    assert report.written == 0
+    assert report.failed == 30
+
+
+def test_bulk_loader_keeps_draining_when_the_connection_fails():
+    class UnreachableDynamoDB:
+        def batch_write_item(self, RequestItems):
+            raise EndpointConnectionError(endpoint_url="https://dynamodb.us-east-1.amazonaws.com")
+
+    loader = BulkLoader("GroceryAppTable", client=UnreachableDynamoDB(), workers=2)
+
+    # More batches than the queue holds, so a dead writer would block the load
+    report = loader.load(product_item(_product(n)) for n in range(500))
+
+    assert report.items == report.failed == 500
+    assert report.written == 0
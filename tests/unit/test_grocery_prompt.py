@@ -0,0 +1,90 @@
+import io
+import json
+import threading
+
+import grocery_prompt
+import lambda_sqs_poller
+from grocery_prompt import chunk_lines, clean_lines, estimate_tokens, merge_grocery_lists, output_budget
+from model.grocery_list import GroceryList
+
+RECEIPT = """FRESH MART #1042
+  2kg   lemons
+12 eggs
+Whole milk x2
+---------
+SUBTOTAL 23.40
+VAT 20% 3.90
+VISA **** 1234
+www.freshmart.example
+Thank you for shopping!
+14/03/2024 18:22
+"""
+
+
+class FakeBedrock:
+    """Returns one item per line of the prompt text and records every call."""
+
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def invoke_model(self, modelId, body):
+        request = json.loads(body)
+        lines = request["messages"][0]["content"].split("Here is the text:\n    ", 1)[1].splitlines()
+        with self._lock:
+            self.calls.append({"lines": len(lines), "max_tokens": request["max_tokens"]})
+        items = [{"item": line.split(" ", 1)[1], "kg": None, "count": int(line.split(" ", 1)[0])} for line in lines]
+        return {"body": io.BytesIO(json.dumps({
+            "content": [{"text": json.dumps({"items": items})}], "stop_reason": "end_turn",
+        }).encode("utf-8"))}
+
+
+def test_clean_lines_strips_receipt_noise():
+    assert clean_lines(RECEIPT) == ["FRESH MART #1042", "2kg lemons", "12 eggs", "Whole milk x2"]
+    assert clean_lines("\n 12.99 \n----\n") == []
+
+
+def test_chunk_lines_respects_the_token_budget():
+    lines = [f"{n} bananas" for n in range(1000)]
+    chunks = chunk_lines(lines, max_tokens=200)
+
+    assert [line for chunk in chunks for line in chunk] == lines
+    assert all(sum(estimate_tokens(line) + 1 for line in chunk) <= 200 for chunk in chunks)
+    assert chunk_lines(["x" * 2000], max_tokens=100) == [["x" * 2000]]
+
+
+def test_output_budget_scales_with_the_number_of_lines():
+    assert output_budget(["milk"]) < output_budget(["milk"] * 40) < output_budget(["milk"] * 400)
+    assert output_budget(["milk"] * 10000) == grocery_prompt.MAX_OUTPUT_TOKENS
+
+
+def test_merge_adds_up_items_listed_in_several_chunks():
+    first = GroceryList.model_validate({"items": [{"item": "Lemons", "kg": 2}, {"item": "Eggs", "count": 6}]})
+    second = GroceryList.model_validate({"items": [{"item": " eggs ", "count": 6}, {"item": "Milk", "count": 1}]})
+
+    merged = merge_grocery_lists([first, second])
+
+    assert [(item.item, item.kg, item.count) for item in merged.items] == [
+        ("Lemons", 2, None), ("Eggs", None, 12), ("Milk", None, 1),
+    ]
+
+
+def test_long_text_is_extracted_in_parallel_chunks(monkeypatch):
+    bedrock = FakeBedrock()
+    monkeypatch.setattr(lambda_sqs_poller, "bedrock_client", bedrock)
+    text = "\n".join(f"{n % 7 + 1} item number {n}" for n in range(900)) + "\nTOTAL 120.00\n"
+
+    grocery_list = lambda_sqs_poller.extract_grocery_list(text)
+
+    assert len(bedrock.calls) > 1
+    assert sum(call["lines"] for call in bedrock.calls) == 900
+    assert all(call["max_tokens"] == output_budget(["x"] * call["lines"]) for call in bedrock.calls)
+    assert len(grocery_list.items) == 900
+
+
+def test_text_without_list_lines_skips_bedrock(monkeypatch):
+    bedrock = FakeBedrock()
+    monkeypatch.setattr(lambda_sqs_poller, "bedrock_client", bedrock)
+
+    assert lambda_sqs_poller.extract_grocery_list("TOTAL 12.00\n14/03/2024\n").items == []
+    assert bedrock.calls == []
@@ -0,0 +1,146 @@
+import io
+import json
+from dataclasses import dataclass
+
+import pytest
+
+import lambda_sqs_poller
+from grocery_prompt import output_budget
+from model.grocery_list import GroceryList
+
+
+@dataclass
+class LambdaContext:
+    function_name: str = "LambdaSQSPoller"
+    memory_limit_in_mb: int = 128
+    invoked_function_arn: str = "arn:aws:lambda:us-east-1:123456789012:function:LambdaSQSPoller"
+    aws_request_id: str = "request-id"
+
+
+def _sqs_event(texts):
+    return {"Records": [
+        {"messageId": f"msg-{n}", "receiptHandle": f"handle-{n}", "eventSource": "aws:sqs",
+         "body": json.dumps({"text": text, "bucket": "grocery-list", "key": f"user-1/list-{n}.jpg"})}
+        for n, text in enumerate(texts)
+    ]}
+
+
+MILK = GroceryList.model_validate({"items": [{"item": "Milk", "kg": None, "count": 2}]})
+
+
+def test_handler_reports_only_failed_records(monkeypatch):
+    def extract(text):
+        if text == "boom":
+            raise RuntimeError("model error")
+        return MILK
+
+    monkeypatch.setattr(lambda_sqs_poller, "extract_grocery_list", extract)
+
+    response = lambda_sqs_poller.handler(_sqs_event(["milk", "boom", "eggs"]), LambdaContext())
+
+    assert response == {"batchItemFailures": [{"itemIdentifier": "msg-1"}]}
+
+
+def test_parse_grocery_list_validates_model_json():
+    output = 'Here is the list:\n{"items": [{"item": "Lemons", "kg": 2, "count": null}]}'
+    assert lambda_sqs_poller.parse_grocery_list(output).items[0].kg == 2
+
+    with pytest.raises(ValueError):
+        lambda_sqs_poller.parse_grocery_list("No grocery list found.")
+    with pytest.raises(ValueError):
+        lambda_sqs_poller.parse_grocery_list('{"items": [{"item": "", "kg": -1}]}')
+
+
+def test_extracted_list_is_saved_as_an_order_draft(monkeypatch, fake_table):
+    grocery_list = GroceryList.model_validate({"items": [
+        {"item": "Fresh Lemons", "kg": 2.5, "count": None},
+        {"item": "Eggs", "kg": None, "count": 12},
+    ]})
+    monkeypatch.setattr(lambda_sqs_poller, "extract_grocery_list", lambda text: grocery_list)
+
+    lambda_sqs_poller.handler(_sqs_event(["lemons and eggs"]), LambdaContext())
+
+    orders = {key: item for key, item in fake_table.items.items() if key[0].startswith("ORDER#")}
+    header = next(item for (pk, sk), item in orders.items() if sk == "ORDER")
+    lines = sorted((item for (pk, sk), item in orders.items() if sk.startswith("ITEM#")), key=lambda i: i["SK"])
+    assert header["GSI1PK"] == "USER#user-1" and header["itemCount"] == 2
+    assert [line["GSI2PK"] for line in lines] == ["ITEM#fresh lemons", "ITEM#eggs"]
+    assert str(lines[0]["kg"]) == "2.5" and lines[1]["count"] == 12
+    assert fake_table.batch_writes == 1
+
+
+class ModelRouter:
+    """Bedrock runtime stand-in answering with a fixed text per model."""
+
+    def __init__(self, answers, stop_reasons=None):
+        self.answers = answers
+        self.stop_reasons = stop_reasons or {}
+        self.calls = []
+
+    def _answer(self, modelId, body):
+        self.calls.append((modelId, json.loads(body)))
+        return self.answers[modelId]
+
+    def invoke_model(self, modelId, body):
+        text = self._answer(modelId, body)
+        stop_reason = self.stop_reasons.get(modelId, "end_turn")
+        return {"body": io.BytesIO(json.dumps({"content": [{"text": text}], "stop_reason": stop_reason}).encode())}
+
+    def invoke_model_with_response_stream(self, modelId, body):
+        text = self._answer(modelId, body)
+        chunks = [{"type": "message_start"}, {"type": "content_block_start"}]
+        chunks += [{"type": "content_block_delta", "delta": {"type": "text_delta", "text": text[i:i + 7]}}
+                   for i in range(0, len(text), 7)]
+        chunks += [{"type": "message_delta", "delta": {"stop_reason": "end_turn"}}, {"type": "message_stop"}]
+        return {"body": ({"chunk": {"bytes": json.dumps(chunk).encode()}} for chunk in chunks)}
+
+
+CHEAP, LARGE = "cheap-model", "large-model"
+LEMONS = '{"items": [{"item": "Lemons", "kg": 2, "count": null}]}'
+
+
+def test_extraction_escalates_only_when_the_answer_does_not_validate(monkeypatch):
+    monkeypatch.setattr(lambda_sqs_poller, "EXTRACTION_MODEL_IDS", [CHEAP, LARGE])
+    router = ModelRouter({CHEAP: "Sure! Lemons, 2kg.", LARGE: LEMONS})
+    monkeypatch.setattr(lambda_sqs_poller, "bedrock_client", router)
+
+    assert lambda_sqs_poller.extract_grocery_list("2kg lemons").items[0].kg == 2
+    assert [model for model, _ in router.calls] == [CHEAP, LARGE]
+    assert router.calls[0][1]["temperature"] == 0 and "top_p" not in router.calls[0][1]
+
+    router = ModelRouter({CHEAP: LEMONS, LARGE: LEMONS})
+    monkeypatch.setattr(lambda_sqs_poller, "bedrock_client", router)
+    lambda_sqs_poller.extract_grocery_list("2kg lemons")
+    assert [model for model, _ in router.calls] == [CHEAP]
+
+
+def test_truncated_extraction_escalates_with_a_larger_budget(monkeypatch):
+    monkeypatch.setattr(lambda_sqs_poller, "EXTRACTION_MODEL_IDS", [CHEAP, LARGE])
+    router = ModelRouter({CHEAP: LEMONS[:20], LARGE: LEMONS}, stop_reasons={CHEAP: "max_tokens"})
+    monkeypatch.setattr(lambda_sqs_poller, "bedrock_client", router)
+
+    assert lambda_sqs_poller.extract_grocery_list("2kg lemons").items[0].item == "Lemons"
+    budgets = [body["max_tokens"] for _, body in router.calls]
+    assert budgets == [output_budget(["2kg lemons"]), 2 * output_budget(["2kg lemons"])]
+
+
+def test_extraction_fails_when_no_model_validates(monkeypatch):
+    monkeypatch.setattr(lambda_sqs_poller, "EXTRACTION_MODEL_IDS", [CHEAP, LARGE])
+    monkeypatch.setattr(lambda_sqs_poller, "bedrock_client", ModelRouter({CHEAP: "no", LARGE: '{"items": "none"}'}))
+
+    with pytest.raises(ValueError):
+        lambda_sqs_poller.extract_grocery_list("2kg lemons")
+
+
+def test_streamed_extraction_is_assembled(monkeypatch):
+    monkeypatch.setattr(lambda_sqs_poller, "EXTRACTION_MODEL_IDS", [CHEAP])
+    monkeypatch.setattr(lambda_sqs_poller, "EXTRACTION_STREAMING", True)
+    monkeypatch.setattr(lambda_sqs_poller, "bedrock_client", ModelRouter({CHEAP: LEMONS}))
+
+    assert lambda_sqs_poller.extract_grocery_list("2kg lemons").items[0].item == "Lemons"
+
+
+def test_cache_key_changes_with_the_model_chain(monkeypatch):
+    before = lambda_sqs_poller.extraction_cache_salt()
+    monkeypatch.setattr(lambda_sqs_poller, "EXTRACTION_MODEL_IDS", [LARGE])
+    assert lambda_sqs_poller.extraction_cache_salt() != before
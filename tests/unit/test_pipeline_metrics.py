@@ -0,0 +1,69 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import lambda_sqs_poller
+from model.grocery_list import GroceryList
+from pipeline_metrics import captured_metrics, metrics, publish_metrics, recorder
+from tests.unit.pipeline_fakes import FakeContext, agent_event, load_agent_app
+
+
+@pytest.fixture(autouse=True)
+def no_pending_metrics():
+    """Tests elsewhere call instrumented functions outside a handler, which leaves their metrics pending."""
+    recorder.clear()
+    metrics.clear_metrics()
+
+
+def test_recorder_sums_counts_from_worker_threads():
+    @publish_metrics
+    def handler(event, context):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(lambda _: recorder.count("Widgets"), range(1000)))
+        recorder.observe("WidgetDuration", 5)
+        recorder.observe("WidgetDuration", 7)
+        recorder.cache_lookups("WidgetCache", hits=3, misses=1)
+
+    with captured_metrics() as captured:
+        handler({}, FakeContext())
+
+    assert len(captured.documents) == 1
+    assert captured.values("WidgetDuration") == [5, 7]
+    assert captured.values("WidgetCacheHitRate") == [75]
+    assert captured.counts() == {"WidgetCacheHits": 3, "WidgetCacheMisses": 1, "Widgets": 1000}
+
+
+def test_poller_reports_records_and_extracted_items(monkeypatch):
+    milk = GroceryList.model_validate({"items": [{"item": "Milk", "kg": None, "count": 2}]})
+
+    def extract(text):
+        if text == "boom":
+            raise RuntimeError("model error")
+        return milk
+
+    monkeypatch.setattr(lambda_sqs_poller, "extract_grocery_list", extract)
+    event = {"Records": [
+        {"messageId": f"msg-{n}", "receiptHandle": f"handle-{n}", "eventSource": "aws:sqs",
+         "body": json.dumps({"text": text, "bucket": "grocery-list", "key": f"user-1/list-{n}.jpg"})}
+        for n, text in enumerate(["milk", "boom", "eggs"])
+    ]}
+
+    with captured_metrics() as captured:
+        lambda_sqs_poller.handler(event, FakeContext())
+
+    assert captured.total("RecordsReceived") == 3
+    assert captured.total("RecordsFailed") == 1
+    assert captured.total("ExtractedItems") == 2
+    assert len(captured.values("RecordDuration")) == 3
+
+
+def test_agent_routes_are_a_metric_dimension():
+    app = load_agent_app()
+
+    with captured_metrics() as captured:
+        app.lambda_handler(agent_event("/current_time", "GET"), FakeContext())
+
+    [dimensions] = captured.dimensions("RequestDuration")
+    assert dimensions["route"] == "/current_time"
+    assert captured.values("ResponseSize")[0] > 0
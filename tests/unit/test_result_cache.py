@@ -0,0 +1,34 @@
+import lambda_sqs_poller
+from result_cache import STATS_PK, ResultCache, text_hash
+from tests.unit.test_lambda_sqs_poller import MILK, LambdaContext, _sqs_event
+
+
+def test_text_hash_ignores_case_and_spacing():
+    assert text_hash("Milk\n2 Eggs ", "model") == text_hash("milk 2   eggs", "model")
+    assert text_hash("milk", "model-a") != text_hash("milk", "model-b")
+
+
+def test_cache_expires_entries_and_counts_hits(fake_table):
+    cache = ResultCache(table=fake_table, ttl_seconds=60)
+    cache.put("textract", "etag-1", "milk\n")
+
+    assert cache.get("textract", "etag-1") == "milk\n"
+    assert cache.get("textract", "etag-2") is None
+
+    fake_table.items[("CACHE#textract#etag-1", "RESULT")]["expiresAt"] = 0
+    assert cache.get("textract", "etag-1") is None
+
+    assert cache.flush_stats() == {"textract_hits": 1, "textract_misses": 2}
+    assert cache.flush_stats() == {}
+    assert fake_table.items[(STATS_PK, "TOTALS")]["textract_misses"] == 2
+
+
+def test_repeated_list_skips_bedrock(monkeypatch, fake_table):
+    calls = []
+    monkeypatch.setattr(lambda_sqs_poller, "extract_grocery_list", lambda text: calls.append(text) or MILK)
+
+    lambda_sqs_poller.handler(_sqs_event(["Milk\n2 eggs"]), LambdaContext())
+    lambda_sqs_poller.handler(_sqs_event(["milk 2 eggs"]), LambdaContext())
+
+    assert calls == ["Milk\n2 eggs"]
+    assert fake_table.items[(STATS_PK, "TOTALS")]["bedrock_hits"] == 1
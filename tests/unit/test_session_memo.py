@@ -0,0 +1,98 @@
+import json
+
+import pytest
+
+import session_memo
+from catalog_changes import CatalogChangeFeed
+from catalog_index import CatalogIndex
+from session_memo import SESSION_MEMO_ATTRIBUTE, SessionMemo
+from tests.unit.pipeline_fakes import CallStats, FakeContext, FakeDynamoDB, FakeStripe, agent_event, load_agent_app
+
+LEMONS = {"name": "Fresh Lemons", "product_id": "prod_1", "price_id": "price_1", "unit_amount": 7160,
+          "currency": "usd"}
+
+
+def test_memo_round_trips_through_session_attributes():
+    memo = SessionMemo()
+    memo.remember("Fresh  Lemons", LEMONS)
+    memo.set_cart({"price_1": 2}, "https://buy.stripe.com/test_1")
+
+    attributes = memo.to_attributes({"locale": "en"})
+    restored = SessionMemo.from_attributes(attributes)
+
+    assert attributes["locale"] == "en"
+    assert restored.product("fresh lemons") == LEMONS
+    assert restored.cart_link({"price_1": 2}) == "https://buy.stripe.com/test_1"
+    assert restored.cart_link({"price_1": 3}) is None
+    assert not restored.changed
+
+
+def test_memo_expires_entries_and_ignores_unreadable_attributes(monkeypatch):
+    memo = SessionMemo(ttl_seconds=60)
+    memo.remember("Fresh Lemons", LEMONS)
+    later = session_memo.time.time() + 61
+    monkeypatch.setattr(session_memo.time, "time", lambda: later)
+
+    assert memo.product("Fresh Lemons") is None
+    assert SessionMemo.from_attributes({SESSION_MEMO_ATTRIBUTE: "{not json"}).products == {}
+
+
+def test_memo_drops_the_oldest_products_when_too_big(monkeypatch):
+    monkeypatch.setattr(session_memo, "SESSION_MEMO_MAX_BYTES", 1024)
+    memo = SessionMemo()
+    for n in range(50):
+        memo.products[f"product {n}"] = {"entry": dict(LEMONS, name=f"Product {n}"), "at": n}
+
+    raw = memo.to_attributes({})[SESSION_MEMO_ATTRIBUTE]
+
+    kept = json.loads(raw)["products"]
+    assert len(raw) <= 1024 and "product 49" in kept and "product 0" not in kept
+
+
+@pytest.fixture
+def agent(monkeypatch):
+    """The agent app wired to a fake Stripe, with a cold catalog index on every request."""
+    app = load_agent_app()
+    monkeypatch.setattr(app, "catalog_changes", lambda: CatalogChangeFeed(table=FakeDynamoDB(CallStats()).table()))
+    stripe = FakeStripe(CallStats())
+    stripe.product_create(name="Fresh Lemons", default_price_data={"unit_amount": 7160, "currency": "usd"})
+    stripe.product_create(name="Eggs", default_price_data={"unit_amount": 310, "currency": "usd"})
+    stripe.stats.calls.clear()
+    app.stripe_api()
+    monkeypatch.setattr(app, "stripe_catalog", CatalogIndex)
+    with stripe.install():
+        yield app, stripe
+
+
+def _ask(app, event, previous=None):
+    if previous is not None:
+        event["sessionAttributes"] = previous.get("sessionAttributes", event["sessionAttributes"])
+    return app.lambda_handler(event, FakeContext())
+
+
+def test_follow_up_turns_skip_stripe_lookups(agent):
+    app, stripe = agent
+    order = [{"product_name": "Fresh Lemons", "qty": 2}, {"product_name": "eggs", "qty": 12}]
+
+    first = _ask(app, agent_event("/order_payment_link", "POST", body={"line_items": order}))
+    lookups = sum(count for name, count in stripe.stats.calls.items() if not name.startswith("stripe.payment_link"))
+    assert lookups > 0 and stripe.stats.calls["stripe.payment_link_create"] == 1
+
+    # Asking again for the same cart reuses the link without calling Stripe
+    stripe.stats.calls.clear()
+    again = _ask(app, agent_event("/order_payment_link", "POST", body={"line_items": order}), first)
+    assert not stripe.stats.calls
+    assert again["response"]["responseBody"] == first["response"]["responseBody"]
+
+    # Changing a quantity only creates the new link
+    order[1]["qty"] = 6
+    _ask(app, agent_event("/order_payment_link", "POST", body={"line_items": order}), again)
+    assert dict(stripe.stats.calls) == {"stripe.payment_link_create": 1}
+
+
+def test_requests_without_memo_changes_leave_session_attributes_alone(agent):
+    app, _ = agent
+
+    response = _ask(app, agent_event("/current_time", "GET"))
+
+    assert "sessionAttributes" not in response
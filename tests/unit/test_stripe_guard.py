@@ -0,0 +1,185 @@
+import pytest
+import stripe
+
+import catalog_index
+import stripe_guard
+from catalog_changes import CatalogChangeFeed
+from catalog_index import CatalogIndex
+from stripe_guard import CircuitBreaker, SharedLookup, StripeUnavailable
+from tests.unit.pipeline_fakes import CallStats, FakeContext, FakeDynamoDB, FakeStripe, agent_event, load_agent_app
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    """A fresh circuit breaker on a fake clock, used by the catalog index and the payment link routes."""
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30, clock=clock)
+    monkeypatch.setattr(stripe_guard, "stripe_breaker", breaker)
+    monkeypatch.setattr(catalog_index, "stripe_breaker", breaker)
+    return breaker, clock
+
+
+def _timeout():
+    raise stripe.error.APIConnectionError("Request timed out")
+
+
+def test_breaker_opens_fails_fast_and_probes_after_the_reset(breaker):
+    breaker, clock = breaker
+    with pytest.raises(stripe.error.InvalidRequestError):
+        breaker.call(lambda: (_ for _ in ()).throw(stripe.error.InvalidRequestError("No such price", "price")))
+    for _ in range(2):
+        with pytest.raises(stripe.error.APIConnectionError):
+            breaker.call(_timeout)
+    assert breaker.state == "open"
+
+    with pytest.raises(StripeUnavailable) as rejected:
+        breaker.call(lambda: pytest.fail("Stripe must not be called while the circuit is open"))
+    assert rejected.value.retry_after == 30
+
+    clock.now += 30
+    with pytest.raises(stripe.error.APIConnectionError):
+        breaker.call(_timeout)
+    assert breaker.state == "open"
+    clock.now += 30
+    assert breaker.call(lambda: "ok") == "ok" and breaker.state == "closed"
+
+
+def test_expired_index_keeps_answering_while_stripe_is_down(breaker, monkeypatch):
+    lemons = stripe.util.convert_to_stripe_object(
+        {"object": "product", "id": "prod_1", "name": "Fresh Lemons", "active": True, "default_price": "price_1"})
+    price = stripe.util.convert_to_stripe_object(
+        {"object": "price", "id": "price_1", "unit_amount": 100, "currency": "usd"})
+    price["product"] = lemons
+    monkeypatch.setattr(stripe.Price, "list", lambda **kwargs: stripe.ListObject.construct_from(
+        {"object": "list", "data": [price], "has_more": False}, None))
+    index = CatalogIndex(ttl_seconds=0)
+    assert index.lookup("Fresh Lemons").price_id == "price_1"
+
+    monkeypatch.setattr(stripe.Price, "list", lambda **kwargs: _timeout())
+
+    assert index.lookup("fresh lemons").price_id == "price_1"
+
+
+def test_containers_share_one_catalog_listing(breaker, monkeypatch):
+    lemons = stripe.util.convert_to_stripe_object(
+        {"object": "product", "id": "prod_1", "name": "Fresh Lemons", "active": True, "default_price": "price_1"})
+    price = stripe.util.convert_to_stripe_object(
+        {"object": "price", "id": "price_1", "unit_amount": 100, "currency": "usd"})
+    price["product"] = lemons
+    listings = []
+
+    def price_list(**kwargs):
+        listings.append(kwargs)
+        return stripe.ListObject.construct_from({"object": "list", "data": [price], "has_more": False}, None)
+
+    monkeypatch.setattr(stripe.Price, "list", price_list)
+    table = FakeDynamoDB(CallStats()).table()
+    changed = set()
+
+    def container():
+        return CatalogIndex(shared=SharedLookup(table=table),
+                            changed_since=lambda name, at_seconds: name in changed)
+
+    assert container().lookup("Fresh Lemons").price_id == "price_1"
+    assert container().lookup("fresh lemons").price_id == "price_1"
+    assert len(listings) == 1
+
+    # A container reading the listing after a change searches for that product itself
+    changed.add("Fresh Lemons")
+    index = container()
+    index.refresh()
+    assert len(index) == 0 and len(listings) == 1
+
+
+def test_a_container_waits_for_the_lease_holder_instead_of_calling_stripe():
+    table = FakeDynamoDB(CallStats()).table()
+    clock = Clock()
+    leader = SharedLookup(table=table, clock=clock)
+    assert leader._take_lease("catalog-index")
+
+    def sleep(seconds):
+        clock.now += seconds
+        leader._publish("catalog-index", "[]", clock.now)
+
+    follower = SharedLookup(table=table, clock=clock, sleep=sleep)
+    value, _ = follower.get("catalog-index", lambda: pytest.fail("the lease holder reads Stripe"))
+    assert value == "[]"
+
+    # Once the lease expires without a result, the next container reads Stripe
+    clock.now += follower.ttl_seconds + follower.wait_seconds + 1
+    assert follower.get("catalog-index", lambda: "fresh")[0] == "fresh"
+
+
+@pytest.fixture
+def agent(monkeypatch, breaker):
+    app = load_agent_app()
+    monkeypatch.setattr(app, "catalog_changes", lambda: CatalogChangeFeed(table=FakeDynamoDB(CallStats()).table()))
+    fake = FakeStripe(CallStats())
+    fake.product_create(name="Fresh Lemons", default_price_data={"unit_amount": 7160, "currency": "usd"})
+    app.stripe_api()
+    index = CatalogIndex()
+    monkeypatch.setattr(app, "stripe_catalog", lambda: index)
+    with fake.install():
+        yield app, fake, breaker[0]
+
+
+def _payment_link(app):
+    event = agent_event("/payment_link", "GET", parameters={"product_name": "Fresh Lemons", "qty": "2"})
+    response = app.lambda_handler(event, FakeContext())
+    return response["response"]["responseBody"]["application/json"]["body"]
+
+
+def test_payment_link_explains_stripe_outages(agent, monkeypatch):
+    app, fake, breaker = agent
+    monkeypatch.setattr(stripe.PaymentLink, "create", lambda **kwargs: _timeout())
+
+    assert _payment_link(app).startswith("Stripe did not respond in time")
+    assert _payment_link(app).startswith("Stripe did not respond in time")
+    assert breaker.state == "open"
+
+    fake.stats.calls.clear()
+    assert _payment_link(app) == "Payments are temporarily unavailable. Please try again in about 31 seconds."
+    assert not fake.stats.calls
+
+
+def test_only_a_stale_price_invalidates_the_catalog_entry(agent, monkeypatch):
+    app, fake, _ = agent
+    assert _payment_link(app).startswith("Payment Link URL")
+    index = app.stripe_catalog()
+    price_id = index.lookup("Fresh Lemons").price_id
+
+    def rejected(**kwargs):
+        raise stripe.error.InvalidRequestError("This value must be less than or equal to 999.",
+                                               "line_items[0][quantity]")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(stripe.PaymentLink, "create", rejected)
+        event = agent_event("/payment_link", "GET", parameters={"product_name": "Fresh Lemons", "qty": "3"})
+        response = app.lambda_handler(event, FakeContext())["response"]["responseBody"]["application/json"]["body"]
+    assert response.startswith("The payment link could not be created")
+    assert len(index) == 1
+
+    fake.price_modify(price_id, active=False)
+    event = agent_event("/payment_link", "GET", parameters={"product_name": "Fresh Lemons", "qty": "4"})
+    response = app.lambda_handler(event, FakeContext())["response"]["responseBody"]["application/json"]["body"]
+    assert response == "The price of Fresh Lemons has changed. Please ask for the payment link again."
+    assert len(index) == 0
+
+
+def test_quantities_below_one_never_reach_stripe(agent):
+    app, fake, _ = agent
+    fake.stats.calls.clear()
+
+    order = [{"product_name": "Fresh Lemons", "qty": -2}]
+    for event in (agent_event("/payment_link", "GET", parameters={"product_name": "Fresh Lemons", "qty": "0"}),
+                  agent_event("/order_payment_link", "POST", body={"line_items": order})):
+        assert app.lambda_handler(event, FakeContext())["response"]["httpStatusCode"] == 422
+    assert not fake.stats.calls
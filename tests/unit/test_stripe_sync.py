@@ -0,0 +1,97 @@
+import stripe
+
+import stripe_sync
+from stripe_sync import StripeCatalogSync, catalog_fingerprint, plan_sync
+from tests.unit.stripe_objects import ListResult, StripeObj
+
+
+def _catalog_item(product_id, price=100):
+    return {
+        "productId": product_id, "name": f"Product {product_id}", "description": "d", "category": "fruit",
+        "createdDate": "2017-04-17", "modifiedDate": "2019-03-13", "tags": ["a"],
+        "package": {"height": 1, "length": 1, "weight": 1, "width": 1}, "pictures": [], "price": price,
+    }
+
+
+def _stripe_product(item, fingerprint, price_id="price_old", amount=100):
+    return StripeObj(
+        id=f"prod_{item['productId']}", name=item["name"],
+        metadata={"productId": item["productId"], "syncHash": fingerprint},
+        default_price=StripeObj(id=price_id, unit_amount=amount),
+    )
+
+
+def test_plan_only_touches_new_and_changed_products():
+    same, changed, new = _catalog_item("1"), _catalog_item("2", price=250), _catalog_item("3")
+    existing = {
+        "1": _stripe_product(same, catalog_fingerprint(same)),
+        "2": _stripe_product(changed, catalog_fingerprint(_catalog_item("2"))),
+    }
+    plan = plan_sync([same, changed, new], existing)
+    assert [item["productId"] for item, _ in plan.creates] == ["3"]
+    assert [item["productId"] for item, _, _ in plan.updates] == ["2"]
+    assert plan.unchanged == 1
+
+
+def test_sync_is_idempotent_and_replaces_changed_prices(monkeypatch):
+    changed, new = _catalog_item("2", price=250), _catalog_item("3")
+    calls = []
+    existing = [_stripe_product(changed, "stale")]
+
+    monkeypatch.setattr(stripe.Product, "list", lambda **kw: ListResult(existing))
+    monkeypatch.setattr(stripe.Product, "create", lambda **kw: calls.append(("create", kw)) or StripeObj(**kw))
+    monkeypatch.setattr(stripe.Product, "modify", lambda id, **kw: calls.append(("modify", kw)))
+    monkeypatch.setattr(stripe.Price, "create", lambda **kw: calls.append(("price", kw)) or StripeObj(id="price_new"))
+    monkeypatch.setattr(stripe.Price, "modify", lambda id, **kw: calls.append(("archive", id, kw)))
+
+    summary = StripeCatalogSync(max_workers=2).run([changed, new])
+
+    assert summary == {"created": 1, "updated": 1, "unchanged": 0, "failed": 0, "remaining": 0, "complete": True}
+    create = next(kw for name, kw in calls if name == "create")
+    assert create["id"] == "3" and create["metadata"]["syncHash"] == catalog_fingerprint(new)
+    assert create["default_price_data"] == {"unit_amount": 100, "currency": "usd"}
+    modify = next(kw for name, kw in calls if name == "modify")
+    assert modify["default_price"] == "price_new"
+    assert ("archive", "price_old", {"active": False}) in calls
+
+
+def test_sync_stops_at_deadline_and_reports_remaining(monkeypatch):
+    monkeypatch.setattr(stripe.Product, "list", lambda **kw: ListResult([]))
+    monkeypatch.setattr(stripe_sync, "create_product", lambda *args: None)
+
+    summary = StripeCatalogSync(remaining_time_ms=lambda: 1000).run([_catalog_item("1"), _catalog_item("2")])
+
+    assert summary["remaining"] == 2
+    assert summary["complete"] is False
+
+
+def test_backoff_retries_rate_limits(monkeypatch):
+    monkeypatch.setattr(stripe_sync.time, "sleep", lambda seconds: None)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise stripe.error.RateLimitError("slow down")
+        return "ok"
+
+    assert stripe_sync.with_backoff(flaky) == "ok"
+    assert len(attempts) == 3
+
+
+def test_listing_retries_a_rate_limited_page_on_its_own(monkeypatch):
+    monkeypatch.setattr(stripe_sync.time, "sleep", lambda seconds: None)
+    products = [_stripe_product(_catalog_item(str(n)), "hash") for n in range(5)]
+    requests = []
+
+    def product_list(starting_after=None, limit=100, **kwargs):
+        requests.append(starting_after)
+        if starting_after is not None and requests.count(starting_after) == 1:
+            raise stripe.error.RateLimitError("slow down")
+        start = 0 if starting_after is None else [p.id for p in products].index(starting_after) + 1
+        return ListResult(products[start:start + 2], has_more=start + 2 < len(products))
+
+    monkeypatch.setattr(stripe.Product, "list", product_list)
+
+    assert sorted(stripe_sync.list_existing_products()) == [str(n) for n in range(5)]
+    assert requests == [None, "prod_1", "prod_1", "prod_3", "prod_3"]
@@ -0,0 +1,80 @@
+import random
+import time
+
+from textract_lines import read_lines
+
+import trigger_step_functions_wrokflow as trigger
+
+
+def _blocks(count, pages=1, noise_every=0, seed=7):
+    """Synthetic Textract output: a PAGE block, then LINE blocks each followed by two WORD blocks."""
+    rng = random.Random(seed)
+    result = []
+    for page in range(1, pages + 1):
+        blocks = [{"BlockType": "PAGE", "Page": page}]
+        for n in range(count // pages):
+            noisy = noise_every and n % noise_every == 0
+            text = f"p{page} item {n}"
+            blocks.append({
+                "BlockType": "LINE", "Text": text, "Page": page,
+                "Confidence": rng.uniform(5, 30) if noisy else rng.uniform(80, 99.9),
+                "Geometry": {"BoundingBox": {"Left": 0.1, "Top": n / count, "Width": 0.5, "Height": 0.01}},
+            })
+            blocks.extend({"BlockType": "WORD", "Text": word, "Page": page} for word in text.split()[:2])
+        result.append(blocks)
+    return result
+
+
+def test_read_lines_joins_tens_of_thousands_of_blocks_in_linear_time():
+    pages = _blocks(40000, pages=40)
+
+    started = time.perf_counter()
+    lines = read_lines(pages, min_confidence=0)
+    elapsed = time.perf_counter() - started
+
+    assert len(lines) == 40000
+    assert lines.text.startswith("p1 item 0\np1 item 1\n")
+    assert lines.text.count("\n") == 40000
+    assert elapsed < 1.0
+
+    # Doubling the input roughly doubles the work rather than quadrupling it
+    pages = _blocks(80000, pages=80)
+    started = time.perf_counter()
+    read_lines(pages, min_confidence=0)
+    assert time.perf_counter() - started < max(4 * elapsed, 0.5)
+
+
+def test_read_lines_drops_low_confidence_noise():
+    lines = read_lines(_blocks(20000, noise_every=10), min_confidence=50)
+
+    assert lines.dropped == 2000
+    assert len(lines) == 18000
+    assert "item 0\n" not in lines.text and "item 1\n" in lines.text
+
+
+def test_read_lines_keeps_layout_in_columns():
+    lines = read_lines(_blocks(30000, pages=3), min_confidence=0, keep_layout=True)
+
+    assert len(lines.confidence) == len(lines.page) == len(lines) == 30000
+    assert len(lines.bbox) == 4 * len(lines)
+    assert lines.page[0] == 1 and lines.page[-1] == 3
+    left, top, width, height = lines.box(1)
+    assert (round(left, 3), round(width, 3)) == (0.1, 0.5)
+
+    columns = lines.to_columns()
+    assert columns["lines"][0] == "p1 item 0" and len(columns["bbox"]) == 120000
+
+    plain = read_lines(_blocks(100), min_confidence=0)
+    assert len(plain.confidence) == len(plain.bbox) == 0
+
+
+def test_extract_text_from_file_uses_the_confidence_threshold(monkeypatch):
+    class Textract:
+        def detect_document_text(self, Document):
+            return {"Blocks": [
+                {"BlockType": "LINE", "Text": "2kg lemons", "Confidence": 97.1},
+                {"BlockType": "LINE", "Text": "~~", "Confidence": 12.0},
+                {"BlockType": "LINE", "Text": "12 eggs", "Confidence": 88.4},
+            ]}
+
+    assert trigger.extract_text_from_file(Textract(), "grocery-list", "user-1/list.jpg") == "2kg lemons\n12 eggs\n"
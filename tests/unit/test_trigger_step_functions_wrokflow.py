@@ -0,0 +1,183 @@
+import json
+import threading
+import time
+
+import pytest
+
+import trigger_step_functions_wrokflow as trigger
+from tests.unit.pipeline_fakes import CallStats, FakeS3
+
+
+class FakeTextract:
+    def __init__(self, pages):
+        self.pages = pages
+        self.calls = []
+
+    def get_document_text_detection(self, **kwargs):
+        self.calls.append(kwargs)
+        page = int(kwargs.get("NextToken", 0))
+        response = {"Blocks": self.pages[page]}
+        if page + 1 < len(self.pages):
+            response["NextToken"] = str(page + 1)
+        return response
+
+
+class FakeSQS:
+    def __init__(self, reject=()):
+        self.messages = []
+        self.batches = []
+        self.reject = set(reject)
+
+    def send_message_batch(self, QueueUrl, Entries):
+        assert len(Entries) <= trigger.SQS_BATCH_SIZE
+        self.batches.append(len(Entries))
+        failed = []
+        for entry in Entries:
+            body = json.loads(entry["MessageBody"])
+            if body["key"] in self.reject:
+                failed.append({"Id": entry["Id"], "Code": "InternalError", "SenderFault": False, "Message": "boom"})
+            else:
+                self.messages.append(body)
+        return {"Successful": [], "Failed": failed}
+
+
+class SlowTextract:
+    """Synchronous detection that takes `latency` seconds per object."""
+
+    def __init__(self, latency, broken=()):
+        self.latency = latency
+        self.broken = set(broken)
+        self.in_flight = self.peak = 0
+        self._lock = threading.Lock()
+
+    def detect_document_text(self, Document):
+        key = Document["S3Object"]["Name"]
+        with self._lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        time.sleep(self.latency)
+        with self._lock:
+            self.in_flight -= 1
+        if key in self.broken:
+            raise RuntimeError("throttled")
+        return {"Blocks": [_line(f"item from {key}")]}
+
+
+def _s3_event(count):
+    return {"Records": [
+        {"s3": {"bucket": {"name": "grocery-list"}, "object": {"key": f"user-1/list-{n}.jpg"}}}
+        for n in range(count)
+    ]}
+
+
+def _line(text):
+    return {"BlockType": "LINE", "Text": text}
+
+
+def test_completion_handler_reads_every_result_page(monkeypatch):
+    textract = FakeTextract([[_line("milk"), {"BlockType": "WORD", "Text": "milk"}], [_line("eggs")]])
+    sqs = FakeSQS()
+    monkeypatch.setenv("SQS_QUEUE_URL", "https://sqs.example/queue")
+    monkeypatch.setattr(trigger, "textract", textract)
+    monkeypatch.setattr(trigger, "sqs_client", sqs)
+
+    message = {
+        "JobId": "job-1", "Status": "SUCCEEDED", "API": "StartDocumentTextDetection",
+        "DocumentLocation": {"S3ObjectName": "lists/week.pdf", "S3Bucket": "grocery-list"},
+    }
+    failed = dict(message, JobId="job-2", Status="FAILED")
+    event = {"Records": [{"Sns": {"Message": json.dumps(message)}}, {"Sns": {"Message": json.dumps(failed)}}]}
+
+    trigger.textract_completion_handler(event, None)
+
+    assert [call.get("NextToken") for call in textract.calls] == [None, "1"]
+    assert sqs.messages == [{"text": "milk\neggs\n", "bucket": "grocery-list", "key": "lists/week.pdf"}]
+
+
+def test_handler_extracts_records_concurrently_and_batches_messages(monkeypatch):
+    textract = SlowTextract(latency=0.05)
+    sqs = FakeSQS()
+    monkeypatch.setenv("SQS_QUEUE_URL", "https://sqs.example/queue")
+    monkeypatch.setattr(trigger, "textract", textract)
+    monkeypatch.setattr(trigger, "sqs_client", sqs)
+    monkeypatch.setattr(trigger, "record_concurrency", 25)
+
+    started = time.perf_counter()
+    response = trigger.handler(_s3_event(25), None)
+    elapsed = time.perf_counter() - started
+
+    assert response["statusCode"] == 200
+    assert textract.peak > 1
+    # Serially this would take 25 x 50 ms
+    assert elapsed < 0.5
+    assert sqs.batches == [10, 10, 5]
+    assert sorted(message["key"] for message in sqs.messages) == sorted(f"user-1/list-{n}.jpg" for n in range(25))
+
+
+def test_handler_reports_failed_records_without_dropping_the_others(monkeypatch):
+    textract = SlowTextract(latency=0, broken={"user-1/list-1.jpg"})
+    sqs = FakeSQS(reject={"user-1/list-2.jpg"})
+    monkeypatch.setenv("SQS_QUEUE_URL", "https://sqs.example/queue")
+    monkeypatch.setattr(trigger, "textract", textract)
+    monkeypatch.setattr(trigger, "sqs_client", sqs)
+
+    with pytest.raises(trigger.RecordsFailed) as failed:
+        trigger.handler(_s3_event(4), None)
+
+    assert sorted(failure["key"] for failure in failed.value.failures) == ["user-1/list-1.jpg", "user-1/list-2.jpg"]
+    assert sorted(message["key"] for message in sqs.messages) == ["user-1/list-0.jpg", "user-1/list-3.jpg"]
+
+
+class RoutingTextract:
+    """Records how each document was handed to Textract."""
+
+    def __init__(self):
+        self.documents = []
+        self.jobs = []
+
+    def detect_document_text(self, Document):
+        self.documents.append(Document)
+        return {"Blocks": [_line("2kg lemons")]}
+
+    def start_document_text_detection(self, DocumentLocation, **kwargs):
+        self.jobs.append(DocumentLocation["S3Object"]["Name"])
+        return {"JobId": f"job-{len(self.jobs)}"}
+
+
+def _upload(s3, key, body=b"image bytes"):
+    s3.put_object(Bucket="grocery-list", Key=key, Body=body)
+    return s3.notification("grocery-list", [key])["Records"][0]
+
+
+def test_documents_are_routed_by_type_and_size(monkeypatch):
+    s3, textract = FakeS3(CallStats()), RoutingTextract()
+    monkeypatch.setattr(trigger, "s3_client", s3)
+    monkeypatch.setattr(trigger, "textract", textract)
+    monkeypatch.setenv("TEXTRACT_SNS_TOPIC_ARN", "arn:aws:sns:us-east-1:123456789012:textract")
+    monkeypatch.setenv("TEXTRACT_ROLE_ARN", "arn:aws:iam::123456789012:role/textract")
+    monkeypatch.setattr(trigger, "TEXTRACT_BYTES_MAX_BYTES", 20)
+
+    small = trigger.process_record(_upload(s3, "user-1/small.jpg"))
+    trigger.process_record(_upload(s3, "user-1/medium.png", b"x" * 21))
+    large = {"s3": {"bucket": {"name": "grocery-list"}, "object": {
+        "key": "user-1/large.png", "size": trigger.TEXTRACT_SYNC_MAX_BYTES + 1, "eTag": "large"}}}
+    assert trigger.process_record(large) is None
+    assert trigger.process_record(_upload(s3, "user-1/scan.TIFF", b"scanned pages")) is None
+    assert trigger.process_record(_upload(s3, "textract-output/1.json", b"{}")) is None
+
+    assert small == {"text": "2kg lemons\n", "bucket": "grocery-list", "key": "user-1/small.jpg"}
+    assert textract.documents == [{"Bytes": b"image bytes"},
+                                  {"S3Object": {"Bucket": "grocery-list", "Name": "user-1/medium.png"}}]
+    assert textract.jobs == ["user-1/large.png", "user-1/scan.TIFF"]
+    assert s3.stats.calls["s3.get_object"] == 1
+
+
+def test_replaced_objects_are_skipped(monkeypatch):
+    s3, textract = FakeS3(CallStats()), RoutingTextract()
+    monkeypatch.setattr(trigger, "s3_client", s3)
+    monkeypatch.setattr(trigger, "textract", textract)
+    record = _upload(s3, "user-1/list.jpg")
+    s3.put_object(Bucket="grocery-list", Key="user-1/list.jpg", Body=b"a newer photo")
+
+    assert trigger.process_record(record) is None
+    assert textract.documents == []